@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Write-behind buffer for V_API event logging
+"""
+__author__ = "Simon Rosner"
+__credits__ = ["Simon Rosner"]
+__version__ = "2026.10.18"
+__maintainer__ = "Simon Rosner"
+__email__ = ""
+
+import threading
+import atexit
+import time
+import sys
+
+class AuditBuffer:
+    def __init__(self, pool, batchSize=50, flushInterval=2.0, maxAttempts=5):
+        """
+        Queues events in memory and writes them
+        to the database in batches.
+        Requires the DBPool to write through,
+        the number of events that forces a flush,
+        the max seconds an event may wait
+        and the flushes an event may fail before it is dropped
+        """
+        self.pool = pool
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.maxAttempts = maxAttempts
+        self._events = []   #(description, timestamp, actors, failed attempts)
+        self._lock = threading.Lock()
+        self._flushLock = threading.Lock()  #keeps batches in order
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def add(self, description, actors):
+        """
+        Queues an event. The timestamp is taken now,
+        not when the event is written
+        """
+        theNow = str(round(time.time(),2))
+        with self._lock:
+            self._events.append((str(description), theNow, list(actors), 0))
+            full = len(self._events) >= self.batchSize
+            if self._thread is None and not self._stopping:
+                self._thread = threading.Thread(target=self._run,
+                                                name="audit-flush",
+                                                daemon=True)
+                self._thread.start()
+        if full:
+            self.flush()
+
+    def pending(self):
+        """
+        Number of events not yet written
+        """
+        return len(self._events)
+
+    def flush(self):
+        """
+        Writes every queued event in one transaction.
+        If that fails the events are written one by one,
+        so one bad event does not hold back the rest.
+        Inside a caller's transaction nothing is written,
+        a rollback would take other threads' events with it,
+        the flush thread is woken instead.
+        Returns the number written
+        """
+        if self.pool.inTransaction():
+            self._wake.set()
+            return 0
+        with self._flushLock:
+            with self._lock:
+                events = self._events
+                self._events = []
+            if len(events) == 0:
+                return 0
+            try:
+                self._write(events)
+                return len(events)
+            except Exception:
+                pass
+            written = 0
+            failed = []
+            for event in events:
+                try:
+                    self._write([event])
+                    written+= 1
+                except Exception as e:
+                    failed.append((event, e))
+            self._retry(failed)
+            return written
+
+    def _write(self, events):
+        """
+        Inserts events and their actors in one transaction
+        """
+        eventInsert = "Insert into Events(description, timestamp) "
+        eventInsert+= "Values(?,?)"
+        addActor = "Insert into Actors(eventID, actorID) "
+        addActor+= "Values(?,?)"
+        with self.pool.transaction() as c:
+            actorRows = []
+            for description, theNow, actors, attempts in events:
+                c.execute(eventInsert, [description, theNow])
+                eventID = c.lastrowid
+                for actor in actors:
+                    actorRows.append([eventID, actor])
+            c.executemany(addActor, actorRows)
+
+    def _retry(self, failed):
+        """
+        Puts failed events back for the next flush,
+        dropping those which failed maxAttempts times
+        """
+        retry = []
+        for (description, theNow, actors, attempts), e in failed:
+            attempts+= 1
+            if attempts < self.maxAttempts:
+                retry.append((description, theNow, actors, attempts))
+            else:
+                sys.stderr.write("audit event dropped after "+str(attempts)
+                                 +" attempts: "+description+": "+str(e)+'\n')
+        with self._lock:
+            self._events = retry + self._events
+
+    def _run(self):
+        """
+        Background flush loop
+        """
+        while not self._stopping:
+            self._wake.wait(self.flushInterval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                sys.stderr.write("audit flush failed: "+str(e)+'\n')
+
+    def close(self):
+        """
+        Stops the background thread and
+        writes whatever is left
+        """
+        self._stopping = True
+        self._wake.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self._thread = None
+        self.flush()
+
+_buffers = {}
+_buffersLock = threading.Lock()
+
+def getAuditBuffer(pool, batchSize=50, flushInterval=2.0, maxAttempts=5):
+    """
+    Returns the shared buffer for a pool's database
+    """
+    with _buffersLock:
+        buf = _buffers.get(pool.db)
+        if buf is None or buf.pool is not pool:
+            buf = AuditBuffer(pool, batchSize, flushInterval, maxAttempts)
+            _buffers[pool.db] = buf
+        return buf
+
+def closeAuditBuffer(db):
+    """
+    Flushes and forgets the buffer for a database file path
+    """
+    with _buffersLock:
+        buf = _buffers.pop(db, None)
+    if buf is not None:
+        buf.close()
+
+@atexit.register
+def closeAll():
+    """
+    Flushes every buffer. Runs at interpreter shutdown,
+    before the pools are closed
+    """
+    with _buffersLock:
+        buffers = list(_buffers.values())
+        _buffers.clear()
+    for buf in buffers:
+        try:
+            buf.close()
+        except Exception as e:
+            sys.stderr.write("audit flush failed: "+str(e)+'\n')
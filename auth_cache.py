@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Cached answers to who is who and who is an admin
+"""
+__author__ = "Simon Rosner"
+__credits__ = ["Simon Rosner"]
+__version__ = "2026.10.18"
+__maintainer__ = "Simon Rosner"
+__email__ = ""
+
+import threading
+import time
+from collections import OrderedDict
+
+#returned by get when a key is not cached, None is a valid answer
+MISSING = object()
+
+class AuthCache:
+    def __init__(self, maxEntries=1024, ttl=60):
+        """
+        Least recently used cache of service accounts to user IDs
+        and user IDs to admin status.
+        Requires the most entries kept
+        and the seconds an answer may be used for,
+        which covers changes made by other processes
+        """
+        self.maxEntries = maxEntries
+        self.ttl = ttl
+        self.version = 0    #bumped by every invalidation, see put
+        self._entries = OrderedDict()   #key -> (value, time stored)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Cached value for key or MISSING
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+            if time.time() - entry[1] > self.ttl:
+                del self._entries[key]
+                return MISSING
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, version):
+        """
+        Stores value, read from the database when the cache was
+        at version. Dropped if anything was invalidated since,
+        as the value may predate the change
+        """
+        with self._lock:
+            if version != self.version:
+                return
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxEntries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        with self._lock:
+            self.version+= 1
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.version+= 1
+            self._entries.clear()
+
+def userKey(uid):
+    #IDs arrive as ints from the bot and strings from web_API
+    return ('user', str(uid))
+
+def serviceKey(serviceID):
+    #service IDs are compared without case
+    return ('service', str(serviceID).lower())
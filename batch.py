@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Runs many V_API calls from one web request, see /batch/ in web_API.py
+"""
+__author__ = "Simon Rosner"
+__credits__ = ["Simon Rosner"]
+__version__ = "2026.10.18"
+__maintainer__ = "Simon Rosner"
+__email__ = ""
+
+import constants
+
+class BatchRolledBack(Exception):
+    """
+    An operation ended the whole transaction,
+    ex: a duplicate user name, which Users rolls back ON CONFLICT
+    """
+
+#methods which only touch the database
+#   each runs in its own savepoint inside the batch's transaction
+BATCH_METHODS = ('adminCheck',
+                 'adminCheckThroughService',
+                 'claimByVM',
+                 'claimUser',
+                 'claimVM',
+                 'createServiceUser',
+                 'createUser',
+                 'getIDbyHostname',
+                 'getIDbyName',
+                 'getUserID',
+                 'getUserVMCount',
+                 'guessIDbyName',
+                 'listUsers',
+                 'listVMs',
+                 'makeAdmin',
+                 'reactivateUser',
+                 'removeUser',
+                 'userOwnsVM')
+#methods which run vagrant, queued as jobs once the batch commits
+#   destroy, delete, provision and clean need the checks their own routes make
+BATCH_JOBS = ('buildThroughService',
+              'buildVM',
+              'rebuildVM')
+
+def parseOperation(operation):
+    """
+    (method, args) from {"method": name, "args": [...]}
+    """
+    if not isinstance(operation, dict) or not isinstance(operation.get('method'), str):
+        raise ValueError("Each operation needs a method")
+    args = operation.get('args', [])
+    if not isinstance(args, list):
+        raise ValueError("args must be a list")
+    return operation['method'], args
+
+def runBatch(v, operations, jobs=None, maxOperations=None):
+    """
+    Runs a list of operations, each {"method": name, "args": [...]},
+    in one transaction and returns a result for each, in order:
+        {"ok": true, "result": ...}
+        {"ok": true, "job": job ID}
+        {"ok": false, "error": message}
+    A failed operation is rolled back on its own, the rest still commit,
+    unless the database rolled back everything, then every operation fails.
+    Requires a V_API,
+    a function returning the JobQueue, or None to reject vagrant operations
+    and the most operations allowed (constants.BATCH_MAX_OPERATIONS by default).
+    Raises ValueError if operations is not a list or is too long
+    """
+    if maxOperations is None:
+        maxOperations = constants.BATCH_MAX_OPERATIONS
+    if not isinstance(operations, list):
+        raise ValueError("A batch is a list of operations")
+    if len(operations) > maxOperations:
+        raise ValueError("A batch may have at most "+str(maxOperations)+" operations")
+    results = [None] * len(operations)
+    queued = []
+    try:
+        _runOperations(v, operations, jobs, results, queued)
+    except BatchRolledBack as e:
+        v.changed()
+        v.auth.clear()
+        error = "Rolled back with the rest of the batch: "+str(e)
+        return [result if result is not None and not result['ok']
+                else {'ok': False, 'error': error} for result in results]
+    #methods bumped the generation and invalidated v.auth before the commit,
+    #   a read in between may have cached what was there before
+    v.changed()
+    v.auth.clear()
+    #queued after the commit so the jobs see what the batch wrote
+    for i, method, args in queued:
+        try:
+            results[i] = {'ok': True, 'job': jobs().submit(method, args)}
+        except Exception as e:
+            results[i] = {'ok': False, 'error': str(e)}
+    return results
+
+def _runOperations(v, operations, jobs, results, queued):
+    """
+    Fills in results for the database operations
+    and lists the vagrant ones in queued
+    """
+    conn = v.pool.connection()
+    with v.pool.transaction(), v.strict():
+        for i, operation in enumerate(operations):
+            try:
+                method, args = parseOperation(operation)
+            except ValueError as e:
+                results[i] = {'ok': False, 'error': str(e)}
+                continue
+            if method in BATCH_JOBS:
+                if jobs is None:
+                    results[i] = {'ok': False,
+                                  'error': method+" runs vagrant and cannot be batched"}
+                else:
+                    queued.append((i, method, args))
+                continue
+            if method not in BATCH_METHODS:
+                results[i] = {'ok': False, 'error': method+" cannot be batched"}
+                continue
+            try:
+                with v.pool.transaction():
+                    result = getattr(v, method)(*args)
+                    #some methods return the error they caught
+                    if isinstance(result, Exception):
+                        raise result
+                results[i] = {'ok': True, 'result': result}
+            except Exception as e:
+                if not conn.in_transaction:
+                    raise BatchRolledBack(method+": "+str(e))
+                results[i] = {'ok': False, 'error': str(e)}
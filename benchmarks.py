@@ -0,0 +1,463 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for vagrant_API.py, the command router and web_API.py
+
+    python3 benchmarks.py --output results.json
+    python3 benchmarks.py --output new.json --compare results.json
+"""
+__author__ = "Simon Rosner"
+__credits__ = ["Simon Rosner"]
+__version__ = "2026.10.18"
+__maintainer__ = "Simon Rosner"
+__email__ = ""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import re
+import time
+from vagrant_API import *
+import bot_commands
+import engine
+from blocklist import BlockMatcher
+
+SERVICE = "testChat"
+BOX = "ubuntu/trusty32"
+
+def legacyQueryDB(db, query, quargs):
+    """
+    queryDB as it was before pooling:
+    a new autocommit connection for every statement
+    """
+    connection = sqlite3.connect(db,isolation_level=None)
+    c = connection.cursor()
+    out = None
+    try:
+        c.execute(query,quargs)
+        out = c.fetchall()
+    except Exception as e:
+        out = str(e)
+    c.close
+    return out
+
+def legacyCopy(db):
+    """
+    Copy of db for the legacy side of a comparison.
+    Made before V_API opens db, which switches the file to WAL,
+    so the copy keeps the rollback journal sqlite used before pooling
+    """
+    legacy = db + ".legacy"
+    shutil.copy2(db, legacy)
+    return legacy
+
+def benchQueryDB(db, n=2000):
+    """
+    Latency of reads and writes,
+    before and after connection pooling.
+    Requires a database never opened by V_API
+    """
+    legacy = legacyCopy(db)
+    v = V_API(SERVICE, db, BOX)
+    read = "Select name, ID From Users Where worksHere = 1"
+    write = "Insert into Events(description, timestamp) Values(?,?)"
+    results = {}
+    results['legacy read'] = latency(lambda i: legacyQueryDB(legacy, read, []), n)
+    results['pooled read'] = latency(lambda i: v.queryDB(read, []), n)
+    #writes are far slower in the legacy journal mode so run fewer
+    results['legacy write'] = latency(
+        lambda i: legacyQueryDB(legacy, write, ['bench', i]), n // 10)
+    results['pooled write'] = latency(
+        lambda i: v.queryDB(write, ['bench', i]), n // 10)
+    v.close()
+    os.remove(legacy)
+    return results
+
+def legacyLogEvent(db, description, actors):
+    """
+    logEvent as it was before batching:
+    insert, look the row back up, then one insert per actor
+    """
+    eventInsert = "Insert into Events(description, timestamp) "
+    eventInsert+= "Values(?,?)"
+    theNow = str(round(time.time(),2))
+    eventArgs = [str(description), theNow]
+    legacyQueryDB(db, eventInsert, eventArgs)
+    getID = "Select Events.ID from Events "
+    getID+= "Where Events.description like ? "
+    getID+= "And Events.timestamp = ?"
+    eventID = legacyQueryDB(db, getID, eventArgs)[0][0]
+    for actor in actors:
+        addActor = "Insert into Actors(eventID, actorID) "
+        addActor+= "Values(?,?)"
+        legacyQueryDB(db, addActor, [eventID, actor])
+
+def benchLogEvent(db, n=500):
+    """
+    Latency of logging an event, before and after write-behind batching.
+    Requires a database never opened by V_API
+    """
+    legacy = legacyCopy(db)
+    v = V_API(SERVICE, db, BOX)
+    results = {}
+    results['legacy log'] = latency(
+        lambda i: legacyLogEvent(legacy, 'bench'+str(i), [0]), n)
+    results['batched log'] = latency(
+        lambda i: v.logEvent('bench'+str(i), [0]), n)
+    v.close()
+    os.remove(legacy)
+    return results
+
+#commands as typed in chat, used to time dispatch
+COMMAND_CORPUS = ["build new vm",
+                  "Build new VM please",
+                  "list vms",
+                  "list users",
+                  "What is my ID?",
+                  "help",
+                  "help claim",
+                  "help admin",
+                  "claim vm nyc-vm-d31",
+                  "claim user with vm test-vm-02",
+                  "get ID for user Simon Rosner",
+                  "get id of vm nyc-cbmweb-d31",
+                  "guess id for Sim",
+                  "provision vm 31",
+                  "rebuild vm 31",
+                  "status of job 12",
+                  "Does I own 31",
+                  "is Simon Rosner an admin?",
+                  "am I an admin",
+                  "get logs since yesterday",
+                  "vagrant global-status",
+                  "server uptime",
+                  "remove vm 80",
+                  "make 74 an admin",
+                  "what time is it"]
+
+#handle_command's if/elif chain before the router, in order
+LEGACY_PATTERNS = [r'block command: (.*)',
+                   r'(are|am) I (an admin|admin).*',
+                   r'is (.*) an admin.*',
+                   r'build new.*',
+                   r'claim user (.*)',
+                   r'claim user with vm (.*)',
+                   r'claim vm (.*)',
+                   r'clean.*',
+                   r'register.*',
+                   r'(remove|delete|nuke) vm (.*)',
+                   r'.*id (of|for) user (.*)',
+                   r'.*id (of|for) vm (.*)',
+                   r'.*logs since (.*)',
+                   r'what is my id.*',
+                   r'.*guess id (of|for) (.*)',
+                   'help',
+                   r'list users',
+                   r'list (vms|virtual machines)',
+                   r'make (.*) an admin.*',
+                   r'provision vm (.*)',
+                   r'(reactivate|reinstate|revive) user (.*)',
+                   r'rebuild (vm|virtual machine) (.*)',
+                   r'(status|state) (of )?job (\d+)',
+                   r'(deactivate|delete|remove) user (.*)',
+                   'server',
+                   'vagrant',
+                   r'(Does|Do) (.*) (own|have|use|control) (.*)']
+
+def legacyDispatch(command):
+    """
+    Test each pattern in turn, then match again for the groups
+    """
+    for pattern in LEGACY_PATTERNS:
+        if pattern in ('help', 'server', 'vagrant'):
+            if command.lower().startswith(pattern):
+                return pattern
+        elif re.match(pattern, command, re.I) is not None:
+            re.match(pattern, command, re.I).groups()
+            return pattern
+    return None
+
+def benchDispatch(rounds=2000):
+    """
+    Latency of routing a command, before and after the router
+    """
+    router = bot_commands.router
+    n = rounds * len(COMMAND_CORPUS)
+    results = {}
+    results['legacy dispatch'] = latency(
+        lambda i: legacyDispatch(COMMAND_CORPUS[i % len(COMMAND_CORPUS)]), n)
+    results['router dispatch'] = latency(
+        lambda i: router.dispatch(COMMAND_CORPUS[i % len(COMMAND_CORPUS)]), n)
+    return results
+
+def legacySecurityCheck(blocked, args):
+    """
+    securityCheck before BlockMatcher:
+    every token looked up in a list
+    """
+    command = args.split(" ")
+    for c in command:
+        if c.lower() in blocked or args.lower() in blocked:
+            return False
+    return True
+
+def benchSecurityCheck(rounds=200, entries=5000, tokens=200, seed=1):
+    """
+    Latency of checking a long server/vagrant command
+    against a large blocklist, before and after BlockMatcher,
+    and to build the matcher and add one phrase to it.
+    Half the entries are phrases, which the old check only
+    caught when they were the whole command
+    """
+    rng = random.Random(seed)
+    blocked = []
+    for i in range(entries):
+        if i % 2 == 0:
+            blocked.append("blockedword"+str(i))
+        else:
+            blocked.append("blocked "+str(i)+" phrase")
+    words = ["vagrant", "ssh", "-c", "sudo", "ls", "-la", "/var/log", "cat", "&&",
+             "grep", "error", "blocked", "phrase", "1", "2", "3", "tail", "-n", "100"]
+    commands = [" ".join(rng.choice(words) for t in range(tokens)) for c in range(20)]
+    legacy = [b.lower() for b in blocked]
+    matchers = []
+    results = {}
+    results['matcher build'] = latency(
+        lambda i: matchers.append(BlockMatcher(blocked)), 1)
+    matcher = matchers[0]
+    n = rounds * len(commands)
+    results['legacy securityCheck'] = latency(
+        lambda i: legacySecurityCheck(legacy, commands[i % len(commands)]), n)
+    results['matcher securityCheck'] = latency(
+        lambda i: matcher.match(commands[i % len(commands)]), n)
+    results['matcher add phrase'] = latency(
+        lambda i: matcher.add("one more phrase "+str(i)), rounds)
+    return results
+
+def makeSyntheticDB(path, users=5000, vms=10000, events=1000000, seed=1):
+    """
+    Copies testDBBackup.db to path and adds
+    users (each with a chat account), VMs owned by them
+    and events spread over the last year, in time order.
+    The same seed always gives the same database
+    """
+    shutil.copy2("testDBBackup.db", path)
+    rnd = random.Random(seed)
+    now = time.time()
+    connection = sqlite3.connect(path)
+    c = connection.cursor()
+    c.execute("PRAGMA journal_mode = WAL")
+    c.execute("PRAGMA synchronous = OFF")
+    firstUser = c.execute("Select max(ID) from Users").fetchone()[0] + 1
+    userIDs = range(firstUser, firstUser + users)
+    c.executemany("Insert into Users(ID, name, isAdmin, worksHere) Values(?,?,?,?)",
+                  ([uid, "Bench User "+str(uid), int(uid % 100 == 0), int(uid % 20 != 0)]
+                   for uid in userIDs))
+    c.executemany("Insert into ThirdPartyAccount(userID, username, serviceID, service) "
+                  "Values(?,?,?,?)",
+                  ([uid, "bench"+str(uid), benchServiceID(uid), SERVICE]
+                   for uid in userIDs))
+    c.executemany("Insert into VM(hostname, ownerID, initDate, lastBuildDate, active, box) "
+                  "Values(?,?,?,?,?,?)",
+                  (["bench-vm-"+str(i), rnd.choice(userIDs), now, now,
+                    int(rnd.random() > 0.1), BOX] for i in range(vms)))
+    methods = ["adminCheckThroughService", "getUserID", "listVMs",
+               "buildThroughService", "claimVM", "getIDbyName"]
+    start = now - 365 * 86400
+    step = (now - start) / max(events, 1)
+    c.execute("Select max(ID) from Events")
+    firstEvent = (c.fetchone()[0] or 0) + 1
+    c.executemany("Insert into Events(ID, description, timestamp) Values(?,?,?)",
+                  ([firstEvent + i,
+                    rnd.choice(methods)+"('bench"+str(i % users)+"',)",
+                    round(start + i * step, 2)] for i in range(events)))
+    c.executemany("Insert into Actors(eventID, actorID) Values(?,?)",
+                  ([firstEvent + i, 0] for i in range(events)))
+    connection.commit()
+    connection.close()
+
+def benchServiceID(uid):
+    return "UB%06d" % uid
+
+def latency(func, n):
+    """
+    Calls func n times and returns
+    calls per second and latency percentiles in microseconds
+    """
+    times = []
+    for i in range(n):
+        start = time.perf_counter()
+        func(i)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    def percentile(p):
+        return round(times[min(len(times) - 1, int(len(times) * p))] * 1e6, 1)
+    return {'ops_per_sec': round(n / sum(times), 1),
+            'mean_usec': round(sum(times) / n * 1e6, 1),
+            'p50_usec': percentile(0.50),
+            'p95_usec': percentile(0.95),
+            'p99_usec': percentile(0.99)}
+
+def benchAPI(db, n=1000):
+    """
+    Latency of the V_API calls every chat command makes
+    """
+    v = V_API(SERVICE, db, BOX)
+    users = v.queryDB("Select userID from ThirdPartyAccount Where service = ?",
+                      [SERVICE])
+    serviceIDs = [benchServiceID(row[0]) for row in users]
+    recent = time.time() - 3600
+    results = {}
+    results['queryDB'] = latency(
+        lambda i: v.queryDB("Select name From Users Where ID = ?", [i]), n)
+    results['logEvent'] = latency(lambda i: v.logEvent('bench'+str(i), [0]), n)
+    results['adminCheckThroughService'] = latency(
+        lambda i: v.adminCheckThroughService(serviceIDs[i % len(serviceIDs)]), n)
+    results['listVMs'] = latency(lambda i: v.listVMs(), max(n // 100, 5))
+    results['listVMs withState'] = latency(lambda i: v.listVMs(True), max(n // 100, 5))
+    results['getLogsSince last hour'] = latency(lambda i: v.getLogsSince(recent), n // 10)
+    results['getLogsSince by method'] = latency(
+        lambda i: v.getLogsSince(recent - 30 * 86400, method='listVMs'), n // 10)
+    v.close()
+    return results
+
+#commands which only read, safe to run over and over
+READ_COMMANDS = ["list users",
+                 "What is my ID?",
+                 "help",
+                 "help claim",
+                 "get ID for user Simon Rosner",
+                 "guess id for Sim",
+                 "is Simon Rosner an admin?",
+                 "am I an admin",
+                 "what time is it"]
+
+def benchCommands(db, n=2000):
+    """
+    Latency of handle_command without the chat service:
+    the security check, routing and the handler itself
+    """
+    v = V_API(SERVICE, db, BOX)
+    event = {"user": benchServiceID(1000), "channel": "bench", "ts": "0"}
+    def handle(i):
+        command = READ_COMMANDS[i % len(READ_COMMANDS)]
+        if not v.securityCheck(command):
+            return
+        ctx = bot_commands.CommandContext(v, event,
+                                          lambda: v.adminCheckThroughService(event["user"]),
+                                          lambda uid: uid, None)
+        route, match = bot_commands.router.dispatch(command)
+        if route is not None:
+            route.handler(ctx, match)
+    results = {'handle_command': latency(handle, n)}
+    v.close()
+    return results
+
+def benchWeb(db, n=500):
+    """
+    Latency of web_API.py routes through the Flask test client
+    """
+    import web_API
+    engine.startup(SERVICE, db, BOX)
+    client = web_API.app.test_client()
+    recent = str(time.time() - 3600)
+    results = {}
+    try:
+        results['GET /adminCheckThroughService/'] = latency(
+            lambda i: client.get('/adminCheckThroughService/?serviceID='
+                                 +benchServiceID(1000 + i % 100)), n)
+        results['GET /listUsers/'] = latency(lambda i: client.get('/listUsers/'),
+                                             max(n // 50, 5))
+        results['GET /listVMs/'] = latency(lambda i: client.get('/listVMs/'),
+                                           max(n // 50, 5))
+        results['POST /getLogsSince/'] = latency(
+            lambda i: client.post('/getLogsSince/?time='+recent), n // 5)
+    finally:
+        engine.shutdown()
+    return results
+
+def gitCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except Exception:
+        return None
+
+def compare(old, new):
+    """
+    Prints the change in mean latency of every benchmark in both runs
+    """
+    print("%-34s %12s %12s %8s" % ("benchmark", "old usec", "new usec", "change"))
+    for group, benches in new['results'].items():
+        for name, stats in benches.items():
+            before = old['results'].get(group, {}).get(name)
+            #runs from before every group used latency() hold bare numbers
+            if not isinstance(before, dict):
+                continue
+            change = (stats['mean_usec'] - before['mean_usec']) / before['mean_usec'] * 100
+            print("%-34s %12.1f %12.1f %+7.1f%%" % (name, before['mean_usec'],
+                                                   stats['mean_usec'], change))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for VMbot")
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--vms', type=int, default=10000)
+    parser.add_argument('--events', type=int, default=1000000)
+    parser.add_argument('--rounds', type=int, default=1000,
+                        help="calls per benchmark, fewer for slow ones")
+    parser.add_argument('--quick', action='store_true',
+                        help="small database and few rounds, for a smoke test")
+    parser.add_argument('--output', help="write results to this JSON file")
+    parser.add_argument('--compare', help="JSON file from an earlier run")
+    args = parser.parse_args()
+    if args.quick:
+        args.users, args.vms, args.events, args.rounds = 200, 400, 20000, 100
+    workDir = tempfile.mkdtemp()
+    try:
+        db = os.path.join(workDir, "benchDB.db")
+        start = time.time()
+        makeSyntheticDB(db, args.users, args.vms, args.events)
+        print("synthetic database built in %.1fs" % (time.time() - start))
+        results = {}
+        results['api'] = benchAPI(db, args.rounds)
+        results['commands'] = benchCommands(db, args.rounds)
+        results['web'] = benchWeb(db, args.rounds)
+        #before and after comparisons for earlier changes
+        #each gets a fresh copy, V_API leaves a file in WAL mode
+        queryDB = os.path.join(workDir, "queryDB.db")
+        logDB = os.path.join(workDir, "logDB.db")
+        shutil.copy2("testDBBackup.db", queryDB)
+        shutil.copy2("testDBBackup.db", logDB)
+        results['legacy'] = {}
+        results['legacy'].update(benchQueryDB(queryDB, args.rounds))
+        results['legacy'].update(benchLogEvent(logDB, args.rounds // 4))
+        results['legacy'].update(benchDispatch(args.rounds))
+        results['legacy'].update(benchSecurityCheck(max(1, args.rounds // 5)))
+    finally:
+        shutil.rmtree(workDir)
+    for group, benches in results.items():
+        for name, stats in benches.items():
+            print("%-34s %10.1f usec mean %10.1f usec p95" % (
+                name, stats['mean_usec'], stats['p95_usec']))
+    run = {'commit': gitCommit(),
+           'time': round(time.time(),2),
+           'python': platform.python_version(),
+           'sqlite': sqlite3.sqlite_version,
+           'size': {'users': args.users, 'vms': args.vms, 'events': args.events},
+           'rounds': args.rounds,
+           'results': results}
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(run, f, indent=2, sort_keys=True)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(json.load(f), run)
+
+if __name__ == "__main__":
+    main()
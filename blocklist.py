@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+Finds blocked commands and phrases in a command, see V_API.securityCheck
+"""
+__author__ = "Simon Rosner"
+__credits__ = ["Simon Rosner"]
+__version__ = "2026.10.18"
+__maintainer__ = "Simon Rosner"
+__email__ = ""
+
+import re
+import threading
+
+#runs of shell operators are tokens of their own
+#   so "ls;rm -rf /" is ls ; rm -rf /
+_TOKEN = re.compile(r'[;&|()<>`]+|[^\s;&|()<>`]+')
+
+def tokenize(text):
+    """
+    Case folded tokens of a command or blocked entry
+    """
+    return _TOKEN.findall(text.casefold())
+
+class BlockMatcher:
+    def __init__(self, entries=()):
+        """
+        Matches commands against blocked entries.
+        One word entries are kept in a set,
+        entries of several words in an Aho-Corasick automaton
+        over tokens, so every entry is checked in one pass.
+        The automaton is built once here and grown in place by add
+        """
+        self.entries = []   #every entry, as added
+        self._words = set()
+        self._phrases = {}  #token tuple -> entry
+        #one slot per state of the automaton, state 0 is the root
+        self._goto = [{}]   #token -> next state
+        self._fail = [0]    #state of the longest proper suffix in the trie
+        self._found = [None]    #an entry ending at the state or a suffix of it
+        self._own = [None]  #the entry ending exactly at the state
+        self._depth = [0]
+        self._failedBy = [set()]    #states whose fail is this state
+        self._byToken = {}  #token -> states entered through it
+        self._lock = threading.Lock()
+        phrases = []
+        for entry in entries:
+            tokens = self._remember(entry)
+            if tokens is not None:
+                phrases.append(tokens)
+        for tokens in phrases:
+            self._insert(tokens)
+        self._link()
+
+    def _remember(self, entry):
+        """
+        Records an entry in entries and the word set.
+        Returns its tokens if it is a new phrase, else None
+        """
+        if isinstance(entry, bytes):
+            entry = entry.decode('utf-8', 'replace')
+        entry = str(entry).casefold()
+        tokens = tuple(tokenize(entry))
+        if len(tokens) == 0:
+            return None
+        self.entries.append(entry)
+        if len(tokens) == 1:
+            self._words.add(tokens[0])
+            return None
+        if tokens in self._phrases:
+            return None
+        self._phrases[tokens] = entry
+        return tokens
+
+    def add(self, entry):
+        """
+        Blocks entry from now on.
+        A word is added to the set,
+        a phrase is inserted into the automaton and only
+        the failure links it changes are updated.
+        A match running at the same time may miss the new entry
+        """
+        with self._lock:
+            tokens = self._remember(entry)
+            if tokens is not None:
+                created = self._insert(tokens)
+                self._relink(tokens, created)
+
+    def _newState(self, token, depth):
+        self._byToken.setdefault(token, []).append(len(self._goto))
+        self._goto.append({})
+        self._fail.append(0)
+        self._found.append(None)
+        self._own.append(None)
+        self._depth.append(depth)
+        self._failedBy.append(set())
+        return len(self._goto) - 1
+
+    def _insert(self, tokens):
+        """
+        Adds a phrase to the trie, without failure links.
+        Returns the states it created as (parent, token, state), shallowest first
+        """
+        created = []
+        state = 0
+        for token in tokens:
+            nextState = self._goto[state].get(token)
+            if nextState is None:
+                nextState = self._newState(token, self._depth[state] + 1)
+                #linked last so a running match never reaches a half made state
+                self._goto[state][token] = nextState
+                created.append((state, token, nextState))
+            state = nextState
+        self._own[state] = self._phrases[tokens]
+        return created
+
+    def _failFor(self, parent, token):
+        """
+        Failure link for the child of parent through token
+        """
+        if parent == 0:
+            return 0
+        f = self._fail[parent]
+        while f and token not in self._goto[f]:
+            f = self._fail[f]
+        return self._goto[f].get(token, 0)
+
+    def _setFail(self, state, f):
+        self._failedBy[self._fail[state]].discard(state)
+        self._fail[state] = f
+        self._failedBy[f].add(state)
+
+    def _link(self):
+        """
+        Failure links and found for the whole trie, breadth first
+        """
+        queue = [(0, token, child) for token, child in self._goto[0].items()]
+        for parent, token, state in queue:
+            self._setFail(state, self._failFor(parent, token))
+            self._found[state] = self._own[state] or self._found[self._fail[state]]
+            queue.extend((state, t, child) for t, child in self._goto[state].items())
+
+    def _relink(self, tokens, created):
+        """
+        Links the states one phrase created and re-points
+        the old states whose longest suffix is now a new state
+        """
+        new = set(state for parent, token, state in created)
+        for parent, token, state in created:
+            self._setFail(state, self._failFor(parent, token))
+            self._found[state] = self._own[state] or self._found[self._fail[state]]
+            if parent == 0:
+                #a first word not seen before, old states
+                #   entered through it may have failed to the root
+                for child in self._byToken[token]:
+                    if child not in new and self._fail[child] == 0:
+                        self._setFail(child, state)
+                        self._spread(child, self._found[state])
+                continue
+            #an old state ending in this one's words is a child through token
+            #   of a state whose suffixes include the parent
+            depth = self._depth[state]
+            stack = list(self._failedBy[parent])
+            while len(stack) > 0:
+                w = stack.pop()
+                child = self._goto[w].get(token)
+                if child is None:
+                    stack.extend(self._failedBy[w])
+                    continue
+                #below w every such child already has a longer suffix than state
+                if child not in new and self._depth[self._fail[child]] < depth:
+                    self._setFail(child, state)
+                    self._spread(child, self._found[state])
+        state = 0
+        for token in tokens:
+            state = self._goto[state][token]
+        self._spread(state, self._own[state])
+
+    def _spread(self, state, entry):
+        """
+        Gives entry to state and every state failing to it
+        which has no entry found yet
+        """
+        if entry is None:
+            return
+        stack = [state]
+        while len(stack) > 0:
+            s = stack.pop()
+            if self._found[s] is None:
+                self._found[s] = entry
+            for kid in self._failedBy[s]:
+                if self._found[kid] is None:
+                    stack.append(kid)
+
+    def match(self, command):
+        """
+        The first blocked entry found in command, or None
+        """
+        tokens = tokenize(command)
+        words = self._words
+        for token in tokens:
+            if token in words:
+                return token
+        goto = self._goto
+        if len(goto[0]) == 0:
+            return None
+        fail = self._fail
+        found = self._found
+        state = 0
+        for token in tokens:
+            while state and token not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(token, 0)
+            if found[state] is not None:
+                return found[state]
+        return None
@@ -0,0 +1,571 @@
+#!/usr/bin/env python3
+"""
+Commands understood by VMbot.py
+Each command is a pattern, a handler and its help text
+"""
+__author__ = "Simon Rosner"
+__credits__ = ["Simon Rosner"]
+__version__ = "2026.10.18"
+__maintainer__ = "Simon Rosner"
+__email__ = ""
+
+import json
+import re
+import time
+import constants
+import metrics
+from router import Router
+
+MAX_VM_PER_USER = constants.MAX_VM_PER_USER
+notAdmin = "Only admins can do that."
+#optional filters for logs since
+LOG_FILTER = re.compile(r'\s+(method|actor|after|limit)\s+(\S+)', re.IGNORECASE)
+
+router = Router()
+
+class CommandContext:
+    def __init__(self, v, event, isAdmin, userName, jobs, warmPool=None):
+        """
+        Everything a command handler may need:
+        the V_API,
+        the chat event the command came from,
+        whether the sender is an admin, or a function answering that
+        which is only called if a command asks,
+        a function returning a chat user's real name,
+        a function returning the JobQueue
+        and optionally a function returning the WarmPool
+        """
+        self.v = v
+        self.event = event
+        self._isAdmin = isAdmin
+        self.userName = userName
+        self.jobs = jobs
+        self.warmPool = warmPool
+
+    @property
+    def isAdmin(self):
+        if callable(self._isAdmin):
+            self._isAdmin = self._isAdmin() == True
+        return self._isAdmin
+
+def is_number(s):
+    try:
+        float(s)
+        return True
+    except ValueError:
+        return False
+
+def vm_id(v, vm):
+    """
+    VM id from an id or hostname
+    """
+    if is_number(vm):
+        return vm
+    return v.getIDbyHostname(vm)[0][1]
+
+def user_id(v, user):
+    """
+    User id from an id or name
+    """
+    if is_number(user):
+        return user
+    return v.getIDbyName(user)[0][1]
+
+def queue_job(ctx, method, args):
+    """
+    Queue a long running V_API method.
+    The result is posted to the event's thread when it ends
+    """
+    return ctx.jobs().submit(method, args,
+                             requester=ctx.event["user"],
+                             channel=ctx.event["channel"],
+                             thread=ctx.event["ts"])
+
+def describe_job(job):
+    """
+    Readable summary of a job dict from jobs.py
+    """
+    text = "Job "+str(job['ID'])+" ("+job['method']+") is *"+job['status']+"*"
+    if job.get('stage') is not None:
+        text+= "\n_"+job['stage']+"_"
+    if job['method'] == 'cleanVMs' and job['status'] == 'done':
+        text+= "\n"+describe_clean(json.loads(job['result']))
+        text+= "\nTo remove them from the database, run the *delete* command"
+    elif job['result'] is not None:
+        text+= "\n"+str(job['result'])
+    return text
+
+def describe_clean(summary):
+    """
+    Readable summary of V_API.cleanVMs
+    """
+    if summary is None:
+        return "Clean failed, see the event log"
+    text = "Destroyed "+str(summary['destroyed'])+" inactive VMs"
+    if summary['failed'] > 0:
+        text+= ", "+str(summary['failed'])+" failed"
+    text+= " in "+str(summary['seconds'])+"s"
+    for r in summary['results']:
+        state = "destroyed" if r['ok'] else "*failed*"
+        text+= "\n"+str(r['ID'])+" "+str(r['hostname'])+": "+state
+    if not summary['pruned']:
+        text+= "\nvagrant global-status --prune failed"
+    return text
+
+def describe_metrics(registry, top=5):
+    """
+    Readable summary of a metrics.Registry:
+    calls, errors and mean time per V_API method,
+    time per vagrant verb and the slowest statements
+    """
+    def mean(count, total):
+        return str(round(total / count * 1000, 1))+"ms" if count > 0 else "-"
+    errors = dict((dict(k).get('method'), n) for k, n
+                  in registry.counter('vmbot_method_errors_total').items())
+    methods = sorted(((dict(k)['method'], n, total) for k, (n, total)
+                      in registry.histogram('vmbot_method_seconds').items()),
+                     key=lambda m: -m[2])
+    text = "*Methods* (calls, errors, mean)"
+    for name, n, total in methods:
+        text+= "\n"+name+": "+str(n)+", "+str(errors.get(name, 0))+", "+mean(n, total)
+    failures = dict((dict(k).get('verb'), n) for k, n
+                    in registry.counter('vmbot_vagrant_failures_total').items())
+    verbs = registry.histogram('vmbot_vagrant_seconds')
+    if len(verbs) > 0:
+        text+= "\n*vagrant* (runs, failures, mean)"
+        for key, (n, total) in sorted(verbs.items()):
+            verb = dict(key)['verb']
+            text+= "\n"+verb+": "+str(n)+", "+str(failures.get(verb, 0))+", "+mean(n, total)
+    statements = sorted(registry.histogram('vmbot_db_seconds').items(),
+                        key=lambda s: -s[1][1])[:top]
+    if len(statements) > 0:
+        text+= "\n*Database* (statements, mean), most time first"
+        for key, (n, total) in statements:
+            text+= "\n"+dict(key)['statement']+": "+str(n)+", "+mean(n, total)
+    return text
+
+def helpWith(com = None):
+    """
+    Return helptext for various commands
+    """
+    return router.helpWith(com)
+
+#Routes are tried in the order they appear in this file
+
+#addBlockedCommand
+@router.route(r'block command: (.*)', name='block',
+              usage="Block command: [command]",
+              description="Add a command to the list of blocked commands",
+              adminOnly=True)
+def blockCommand(ctx, match):
+    if ctx.isAdmin:
+        try:
+            blockCom = match.group(1)
+            ctx.v.addBlockedCommand(blockCom)
+            return blockCom + " has been permanently blocked"
+        except Exception as e:
+            return "Something went wrong: "+str(e)
+    return notAdmin
+
+#adminCheck
+@router.route(r'(are|am) I (an admin|admin).*')
+def amIAdmin(ctx, match):
+    if ctx.isAdmin:
+        return "You are an admin"
+    return "You are not an admin"
+
+@router.route(r'is (.*) an admin.*', name='is admin',
+              usage="Is [user] an admin?",
+              description="Checks if a specified user is an admin")
+def isUserAdmin(ctx, match):
+    userInQuestion = match.group(1)
+    try:
+        userIqId = user_id(ctx.v, userInQuestion)
+    except Exception as e:
+        return "Something went wrong: "+str(e)
+    if ctx.v.adminCheck(userIqId) == True:
+        return userInQuestion + " is an admin"
+    return userInQuestion + " is not an admin"
+
+#archive
+@router.route(r'archive (logs|events)\b.*', name='archive',
+              usage="Archive logs",
+              description="Moves events older than the retention window out of the database. \
+Get logs since still finds them",
+              adminOnly=True)
+def archiveLogs(ctx, match):
+    if ctx.isAdmin:
+        jobID = queue_job(ctx, 'archiveEvents', [])
+        return "Archiving old events as job "+str(jobID)+"..."
+    return notAdmin
+
+#build
+@router.route(r'build new.*', name='build',
+              usage="Build new VM",
+              description="Creates a new virtual machine assigned to the current user")
+def buildNew(ctx, match):
+    vmCount = ctx.v.getUserVMCount(ctx.event["user"])
+    tempResponse = "You have "+str(vmCount)+" virtual machines already assigned to you.\n"
+    tempResponse+= "The maximum per user is: "+str(MAX_VM_PER_USER)+"\n"
+    if vmCount > MAX_VM_PER_USER:
+        tempResponse+= "Another virtual machine cannot be built at this time.\n"
+        return tempResponse
+    #a ready VM from the warm pool is instant
+    userID = ctx.v.getUserID(ctx.event["user"])
+    if ctx.warmPool is not None and userID is not None:
+        VMid = ctx.warmPool().claim(userID)
+        if VMid is not None:
+            tempResponse+= "Virtual machine "+str(VMid)+" is ready for you."
+            return tempResponse
+    try:
+        jobID = queue_job(ctx, 'buildThroughService', [ctx.event["user"]])
+        tempResponse += "Building virtual machine as job "+str(jobID)+"..."
+        return tempResponse
+    except Exception as e:
+        return "Something went wrong: "+str(e)
+
+#claim by VM
+#   must come before claim user, which would also match
+@router.route(r'claim user with vm (.*)', name='claim user with vm',
+              usage="Claim user with VM [vm]",
+              description="Pairs current service account to VMbot account which owns the specified virtual machine")
+def claimUserWithVM(ctx, match):
+    targetVMID = vm_id(ctx.v, match.group(1))
+    worked = ctx.v.claimByVM(targetVMID,
+                             ctx.userName(ctx.event["user"]),
+                             ctx.event["user"])
+    if worked is None:
+        return ("You have succesfully claimed VM:" + str(targetVMID)
+                + " and paired your " + ctx.v.service
+                + " account with your VMbot account")
+    return "Something went wrong"
+
+#claim user
+@router.route(r'claim user (with id )?(.*)', name='claim user',
+              usage="Claim user [user]",
+              description="Pairs current service (slack,hipchat,etc) account to a VMbot account")
+def claimUser(ctx, match):
+    targetUserID = user_id(ctx.v, match.group(2))
+    worked = ctx.v.claimUser(targetUserID,
+                             ctx.userName(ctx.event["user"]),
+                             ctx.event["user"])
+    if worked is None:
+        return ("You have succesfully paired your " + ctx.v.service
+                + " account with your VMbot account")
+    return "Something went wrong"
+
+#claim VM
+@router.route(r'claim vm (.*)', name='claim vm',
+              usage="Claim VM [vm]",
+              description="Changes virtual machine so that it is owned by current user")
+def claimVM(ctx, match):
+    targetVMID = vm_id(ctx.v, match.group(1))
+    worked = ctx.v.claimVM(targetVMID,
+                           ctx.v.getUserID(ctx.event['user']))
+    if worked is None:
+        return "You have succesfully claimed VM:" + str(targetVMID)
+    return "Something went wrong"
+
+#clean
+@router.route(r'clean\b.*', name='clean',
+              usage="Clean",
+              description="Deactivates virtual machines owned by innactive users. Prunes vagrant global-list",
+              adminOnly=True)
+def clean(ctx, match):
+    if ctx.isAdmin:
+        #destroying every inactive VM can take hours
+        jobID = queue_job(ctx, 'cleanVMs', [])
+        return "Cleaning inactive VMs as job "+str(jobID)+"..."
+    return notAdmin
+
+#createUser
+@router.route(r'register\b.*', name='register',
+              usage="Register",
+              description="Creates a new VMbot account and pairs the current service user account to it")
+def register(ctx, match):
+    v = ctx.v
+    if v.getUserID(ctx.event["user"]) is None:
+        v.createServiceUser(ctx.userName(ctx.event["user"]),
+                            v.createUser(ctx.event["user"]),
+                            ctx.event["user"])
+        return None
+    return "This "+v.service+" account is already registered"
+
+#delete/remove
+@router.route(r'(remove|delete|nuke) vm (.*)', name='delete',
+              usage="Delete|Remove|Nuke VM [vm]",
+              description="Destroy a virtual machine and remove it's record from the database. Do not use this unless absolutely nescessary",
+              adminOnly=True)
+def deleteVM(ctx, match):
+    if ctx.isAdmin:
+        target = vm_id(ctx.v, match.group(2))
+        jobID = queue_job(ctx, 'deleteVM', [target])
+        return "Deleting virtual machine as job "+str(jobID)+"..."
+    return notAdmin
+
+#drift
+@router.route(r'drift\b.*', name='drift',
+              usage="Drift",
+              description="Lists virtual machines whose records disagree with vagrant",
+              adminOnly=True)
+def drift(ctx, match):
+    if ctx.isAdmin:
+        problems = ctx.v.findDrift()
+        if len(problems) == 0:
+            return "Every virtual machine matches vagrant"
+        response = ""
+        for VMid, hostname, problem in problems:
+            response+= str(VMid)+" *"+str(hostname)+"*: "+problem+"\n"
+        return response
+    return notAdmin
+
+#getIDbyName
+@router.route(r'.*id (of|for) user (.*)', name='get user id',
+              usage="Get ID for user [user]",
+              description="Get VMbot id for specified user")
+def getIDbyName(ctx, match):
+    try:
+        user = ctx.v.getIDbyName(match.group(2))
+        return "ID for "+user[0][0]+" is "+str(user[0][1])
+    except Exception as e:
+        return "Cannot find user. Error: "+str(e)
+
+#getIDbyHostname
+@router.route(r'.*id (of|for) vm (.*)', name='get vm id',
+              usage="Get ID for VM [vm]",
+              description="Get id for specified virtual machine")
+def getIDbyHostname(ctx, match):
+    try:
+        vm = ctx.v.getIDbyHostname(match.group(2))
+        if len(vm) >= 1:
+            return "ID for "+vm[0][0]+" is "+str(vm[0][1])
+        return "Cannot find virtual machine"
+    except Exception as e:
+        return "Cannot find virtual machine. Error: "+str(e)
+
+#getLogsSince
+@router.route(r'.*logs since (.*)', name='logs',
+              usage="Get logs since [time] (method [name]) (actor [id]) (after [event id])",
+              description="Get event logs since specified datetime, a page at a time. \
+Filter by V_API method or by actor, and use after to get the next page",
+              adminOnly=True)
+def getLogsSince(ctx, match):
+    if not ctx.isAdmin:
+        return notAdmin
+    #filters come after the time, ex: yesterday method buildVM after 120
+    filters = {}
+    text = match.group(1)
+    for key, value in LOG_FILTER.findall(text):
+        key = key.lower()
+        if key != 'method' and not value.isdigit():
+            return key+" must be a number"
+        filters[key] = value
+    pointInTime = LOG_FILTER.sub('', text).strip()
+    rows = ctx.v.getLogsSince(pointInTime, **filters)
+    if not isinstance(rows, list):
+        return str(rows)
+    if len(rows) == 0:
+        return "No events since "+pointInTime
+    response = ""
+    for description, timestamp, name, eventID in rows:
+        response+= str(eventID)+" "
+        response+= time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+        response+= " *"+str(name)+"* "+str(description)+"\n"
+    pageSize = min(int(filters.get('limit', constants.LOG_PAGE_SIZE)),
+                   constants.LOG_MAX_PAGE_SIZE)
+    if len(set(row[3] for row in rows)) >= pageSize:
+        response+= "_More: logs since "+pointInTime+" after "+str(rows[-1][3])+"_"
+    return response
+
+#getUserID
+@router.route(r'what is my id.*', name='my id',
+              usage="What is my ID?",
+              description="Get the VMbot account id of the current user")
+def whatIsMyID(ctx, match):
+    yourID = ctx.v.getUserID(ctx.event["user"])
+    if yourID is not None:
+        return "Your ID is "+str(yourID)
+    return "You do not have an ID yet"
+
+#guessIDbyName
+@router.route(r'.*guess id (of|for) (.*)', name='guess user id',
+              usage="Guess ID for [user]",
+              description="Enter a user name. If any names in the system are close, \
+their full name and ID will be returned")
+def guessIDbyName(ctx, match):
+    guesses = ctx.v.guessIDbyName(match.group(2))
+    if len(guesses) >= 1:
+        response = ""
+        for guess in guesses:
+            response += str(guess[0])
+            response +='\t-\t_'
+            response += str(guess[1])
+            response +='_\n'
+        return response
+    return "I need another hint. Try guessing a shorter name"
+
+#help
+@router.route(r'help\b\s*(.*)', name='help',
+              usage="Help [admin|command| ]",
+              description="Get help text for admin commands, commands like [command] or standard commands")
+def helpCommand(ctx, match):
+    if match.group(1) == '':
+        return helpWith()
+    return helpWith(match.group(1))
+
+#listUsers
+@router.route(r'list users', name='list users',
+              usage="List users",
+              description="Lists all active users")
+def listUsers(ctx, match):
+    response = ""
+    for user in ctx.v.listUsers():
+        response += user[0]
+        response +='\t-\t_'
+        response += str(user[1])
+        response +='_\n'
+    return response
+
+#listVMs
+@router.route(r'list (vms|virtual machines)', name='list vms',
+              usage="List virtual machines",
+              description="List all active virtual machines")
+def listVMs(ctx, match):
+    response = ""
+    for vm in ctx.v.listVMs(withState=True):
+        response += "*"
+        response += str(vm[0])
+        response += "*\n\t"
+        response += str(vm[1])
+        response += "\n\t"
+        response += str(vm[2])
+        response += "\n\t"
+        response += str(vm[3] or "unknown")
+        response += '\n'
+    return response
+
+#makeAdmin
+@router.route(r'make (.*) an admin.*', name='make admin',
+              usage="Make [user] admin",
+              description="Grant the specified user full admin powers. This cannot be reversed through bot commands",
+              adminOnly=True)
+def makeAdmin(ctx, match):
+    if ctx.isAdmin:
+        newAdmin = match.group(1)
+        if ctx.v.makeAdmin(ctx.v.getUserID(ctx.event['user']),
+                           user_id(ctx.v, newAdmin)) == True:
+            return newAdmin + " is now an Admin"
+        return "Something went wrong"
+    return notAdmin
+
+#provision
+@router.route(r'provision vm (.*)', name='provision',
+              usage="Provision vm [vm]",
+              description="Rerun Virtual Machine setup without destroying it first. Some data may be destroyed anyway.")
+def provisionVM(ctx, match):
+    vmInQuestion = vm_id(ctx.v, match.group(1))
+    uid = ctx.v.getUserID(ctx.event['user'])
+    if ctx.isAdmin or ctx.v.userOwnsVM(uid,vmInQuestion):
+        jobID = queue_job(ctx, 'provisionVM', [vmInQuestion])
+        return "Provisioning virtual machine as job "+str(jobID)+"..."
+    return notAdmin
+
+#reactivate
+@router.route(r'(reactivate|reinstate|revive) user (.*)', name='reactivate',
+              usage="Reactivate user [user]",
+              description="Marks a removed user as active",
+              adminOnly=True)
+def reactivateUser(ctx, match):
+    if ctx.isAdmin:
+        userInQuestion = match.group(2)
+        if is_number(userInQuestion) == False:
+            userInQuestion = ctx.v.getUserID(userInQuestion)
+        result = ctx.v.reactivateUser(ctx.event['user'],userInQuestion)
+        if result == True:
+            return str(userInQuestion) + " has been reactivated"
+        return "Something went wrong"
+    return notAdmin
+
+#rebuild
+@router.route(r'rebuild (vm|virtual machine) (.*)', name='rebuild',
+              usage="Rebuild vm [vm]",
+              description="Rebuilds the specified virtual machine. Reverts it to it's default state")
+def rebuildVM(ctx, match):
+    vmInQuestion = vm_id(ctx.v, match.group(2))
+    user = ctx.v.getUserID(ctx.event['user'])
+    if ctx.v.userOwnsVM(user,vmInQuestion) == True or ctx.isAdmin:
+        jobID = queue_job(ctx, 'rebuildVM', [vmInQuestion])
+        return "Rebuilding virtual machine as job "+str(jobID)+"..."
+    return "You should not rebuild other users' virtual machines"
+
+#job status
+@router.route(r'(status|state) (of )?job (\d+)', name='job',
+              usage="Status of job [job]",
+              description="Check on a build, rebuild, provision or delete started earlier")
+def jobStatus(ctx, match):
+    jobID = int(match.group(3))
+    job = ctx.jobs().status(jobID)
+    if job is None:
+        return "There is no job "+str(jobID)
+    return describe_job(job)
+
+#removeUser
+@router.route(r'(deactivate|delete|remove) user (.*)', name='deactivate',
+              usage="Remove user [user]",
+              description="Marks a user as innactive. For use when a user leaves the company",
+              adminOnly=True)
+def removeUser(ctx, match):
+    if ctx.isAdmin:
+        userInQuestion = match.group(2)
+        if is_number(userInQuestion) == False:
+            userInQuestion = ctx.v.getUserID(userInQuestion)
+        result = ctx.v.removeUser(ctx.event['user'],userInQuestion)
+        if result == True:
+            return str(userInQuestion) + " has been removed"
+        return "Something went wrong"
+    return notAdmin
+
+#server
+#This command will not work as intended if bot is installed on Windows
+@router.route(r'server (.*)', name='server',
+              usage="server [command]",
+              description="Send a command directly to the server. \
+It is recommended that you execute commands directly on the server instead of through this command",
+              adminOnly=True)
+def server(ctx, match):
+    if ctx.isAdmin:
+        return ctx.v.other(match.group(1))
+    return "Only admins may use vagrant commands."
+
+#stats
+@router.route(r'stats\b.*', name='stats',
+              usage="Stats",
+              description="Calls, errors and time spent per method, vagrant command and query since the bot started",
+              adminOnly=True)
+def stats(ctx, match):
+    if ctx.isAdmin:
+        return describe_metrics(metrics.registry)
+    return notAdmin
+
+#vagrant
+@router.route(r'vagrant\b.*', name='vagrant',
+              usage="vagrant [command]",
+              description="Sends a vagrant command directly to the server. Use with care",
+              adminOnly=True)
+def vagrant(ctx, match):
+    if ctx.isAdmin:
+        return ctx.v.other(match.group(0))
+    return "Only admins may use vagrant commands."
+
+#userOwnsVM
+@router.route(r'(Does|Do) (.*) (own|have|use|control) (.*)', name='does own',
+              usage="Does [user] own [vm]",
+              description="Checks if specified user owns specified virtual machine")
+def userOwnsVM(ctx, match):
+    userInQuestion = match.group(2)
+    if userInQuestion == "I":
+        userInQuestion = ctx.v.getUserID(ctx.event['user'])
+    else:
+        userInQuestion = user_id(ctx.v, userInQuestion)
+    VMinQuestion = vm_id(ctx.v, match.group(4))
+    return str(ctx.v.userOwnsVM(userInQuestion,VMinQuestion))
@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+"""
+unit tests for the helpers used by VMbot.py
+"""
+__author__ = "Simon Rosner"
+__credits__ = ["Simon Rosner"]
+__version__ = "2026.10.18"
+__maintainer__ = "Simon Rosner"
+__email__ = ""
+
+import asyncio
+import json
+import threading
+import time
+import unittest
+import metrics
+from dispatch import CommandDispatcher
+from router import Router, leadingWords
+import bot_commands
+from user_directory import UserDirectory
+from outbox import Outbox, splitText
+from slack_rtm import RTMTransport
+from fake_slack import FakeSlackServer
+
+class TestDispatch(unittest.TestCase):
+    """
+    Test concurrent command dispatch
+    """
+    def test_userOrder(self):
+        """
+        Commands from one user run in order
+        while other users are not held up
+        """
+        seen = []
+        lock = threading.Lock()
+        def handler(user, n):
+            if user == 'slow':
+                time.sleep(0.05)
+            with lock:
+                seen.append((user, n))
+        d = CommandDispatcher(handler, workers=4)
+        for n in range(5):
+            d.submit('slow', 'slow', n)
+            d.submit('fast', 'fast', n)
+        d.close()
+        self.assertEqual([n for u, n in seen if u == 'slow'], list(range(5)))
+        self.assertEqual([n for u, n in seen if u == 'fast'], list(range(5)))
+        #the fast user finished before the slow one
+        self.assertEqual(seen[-1][0], 'slow')
+        self.assertEqual(d.stats()['dispatched'], 10)
+
+    def test_dropWhenFull(self):
+        """
+        Commands beyond the pending limit are dropped and counted
+        """
+        def total(name):
+            return metrics.registry.counter('vmbot_dispatch_total').get(
+                (('counter', name),), 0)
+        before = dict((name, total(name)) for name in ('commands', 'dispatched', 'dropped'))
+        release = threading.Event()
+        d = CommandDispatcher(lambda: release.wait(), workers=1, maxPending=2)
+        self.assertTrue(d.submit('a'))
+        self.assertTrue(d.submit('b'))
+        self.assertFalse(d.submit('c'))
+        release.set()
+        d.close()
+        stats = d.stats()
+        self.assertEqual(stats['commands'], 3)
+        self.assertEqual(stats['dispatched'], 2)
+        self.assertEqual(stats['dropped'], 1)
+        self.assertEqual(stats['pending'], 0)
+        #the counters reach the metrics registry too
+        self.assertEqual(total('commands') - before['commands'], 3)
+        self.assertEqual(total('dispatched') - before['dispatched'], 2)
+        self.assertEqual(total('dropped') - before['dropped'], 1)
+
+class TestOutbox(unittest.TestCase):
+    """
+    Test the rate limited message queue
+    """
+    def fakeAPI(self, results=()):
+        """
+        Records calls, answering with results in turn
+        and then with ok
+        """
+        calls = []
+        answers = list(results)
+        def apiCall(method, **kwargs):
+            calls.append((method, kwargs))
+            if len(answers) > 0:
+                return answers.pop(0)
+            return {'ok': True, 'ts': str(len(calls))}
+        return apiCall, calls
+
+    def test_coalesce(self):
+        """
+        Messages to one thread sent close together go as one
+        """
+        apiCall, calls = self.fakeAPI()
+        o = Outbox(apiCall, rate=100, coalesce=0.05)
+        o.start()
+        o.post('C1', "one", '1.0')
+        o.post('C1', "two", '1.0')
+        o.post('C1', "elsewhere", '2.0')
+        o.close()
+        self.assertEqual([c[1]['text'] for c in calls], ["one\ntwo", "elsewhere"])
+        self.assertEqual(calls[0][1]['thread_ts'], '1.0')
+
+    def test_rateLimit(self):
+        """
+        A channel gets its burst, then waits for tokens
+        and for Retry-After when told to
+        """
+        limited = {'ok': False, 'error': 'ratelimited', 'headers': {'Retry-After': '0.2'}}
+        apiCall, calls = self.fakeAPI([{'ok': True}, limited])
+        o = Outbox(apiCall, rate=20, burst=1, coalesce=0)
+        start = time.monotonic()
+        o.start()
+        for n in range(3):
+            o.post('C1', str(n), str(n))
+        o.close()
+        self.assertEqual([c[1]['text'] for c in calls], ['0', '1', '1', '2'])
+        self.assertTrue(time.monotonic() - start >= 0.2)
+
+    def test_split(self):
+        """
+        Long responses are split between lines,
+        very long ones are uploaded
+        """
+        text = "```\n"+"\n".join("line "+str(n) for n in range(100))+"\n```"
+        chunks = splitText(text, 200)
+        self.assertTrue(all(len(c) <= 200 for c in chunks))
+        self.assertTrue(all(c.count("```") == 2 for c in chunks))
+        self.assertEqual("".join(chunks).count("line "), 100)
+        apiCall, calls = self.fakeAPI()
+        o = Outbox(apiCall, rate=1000, burst=100, maxChars=200,
+                   snippetChars=len(text) - 1, coalesce=0)
+        o.start()
+        o.post('C1', text[:700])
+        o.post('C1', text)
+        o.close()
+        methods = [c[0] for c in calls]
+        self.assertEqual(methods[-1], "files.upload")
+        self.assertTrue(methods.count("chat.postMessage") >= 4)
+
+    def test_show(self):
+        """
+        show posts once and edits after,
+        unsent text is replaced
+        """
+        apiCall, calls = self.fakeAPI()
+        o = Outbox(apiCall, rate=100, coalesce=0.05)
+        o.start()
+        o.show('job', 'C1', "stage 1", '1.0')
+        o.show('job', 'C1', "stage 2", '1.0')
+        time.sleep(0.2)
+        o.show('job', 'C1', "stage 3", '1.0')
+        o.close()
+        self.assertEqual([(c[0], c[1]['text']) for c in calls],
+                         [("chat.postMessage", "stage 2"), ("chat.update", "stage 3")])
+        self.assertEqual(calls[1][1]['ts'], '1')
+        o.forget('job')
+        self.assertEqual(o.pending(), 0)
+
+class TestRTM(unittest.TestCase):
+    """
+    Test the RTM connection against a fake Slack
+    """
+    async def until(self, condition, timeout=3):
+        end = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > end:
+                self.fail("timed out")
+            await asyncio.sleep(0.01)
+
+    def test_events(self):
+        """
+        Events are handed over as they arrive, hello is not
+        and websocket pings are answered
+        """
+        async def scenario():
+            server = FakeSlackServer()
+            await server.start()
+            events = []
+            transport = RTMTransport(server.connectURL, events.append)
+            running = asyncio.ensure_future(transport.run())
+            await self.until(lambda: server.connections == 1)
+            await server.ping()
+            sent = time.monotonic()
+            await server.send({'type': 'message', 'text': 'hi', 'user': 'U1'})
+            await self.until(lambda: len(events) == 1)
+            latency = time.monotonic() - sent
+            transport.stop()
+            await running
+            await server.close()
+            return events, latency
+        events, latency = asyncio.run(scenario())
+        self.assertEqual(events, [{'type': 'message', 'text': 'hi', 'user': 'U1'}])
+        #not held up by a poll interval
+        self.assertTrue(latency < 0.5)
+
+    def test_reconnect(self):
+        """
+        Failed connects and dropped connections are retried
+        """
+        async def scenario():
+            server = FakeSlackServer(refuse=1)
+            await server.start()
+            events = []
+            transport = RTMTransport(server.connectURL, events.append,
+                                     minBackoff=0.05, maxBackoff=0.2)
+            running = asyncio.ensure_future(transport.run())
+            await self.until(lambda: server.connections == 1)
+            await server.drop()
+            await self.until(lambda: server.connections == 2)
+            await server.send({'type': 'message', 'text': 'again'})
+            await self.until(lambda: len(events) == 1)
+            await server.send({'type': 'goodbye'})
+            await self.until(lambda: server.connections == 3)
+            transport.stop()
+            await running
+            await server.close()
+            return server, events
+        server, events = asyncio.run(scenario())
+        self.assertEqual(server.connectCalls, 4)
+        self.assertEqual(events, [{'type': 'message', 'text': 'again'}])
+
+    def test_silentServer(self):
+        """
+        A quiet connection is pinged and
+        dropped if the pings go unanswered
+        """
+        async def scenario():
+            server = FakeSlackServer(answerPings=False)
+            await server.start()
+            transport = RTMTransport(server.connectURL, lambda event: None,
+                                     pingInterval=0.05, minBackoff=0.01)
+            running = asyncio.ensure_future(transport.run())
+            await self.until(lambda: server.connections == 2)
+            transport.stop()
+            await running
+            await server.close()
+            return server
+        server = asyncio.run(scenario())
+        pings = [m for m in server.received if m.get('type') == 'ping']
+        self.assertTrue(len(pings) >= 1)
+
+class TestRouter(unittest.TestCase):
+    """
+    Test the command router and its help text
+    """
+    def test_leadingWords(self):
+        """
+        Patterns are indexed by the words they must start with
+        """
+        self.assertEqual(leadingWords(r'build new.*'), ['build'])
+        self.assertEqual(leadingWords(r'(remove|delete|nuke) vm (.*)'),
+                         ['remove', 'delete', 'nuke'])
+        self.assertEqual(leadingWords(r'clean\b.*'), ['clean'])
+        self.assertIsNone(leadingWords(r'.*logs since (.*)'))
+        self.assertIsNone(leadingWords(r'clean.*'))
+
+    def test_dispatch(self):
+        """
+        Commands reach the first matching handler
+        """
+        router = bot_commands.router
+        cases = {"Build new VM": bot_commands.buildNew,
+                 "claim user with vm test-vm-02": bot_commands.claimUserWithVM,
+                 "claim user Test McTester": bot_commands.claimUser,
+                 "get logs since yesterday": bot_commands.getLogsSince,
+                 "What is the ID for user Simon": bot_commands.getIDbyName,
+                 "delete user 78": bot_commands.removeUser,
+                 "delete vm 80": bot_commands.deleteVM,
+                 "status of job 12": bot_commands.jobStatus,
+                 "help": bot_commands.helpCommand}
+        for text, handler in cases.items():
+            route, match = router.dispatch(text)
+            self.assertIs(route.handler, handler, text)
+        self.assertEqual(router.dispatch("make me a sandwich"), (None, None))
+
+    def test_order(self):
+        """
+        Earlier routes win over later ones
+        regardless of how they are indexed
+        """
+        router = Router()
+        router.add(r'.*anything', lambda ctx, m: 'any')
+        router.add(r'say (.*)', lambda ctx, m: m.group(1))
+        route, match = router.dispatch("say anything")
+        self.assertEqual(route.handler(None, match), 'any')
+        route, match = router.dispatch("say hi")
+        self.assertEqual(route.handler(None, match), 'hi')
+
+    def test_helpWith(self):
+        """
+        Help text comes from the same table as the routes
+        """
+        standard = bot_commands.helpWith()
+        self.assertTrue("*Build new VM*" in standard)
+        self.assertFalse("*Clean*" in standard)
+        self.assertTrue("*Clean*" in bot_commands.helpWith('admin'))
+        claims = bot_commands.helpWith('claim user')
+        self.assertTrue("*Claim user [user]*" in claims)
+        self.assertTrue("*Claim user with VM [vm]*" in claims)
+
+    def test_logFilters(self):
+        """
+        Filters are taken off the end of logs since
+        """
+        calls = []
+        class FakeAPI:
+            def getLogsSince(self, pointInTime, **filters):
+                calls.append((pointInTime, filters))
+                return [("buildVM(78,)", 1539094525.0, "System", 120)]
+        ctx = bot_commands.CommandContext(FakeAPI(), {}, True, None, None)
+        route, match = bot_commands.router.dispatch(
+            "get logs since 2 days ago method buildVM after 100")
+        response = route.handler(ctx, match)
+        self.assertEqual(calls, [("2 days ago", {'method': 'buildVM', 'after': '100'})])
+        self.assertTrue("120 " in response and "buildVM(78,)" in response)
+        route, match = bot_commands.router.dispatch("get logs since today actor me")
+        self.assertEqual(route.handler(ctx, match), "actor must be a number")
+
+    def test_lazyAdminCheck(self):
+        """
+        The sender is only checked when a command asks
+        """
+        checks = []
+        def isAdmin():
+            checks.append(1)
+            return True
+        ctx = bot_commands.CommandContext(None, {}, isAdmin, None, None)
+        route, match = bot_commands.router.dispatch("help")
+        route.handler(ctx, match)
+        self.assertEqual(checks, [])
+        self.assertTrue(ctx.isAdmin)
+        self.assertTrue(ctx.isAdmin)
+        self.assertEqual(checks, [1])
+
+    def test_cleanJob(self):
+        """
+        Clean is queued and its summary is
+        described once the job is done
+        """
+        submitted = []
+        class FakeJobs:
+            def submit(self, method, args, **where):
+                submitted.append((method, args, where))
+                return 7
+        event = {'user': 'U1', 'channel': 'C1', 'ts': '1.5'}
+        ctx = bot_commands.CommandContext(None, event, True, None, FakeJobs)
+        route, match = bot_commands.router.dispatch("clean")
+        self.assertEqual(route.handler(ctx, match), "Cleaning inactive VMs as job 7...")
+        self.assertEqual(submitted, [('cleanVMs', [],
+                                      {'requester': 'U1', 'channel': 'C1', 'thread': '1.5'})])
+        summary = {'results': [{'ID': 80, 'hostname': 'junk-VM-01', 'ok': True}],
+                   'destroyed': 1, 'failed': 0, 'pruned': True, 'seconds': 2.5}
+        job = {'ID': 7, 'method': 'cleanVMs', 'status': 'done',
+               'result': json.dumps(summary)}
+        text = bot_commands.describe_job(job)
+        self.assertTrue("Destroyed 1 inactive VMs in 2.5s" in text)
+        self.assertTrue("80 junk-VM-01: destroyed" in text)
+
+class TestUserDirectory(unittest.TestCase):
+    """
+    Test the cached chat user directory
+    """
+    def setUp(self):
+        self.pages = {'': ([{"id": "U1", "real_name": "Simon Rosner"}], 'c2'),
+                      'c2': ([{"id": "U2", "profile": {"real_name": "Test McTester"}}], '')}
+        self.calls = []
+        def fetchPage(cursor):
+            self.calls.append(cursor)
+            return self.pages[cursor]
+        self.fetchPage = fetchPage
+
+    def test_pagination(self):
+        """
+        Every page is loaded and indexed by id
+        """
+        d = UserDirectory(self.fetchPage)
+        self.assertEqual(d.refresh(), 2)
+        self.assertEqual(self.calls, ['', 'c2'])
+        self.assertEqual(d.realName("U1"), "Simon Rosner")
+        self.assertEqual(d.realName("U2"), "Test McTester")
+
+    def test_cached(self):
+        """
+        Fresh lookups do not call the service again
+        and unknown users fall back to fetchOne
+        """
+        d = UserDirectory(self.fetchPage, ttl=60,
+                          fetchOne=lambda uid: {"id": uid, "real_name": "New Hire"})
+        d.refresh()
+        for i in range(10):
+            d.realName("U1")
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(d.realName("U3"), "New Hire")
+        self.assertEqual(len(self.calls), 2)
+
+    def test_staleRefresh(self):
+        """
+        Stale lookups answer at once and refresh in the background
+        """
+        d = UserDirectory(self.fetchPage, ttl=0)
+        d.refresh()
+        self.assertEqual(d.realName("U1"), "Simon Rosner")
+        deadline = time.time() + 5
+        while len(self.calls) < 4 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(self.calls), 4)
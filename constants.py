@@ -4,6 +4,117 @@
 SERVICE = "slack"
 DATABASE = "VMDB.db"
 BOX = 'vsphere'
-READ_DELAY = 1
 MENTION_REGEX = "^<@(|[WU].+?)>(.*)"
 MAX_VM_PER_USER = 3
+
+#event logging is written in batches
+#   flushed once this many events are queued
+AUDIT_BATCH_SIZE = 50
+#   or after this many seconds
+AUDIT_FLUSH_INTERVAL = 2
+#   an event which fails this many flushes is dropped
+AUDIT_MAX_ATTEMPTS = 5
+
+#number of vagrant jobs (build, rebuild, provision, destroy)
+#   which may run at the same time
+JOB_WORKERS = 2
+
+#bot commands handled at the same time
+COMMAND_WORKERS = 4
+#   commands waiting beyond this are dropped
+MAX_PENDING_COMMANDS = 100
+
+#seconds without a word from Slack before the bot pings,
+#   after twice this long the connection is dropped and made again
+RTM_PING_INTERVAL = 30
+#seconds waited before reconnecting, doubled after each failure
+RTM_MIN_BACKOFF = 1
+#   up to this many
+RTM_MAX_BACKOFF = 60
+
+#messages per second the bot sends to one channel, see outbox.py
+#   Slack allows about one per second per channel
+SLACK_RATE = 1
+#   messages a quiet channel may get at once
+SLACK_BURST = 3
+#longest message, longer responses are split
+SLACK_MAX_CHARS = 3500
+#   responses longer than this are uploaded as a file instead
+SLACK_SNIPPET_CHARS = 12000
+#seconds a message waits for more text to the same thread
+SLACK_COALESCE_SECONDS = 0.25
+
+#seconds before the cached list of chat users is refreshed
+USER_CACHE_TTL = 3600
+#users fetched per users.list call
+USER_PAGE_SIZE = 200
+
+#Vagrantfile template in the templates folder used for new VMs
+VAGRANT_TEMPLATE = 'Vagrantfile.j2'
+
+#lines of command output kept in memory and sent back to chat
+#   the full output is written to the logs folder
+OUTPUT_TAIL_LINES = 40
+#min seconds between progress updates while vagrant runs
+PROGRESS_INTERVAL = 5
+
+#cleanVMs destroys at most this many VMs at once per box (cluster)
+CLEAN_PARALLELISM = {'vsphere': 4}
+#   for boxes not listed above
+CLEAN_DEFAULT_PARALLELISM = 2
+#   and at most this many in total
+CLEAN_MAX_WORKERS = 8
+
+#networks new VMs get their addresses from
+IP_POOLS = ['10.20.6.0/24']
+#   addresses at the start of each network which are never used
+IP_RESERVED_HOSTS = 1
+
+#ready built VMs kept for "build new", by box, ex: {'vsphere': 2}
+#   every one is a paid for VM, so the pool is off (empty) by default
+WARM_POOL_TARGETS = {}
+#   builds for the pool which may run at once
+WARM_POOL_MAX_BUILDS = 1
+#   most VMs in the pool across every box, ready or being built
+WARM_POOL_MAX_VMS = 2
+#   seconds between checks of the pool level
+WARM_POOL_INTERVAL = 300
+#user that owns VMs in the pool
+POOL_OWNER = 0
+
+#seconds between vagrant global-status runs, see reconciler.py
+RECONCILE_INTERVAL = 300
+#VMs still underConstruction after this many seconds are reported as drift
+STALE_BUILD_SECONDS = 3600
+
+#events returned per page by getLogsSince
+LOG_PAGE_SIZE = 100
+#   the most a caller may ask for
+LOG_MAX_PAGE_SIZE = 1000
+
+#days events stay in the database before archiveEvents moves them
+#   to compressed monthly files in the archive folder
+EVENT_RETENTION_DAYS = 90
+#   events moved per transaction
+ARCHIVE_BATCH_SIZE = 5000
+#   seconds between archives, run by the reconciler, None to only archive on request
+ARCHIVE_INTERVAL = 86400
+
+#vagrant executable, set to fake_vagrant/vagrant to test without a cluster
+VAGRANT = 'vagrant'
+#folder holding one folder per VM, None for the folder vagrant_API.py is in
+VMS_PATH = None
+
+#most operations accepted by one /batch/ request, see batch.py
+BATCH_MAX_OPERATIONS = 100
+
+#service accounts and admin status remembered by each V_API, see auth_cache.py
+AUTH_CACHE_SIZE = 1024
+#   seconds an answer is used for, changes made by
+#   another process (bot or web) show up after this long
+AUTH_CACHE_SECONDS = 60
+
+#seconds web_API serves /listUsers/ and /listVMs/ from its cache
+#   writes made by this process clear it at once,
+#   writes made by the bot or another process show up after this long
+READ_CACHE_SECONDS = 10
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+Pooled sqlite3 connections for V_API
+"""
+__author__ = "Simon Rosner"
+__credits__ = ["Simon Rosner"]
+__version__ = "2026.10.18"
+__maintainer__ = "Simon Rosner"
+__email__ = ""
+
+import sqlite3
+import threading
+import atexit
+import time
+import weakref
+import metrics
+from contextlib import contextmanager
+
+#pragmas applied to every new connection
+#   WAL lets readers and the writer work at the same time
+#   NORMAL only fsyncs at checkpoints while in WAL mode
+#   cache_size is negative so it is read as KiB
+PRAGMAS = ["PRAGMA journal_mode=WAL",
+           "PRAGMA synchronous=NORMAL",
+           "PRAGMA cache_size=-8192",
+           "PRAGMA temp_store=MEMORY",
+           "PRAGMA busy_timeout=5000"]
+
+class _Held:
+    def __init__(self, conn):
+        """
+        A thread's connection and how deep its transactions are.
+        Only the thread's locals refer to it,
+        so it goes away when the thread does
+        """
+        self.conn = conn
+        self.depth = 0
+
+class DBPool:
+    def __init__(self, db):
+        """
+        Hands out one connection per thread for
+        the sqlite3 database file path provided.
+        A connection is closed when its thread exits
+        """
+        self.db = db
+        self.closed = False
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = {}  #connection -> finalizer closing it
+
+    def _held(self):
+        """
+        The calling thread's _Held,
+        opening its connection on first use
+        """
+        held = getattr(self._local, 'held', None)
+        if held is None:
+            if self.closed:
+                raise sqlite3.ProgrammingError("The pool for "+self.db+" is closed")
+            #autocommit mode, transactions are opened explicitly
+            conn = sqlite3.connect(self.db,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+            for pragma in PRAGMAS:
+                conn.execute(pragma)
+            held = _Held(conn)
+            self._local.held = held
+            #request handlers and workers are short lived threads,
+            #   their connections must not outlive them
+            closer = weakref.finalize(held, self._release, conn)
+            with self._lock:
+                closed = self.closed
+                if not closed:
+                    self._connections[conn] = closer
+            if closed:
+                closer()
+                raise sqlite3.ProgrammingError("The pool for "+self.db+" is closed")
+        return held
+
+    def connection(self):
+        """
+        Returns the calling thread's connection,
+        opening it on first use
+        """
+        return self._held().conn
+
+    def inTransaction(self):
+        """
+        True if the calling thread is inside transaction()
+        or has a transaction open on its connection
+        """
+        held = getattr(self._local, 'held', None)
+        return held is not None and (held.depth > 0 or held.conn.in_transaction)
+
+    def _release(self, conn):
+        """
+        Closes a connection and forgets it
+        """
+        with self._lock:
+            self._connections.pop(conn, None)
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def openConnections(self):
+        """
+        Number of connections open right now
+        """
+        with self._lock:
+            return len(self._connections)
+
+    def execute(self, query, quargs):
+        """
+        Runs a single statement and returns all rows.
+        Errors are raised to the caller
+        """
+        c = self.connection().cursor()
+        start = time.perf_counter()
+        kind = metrics.statementKind(query)
+        try:
+            c.execute(query, quargs)
+            return c.fetchall()
+        except Exception:
+            metrics.registry.inc('vmbot_db_errors_total', {'statement': kind})
+            raise
+        finally:
+            c.close()
+            metrics.registry.observe('vmbot_db_seconds', {'statement': kind},
+                                     time.perf_counter() - start)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Groups every statement run on this thread
+        into one transaction. Nested use becomes a savepoint
+        """
+        held = self._held()
+        conn = held.conn
+        depth = held.depth
+        savepoint = "sp" + str(depth)
+        if depth == 0:
+            conn.execute("BEGIN IMMEDIATE")
+        else:
+            conn.execute("SAVEPOINT " + savepoint)
+        held.depth = depth + 1
+        c = conn.cursor()
+        try:
+            yield c
+        except:
+            #ON CONFLICT ROLLBACK may have ended the transaction already
+            if not conn.in_transaction:
+                pass
+            elif depth == 0:
+                conn.execute("ROLLBACK")
+            else:
+                conn.execute("ROLLBACK TO " + savepoint)
+                conn.execute("RELEASE " + savepoint)
+            raise
+        else:
+            if depth == 0:
+                conn.execute("COMMIT")
+            else:
+                conn.execute("RELEASE " + savepoint)
+        finally:
+            c.close()
+            held.depth = depth
+
+    def close(self):
+        """
+        Closes every connection handed out by this pool.
+        It hands out no more, threads still using it
+        get an error instead of a connection nothing would close
+        """
+        with self._lock:
+            self.closed = True
+            closers = list(self._connections.values())
+        for closer in closers:
+            closer()
+        self._local = threading.local()
+
+_pools = {}
+_poolsLock = threading.Lock()
+
+def getPool(db):
+    """
+    Returns the shared pool for a database file path
+    """
+    with _poolsLock:
+        pool = _pools.get(db)
+        if pool is None:
+            pool = DBPool(db)
+            _pools[db] = pool
+        return pool
+
+def closePool(db):
+    """
+    Closes and forgets the pool for a database file path
+    """
+    with _poolsLock:
+        pool = _pools.pop(db, None)
+    if pool is not None:
+        pool.close()
+
+@atexit.register
+def closeAll():
+    """
+    Closes every pool. Runs at interpreter shutdown
+    """
+    with _poolsLock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Runs bot commands on a bounded thread pool
+"""
+__author__ = "Simon Rosner"
+__credits__ = ["Simon Rosner"]
+__version__ = "2026.10.18"
+__maintainer__ = "Simon Rosner"
+__email__ = ""
+
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+class CommandDispatcher:
+    def __init__(self, handler, workers=4, maxPending=100):
+        """
+        Calls handler(*args) for every submitted command.
+        Requires the handler,
+        the number of commands that may run at once
+        and the number that may wait before new ones are dropped.
+        Commands from the same user run one at a time, in order
+        """
+        self.handler = handler
+        self.maxPending = maxPending
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix="command")
+        self._lock = threading.Lock()
+        self._queues = {}   #user -> deque of waiting args
+        self._pending = 0   #commands waiting or running
+        self.counters = {'events': 0,
+                         'commands': 0,
+                         'dispatched': 0,
+                         'dropped': 0,
+                         'failed': 0}
+
+    def count(self, name, n=1):
+        """
+        Adds n to one of the counters
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+        metrics.registry.inc('vmbot_dispatch_total', {'counter': name}, n)
+
+    def stats(self):
+        """
+        Returns a copy of the counters
+        """
+        with self._lock:
+            out = dict(self.counters)
+            out['pending'] = self._pending
+            return out
+
+    def submit(self, user, *args):
+        """
+        Queues a command for a user.
+        Returns False if it was dropped
+        """
+        self.count('commands')
+        with self._lock:
+            dropped = self._pending >= self.maxPending
+            if not dropped:
+                self._pending+= 1
+                userQueue = self._queues.get(user)
+                start = userQueue is None
+                if start:
+                    userQueue = deque()
+                    self._queues[user] = userQueue
+                userQueue.append(args)
+        if dropped:
+            self.count('dropped')
+            return False
+        self.count('dispatched')
+        #only one runner per user keeps their commands in order
+        if start:
+            self._executor.submit(self._drain, user)
+        return True
+
+    def _drain(self, user):
+        """
+        Runs a user's commands until none are left
+        """
+        while True:
+            with self._lock:
+                userQueue = self._queues[user]
+                if len(userQueue) == 0:
+                    del self._queues[user]
+                    return
+                args = userQueue.popleft()
+            try:
+                self.handler(*args)
+            except Exception as e:
+                self.count('failed')
+                sys.stderr.write("command failed: "+str(e)+'\n')
+            finally:
+                with self._lock:
+                    self._pending-= 1
+
+    def close(self, wait=True):
+        """
+        Stops accepting work and optionally waits
+        for queued commands to finish
+        """
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Process-wide V_API shared by VMbot.py and web_API.py
+"""
+__author__ = "Simon Rosner"
+__credits__ = ["Simon Rosner"]
+__version__ = "2026.10.18"
+__maintainer__ = "Simon Rosner"
+__email__ = ""
+
+import threading
+import atexit
+import constants
+from vagrant_API import V_API
+from jobs import JobQueue
+from warm_pool import WarmPool
+from reconciler import Reconciler
+
+_engine = None
+_jobs = None
+_warmPool = None
+_reconciler = None
+_lock = threading.Lock()
+
+def startup(service=None, db=None, box=None):
+    """
+    Creates the shared V_API if it does not exist yet.
+    Arguments default to the values in constants.py
+    """
+    global _engine
+    with _lock:
+        if _engine is None:
+            _engine = V_API(service or constants.SERVICE,
+                            db or constants.DATABASE,
+                            box or constants.BOX)
+        return _engine
+
+def get():
+    """
+    Returns the shared V_API, starting it if needed
+    """
+    engine = _engine
+    if engine is None:
+        engine = startup()
+    return engine
+
+def jobs():
+    """
+    Returns the shared JobQueue, starting it if needed
+    """
+    global _jobs
+    engine = get()
+    with _lock:
+        if _jobs is None:
+            _jobs = JobQueue(engine, constants.JOB_WORKERS)
+            _jobs.start()
+        return _jobs
+
+def warmPool():
+    """
+    Returns the shared WarmPool, starting it if needed
+    """
+    global _warmPool
+    engine = get()
+    with _lock:
+        if _warmPool is None:
+            _warmPool = WarmPool(engine,
+                                 constants.WARM_POOL_TARGETS,
+                                 constants.WARM_POOL_MAX_BUILDS,
+                                 constants.WARM_POOL_INTERVAL,
+                                 constants.WARM_POOL_MAX_VMS)
+            _warmPool.start()
+        return _warmPool
+
+def reconciler():
+    """
+    Returns the shared Reconciler, starting it if needed
+    """
+    global _reconciler
+    engine = get()
+    with _lock:
+        if _reconciler is None:
+            _reconciler = Reconciler(engine, constants.RECONCILE_INTERVAL,
+                                     archiveInterval=constants.ARCHIVE_INTERVAL)
+            _reconciler.start()
+        return _reconciler
+
+@atexit.register
+def shutdown():
+    """
+    Waits for running jobs and pool builds, flushes logs
+    and closes database connections.
+    Safe to call more than once
+    """
+    global _engine, _jobs, _warmPool, _reconciler
+    with _lock:
+        engine = _engine
+        jobQueue = _jobs
+        pool = _warmPool
+        states = _reconciler
+        _engine = None
+        _jobs = None
+        _warmPool = None
+        _reconciler = None
+    if states is not None:
+        states.close()
+    if pool is not None:
+        pool.close()
+    if jobQueue is not None:
+        jobQueue.stop()
+    if engine is not None:
+        engine.close()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Moves old events out of the database into
+compressed files, one per month, and reads them back
+"""
+__author__ = "Simon Rosner"
+__credits__ = ["Simon Rosner"]
+__version__ = "2026.10.18"
+__maintainer__ = "Simon Rosner"
+__email__ = ""
+
+import gzip
+import json
+import os
+import re
+import time
+
+#events-2018-10.jsonl.gz
+_FILE_NAME = re.compile(r'^events-(\d{4})-(\d{2})\.jsonl\.gz$')
+#highest event ID in each month's file, so readers can skip whole files
+_INDEX_NAME = "index.json"
+
+def monthOf(timestamp):
+    """
+    (year, month) of a UNIX timestamp in local time
+    """
+    t = time.localtime(timestamp)
+    return t.tm_year, t.tm_mon
+
+def archiveFile(folder, month):
+    return os.path.join(folder, "events-%04d-%02d.jsonl.gz" % month)
+
+def readIndex(folder):
+    """
+    {"2018-10": highest event ID in that month's file}.
+    Months missing from it must be read to be sure
+    """
+    try:
+        with open(os.path.join(folder, _INDEX_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _writeIndex(folder, index):
+    path = os.path.join(folder, _INDEX_NAME)
+    with open(path+'.tmp', 'w') as f:
+        json.dump(index, f, sort_keys=True)
+    os.replace(path+'.tmp', path)
+
+def archiveEvents(pool, folder, before, batchSize=5000):
+    """
+    Moves events older than before (a UNIX timestamp)
+    and their actors into folder, batchSize events per transaction.
+    Each event is one JSON line in the file for its month.
+    Returns the number of events moved
+    """
+    os.makedirs(folder, exist_ok=True)
+    events = "Select ID, description, timestamp From Events "
+    events+= "Where timestamp < ? Order by ID Limit ?"
+    actors = "Select Actors.eventID, Actors.actorID, Users.name From Actors "
+    actors+= "Left Join Users on Actors.actorID = Users.ID "
+    actors+= "Where Actors.eventID between ? and ? "
+    actors+= "Order by Actors.eventID, Actors.actorID"
+    moved = 0
+    while True:
+        with pool.transaction() as c:
+            c.execute(events, [before, batchSize])
+            rows = c.fetchall()
+            if len(rows) == 0:
+                break
+            first = rows[0][0]
+            last = rows[-1][0]
+            c.execute(actors, [first, last])
+            byEvent = {}
+            for eventID, actorID, name in c.fetchall():
+                byEvent.setdefault(eventID, []).append([actorID, name])
+            byMonth = {}
+            lastID = {}     #month -> highest ID in this batch
+            for eventID, description, timestamp in rows:
+                if isinstance(description, bytes):
+                    description = description.decode('utf-8', 'replace')
+                line = json.dumps({'ID': eventID,
+                                   'description': description,
+                                   'timestamp': timestamp,
+                                   'actors': byEvent.get(eventID, [])})
+                month = monthOf(timestamp)
+                byMonth.setdefault(month, []).append(line)
+                lastID[month] = max(lastID.get(month, 0), eventID)
+            #written before the rows are deleted, a crash in between
+            #   leaves duplicates which readEvents skips
+            for month, lines in byMonth.items():
+                with gzip.open(archiveFile(folder, month), 'at') as f:
+                    f.write('\n'.join(lines)+'\n')
+            index = readIndex(folder)
+            for month, eventID in lastID.items():
+                key = "%04d-%02d" % month
+                index[key] = max(index.get(key, 0), eventID)
+            _writeIndex(folder, index)
+            ids = [[row[0]] for row in rows]
+            c.executemany("Delete from Actors Where eventID = ?", ids)
+            c.executemany("Delete from Events Where ID = ?", ids)
+        moved+= len(rows)
+    return moved
+
+def archivedMonths(folder):
+    """
+    Months which have an archive file, oldest first
+    """
+    if not os.path.isdir(folder):
+        return []
+    months = []
+    for name in os.listdir(folder):
+        m = _FILE_NAME.match(name)
+        if m is not None:
+            months.append((int(m.group(1)), int(m.group(2))))
+    return sorted(months)
+
+def readEvents(folder, since, after=0, actor=None, method=None, limit=None):
+    """
+    Yields archived events at or after since
+    with an ID greater than after, as dicts,
+    oldest month first and in ID order within a month.
+    actor and method filter like V_API.getLogsSince,
+    at most limit events are read if it is given.
+    Months before since, or whose events all have
+    an ID up to after, are not opened
+    """
+    start = monthOf(since)
+    index = readIndex(folder)
+    seen = set()
+    found = 0
+    for month in archivedMonths(folder):
+        if month < start:
+            continue
+        lastID = index.get("%04d-%02d" % month)
+        if lastID is not None and lastID <= after:
+            continue
+        #later runs may append lower IDs to a month, so sort before paging
+        with gzip.open(archiveFile(folder, month), 'rt') as f:
+            events = sorted((json.loads(line) for line in f),
+                            key=lambda event: event['ID'])
+        for event in events:
+            if event['ID'] <= after or event['timestamp'] < since:
+                continue
+            if event['ID'] in seen:
+                continue
+            seen.add(event['ID'])
+            if method is not None and not event['description'].startswith(method+'('):
+                continue
+            if actor is not None and actor not in [a[0] for a in event['actors']]:
+                continue
+            yield event
+            found+= 1
+            if limit is not None and found >= limit:
+                return
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Stand-in for Slack's RTM websocket, for tests.
+Serves on localhost and lets a test push events,
+drop connections and see what the client sent
+"""
+__author__ = "Simon Rosner"
+__credits__ = ["Simon Rosner"]
+__version__ = "2026.10.18"
+__maintainer__ = "Simon Rosner"
+__email__ = ""
+
+import asyncio
+import base64
+import hashlib
+import json
+import struct
+
+#added to the client's key to make the accept header, see RFC 6455
+_WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+TEXT = 0x1
+CLOSE = 0x8
+PING = 0x9
+PONG = 0xA
+
+class ConnectionClosed(Exception):
+    pass
+
+def acceptKey(key):
+    """
+    Sec-WebSocket-Accept for a client's Sec-WebSocket-Key
+    """
+    digest = hashlib.sha1((key + _WEBSOCKET_GUID).encode()).digest()
+    return base64.b64encode(digest).decode()
+
+def encodeFrame(opcode, payload):
+    """
+    One final, unmasked frame, as a server sends them
+    """
+    header = bytes([0x80 | opcode])
+    length = len(payload)
+    if length < 126:
+        header+= bytes([length])
+    elif length < 1 << 16:
+        header+= bytes([126]) + struct.pack('!H', length)
+    else:
+        header+= bytes([127]) + struct.pack('!Q', length)
+    return header + payload
+
+async def readFrame(reader):
+    """
+    (opcode, payload) of the next frame from a client, unmasked
+    """
+    try:
+        first, second = await reader.readexactly(2)
+        length = second & 0x7F
+        if length == 126:
+            length = struct.unpack('!H', await reader.readexactly(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', await reader.readexactly(8))[0]
+        key = await reader.readexactly(4) if second & 0x80 else None
+        payload = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        raise ConnectionClosed("connection closed mid frame")
+    if key is not None:
+        payload = bytes(b ^ key[i % 4] for i, b in enumerate(payload))
+    return first & 0x0F, payload
+
+class FakeSlackServer:
+    def __init__(self, hello=True, answerPings=True, refuse=0):
+        """
+        hello: say hello on connect, as Slack does
+        answerPings: answer {"type": "ping"} with a pong
+        refuse: rtm.connect fails this many times first
+        """
+        self.hello = hello
+        self.answerPings = answerPings
+        self.refuse = refuse
+        self.received = []  #messages from clients, decoded
+        self.connectCalls = 0   #calls to connectURL
+        self.connections = 0    #websockets opened
+        self._writers = []
+        self._handlers = set()  #running _client tasks
+        self._server = None
+        self.url = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._client, '127.0.0.1', 0)
+        port = self._server.sockets[0].getsockname()[1]
+        self.url = "ws://127.0.0.1:"+str(port)+"/websocket/fake"
+        return self.url
+
+    def connectURL(self):
+        """
+        Stands in for rtm.connect
+        """
+        self.connectCalls+= 1
+        if self.connectCalls <= self.refuse:
+            raise Exception("fake rtm.connect refused")
+        return self.url
+
+    async def _client(self, reader, writer):
+        self._handlers.add(asyncio.current_task())
+        request = await reader.readuntil(b'\r\n\r\n')
+        key = None
+        for line in request.decode('latin-1').split('\r\n'):
+            if line.lower().startswith('sec-websocket-key:'):
+                key = line.split(':', 1)[1].strip()
+        response = "HTTP/1.1 101 Switching Protocols\r\n"
+        response+= "Upgrade: websocket\r\nConnection: Upgrade\r\n"
+        response+= "Sec-WebSocket-Accept: "+acceptKey(key)+"\r\n\r\n"
+        writer.write(response.encode())
+        self.connections+= 1
+        self._writers.append(writer)
+        if self.hello:
+            writer.write(encodeFrame(TEXT, b'{"type": "hello"}'))
+        await writer.drain()
+        try:
+            while True:
+                opcode, payload = await readFrame(reader)
+                if opcode == CLOSE:
+                    break
+                if opcode == PING:
+                    writer.write(encodeFrame(PONG, payload))
+                    continue
+                if opcode != TEXT:
+                    continue
+                message = json.loads(payload.decode('utf-8'))
+                self.received.append(message)
+                if message.get('type') == 'ping' and self.answerPings:
+                    pong = {'type': 'pong', 'reply_to': message.get('id')}
+                    writer.write(encodeFrame(TEXT, json.dumps(pong).encode()))
+                    await writer.drain()
+        except (ConnectionClosed, ConnectionError):
+            pass
+        finally:
+            if writer in self._writers:
+                self._writers.remove(writer)
+            writer.close()
+            self._handlers.discard(asyncio.current_task())
+
+    async def send(self, event):
+        """
+        Sends an event to every connected client
+        """
+        data = json.dumps(event).encode('utf-8')
+        for writer in list(self._writers):
+            writer.write(encodeFrame(TEXT, data))
+            await writer.drain()
+
+    async def ping(self):
+        """
+        Sends a websocket ping frame to every client
+        """
+        for writer in list(self._writers):
+            writer.write(encodeFrame(PING, b'are you there'))
+            await writer.drain()
+
+    async def drop(self):
+        """
+        Cuts every connection without a close frame
+        """
+        for writer in list(self._writers):
+            self._writers.remove(writer)
+            writer.transport.abort()
+
+    async def close(self):
+        await self.drop()
+        self._server.close()
+        #lets every connection finish before the loop goes away
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+        await self._server.wait_closed()
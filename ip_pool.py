@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Allocates VM addresses from CIDR pools
+"""
+__author__ = "Simon Rosner"
+__credits__ = ["Simon Rosner"]
+__version__ = "2026.10.18"
+__maintainer__ = "Simon Rosner"
+__email__ = ""
+
+import ipaddress
+import threading
+from collections import deque
+
+class PoolExhausted(Exception):
+    """
+    Every address in the pool is in use
+    """
+    pass
+
+class IPPool:
+    def __init__(self, networks, reservedHosts=1):
+        """
+        Hands out host addresses from a list of CIDR networks
+        (ex: ['10.20.6.0/24']), in order.
+        The first reservedHosts addresses of each network
+        are never handed out (gateways and the like).
+        Which addresses are used is kept in a bitmap,
+        one bit per address
+        """
+        self.networks = []  #(first address as int, size, offset of first bit)
+        size = 0
+        for network in networks:
+            network = ipaddress.ip_network(network)
+            first = int(network.network_address) + 1 + reservedHosts
+            last = int(network.broadcast_address) - 1
+            if last < first:
+                continue
+            self.networks.append((first, last - first + 1, size))
+            size+= last - first + 1
+        self.size = size
+        self._used = bytearray((size + 7) // 8)
+        self._count = 0
+        self._next = 0  #every address past this has never been handed out
+        self._released = deque()    #addresses freed since then
+        self._lock = threading.Lock()
+
+    def _index(self, ip):
+        """
+        Bit for an address or None if it is not in the pool
+        """
+        try:
+            value = int(ipaddress.ip_address(str(ip).strip()))
+        except ValueError:
+            return None
+        for first, size, offset in self.networks:
+            if first <= value < first + size:
+                return offset + value - first
+        return None
+
+    def _address(self, index):
+        for first, size, offset in self.networks:
+            if index < offset + size:
+                return str(ipaddress.ip_address(first + index - offset))
+
+    def _isUsed(self, index):
+        return self._used[index >> 3] & (1 << (index & 7)) != 0
+
+    def _setUsed(self, index, used):
+        if used:
+            self._used[index >> 3]|= 1 << (index & 7)
+        else:
+            self._used[index >> 3]&= ~(1 << (index & 7))
+
+    def mark(self, ip):
+        """
+        Records an address as used.
+        Returns False if it is not in the pool
+        """
+        index = self._index(ip)
+        if index is None:
+            return False
+        with self._lock:
+            if not self._isUsed(index):
+                self._setUsed(index, True)
+                self._count+= 1
+        return True
+
+    def load(self, addresses):
+        """
+        Marks every address as used, ex: every ip in the VM table.
+        Addresses outside the pool are ignored
+        """
+        for ip in addresses:
+            if ip is not None:
+                self.mark(ip)
+
+    def allocate(self):
+        """
+        Returns a free address and marks it as used.
+        Raises PoolExhausted when there is none
+        """
+        with self._lock:
+            while len(self._released) > 0:
+                index = self._released.popleft()
+                if not self._isUsed(index):
+                    return self._take(index)
+            while self._next < self.size:
+                index = self._next
+                self._next+= 1
+                if not self._isUsed(index):
+                    return self._take(index)
+        raise PoolExhausted("No free addresses left")
+
+    def _take(self, index):
+        self._setUsed(index, True)
+        self._count+= 1
+        return self._address(index)
+
+    def release(self, ip):
+        """
+        Returns an address to the pool
+        """
+        index = self._index(ip)
+        if index is None:
+            return
+        with self._lock:
+            if self._isUsed(index):
+                self._setUsed(index, False)
+                self._count-= 1
+                if index < self._next:
+                    self._released.append(index)
+
+    def free(self):
+        """
+        Number of addresses that can still be handed out
+        """
+        return self.size - self._count
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Background job queue for long running V_API operations
+"""
+__author__ = "Simon Rosner"
+__credits__ = ["Simon Rosner"]
+__version__ = "2026.10.18"
+__maintainer__ = "Simon Rosner"
+__email__ = ""
+
+import json
+import queue
+import sys
+import threading
+import time
+
+#V_API methods which may be run as jobs
+JOB_METHODS = ('archiveEvents',
+               'buildThroughService',
+               'buildVM',
+               'cleanVMs',
+               'deleteVM',
+               'destroyVM',
+               'provisionVM',
+               'rebuildVM')
+#job methods which accept a progress callback
+PROGRESS_METHODS = ('buildThroughService',
+                    'buildVM',
+                    'deleteVM',
+                    'destroyVM',
+                    'provisionVM',
+                    'rebuildVM')
+
+class JobQueue:
+    def __init__(self, v, workers=2, methods=JOB_METHODS):
+        """
+        Runs V_API methods on a pool of worker threads.
+        Jobs are kept in the Jobs table, see migrations.py
+        Requires a V_API,
+        the number of jobs that may run at once
+        and the method names which may be queued
+        """
+        self.v = v
+        self.workers = workers
+        self.methods = methods
+        self._queue = queue.Queue()
+        self._threads = []
+        self._listeners = []    #called with the job dict when a job ends
+        self._progressListeners = []    #called with (job, stage)
+        self._stages = {}   #job ID -> latest stage of a running job
+        self._finished = threading.Condition()
+
+    def addListener(self, func):
+        """
+        func(job) is called from a worker thread
+        whenever a job finishes or fails
+        """
+        self._listeners.append(func)
+
+    def addProgressListener(self, func):
+        """
+        func(job, stage) is called from a worker thread
+        as a running job moves from stage to stage
+        """
+        self._progressListeners.append(func)
+
+    def start(self):
+        """
+        Starts the workers. Jobs that were running when
+        the process last stopped are marked as failed,
+        queued jobs are picked up again
+        """
+        interrupted = "Update Jobs set status = 'failed', "
+        interrupted+= "result = 'Interrupted by restart', finished = ? "
+        interrupted+= "Where status = 'running'"
+        self.v.queryDB(interrupted, [round(time.time(),2)])
+        waiting = self.v.queryDB("Select ID from Jobs Where status = 'queued' "
+                                 "Order by ID", [])
+        for row in waiting:
+            self._queue.put(row[0])
+        for i in range(self.workers):
+            t = threading.Thread(target=self._work,
+                                 name="job-worker-"+str(i),
+                                 daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self):
+        """
+        Lets running jobs finish and stops the workers.
+        Jobs still queued stay queued for the next start
+        """
+        for t in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def submit(self, method, args, requester=None, channel=None, thread=None):
+        """
+        Queues V_API.method(*args) and returns the job ID.
+        channel and thread record where to report the result
+        """
+        if method not in self.methods:
+            raise ValueError(method + " cannot be run as a job")
+        query = "Insert into Jobs(method, args, requester, channel, thread, "
+        query+= "status, created) Values(?,?,?,?,?,'queued',?)"
+        queryArgs = [method, json.dumps(list(args)), requester,
+                     channel, thread, round(time.time(),2)]
+        with self.v.pool.transaction() as c:
+            c.execute(query, queryArgs)
+            jobID = c.lastrowid
+        self._queue.put(jobID)
+        return jobID
+
+    def status(self, jobID):
+        """
+        Returns the job as a dict or None if it does not exist
+        """
+        query = "Select ID, method, args, requester, channel, thread, "
+        query+= "status, result, created, started, finished "
+        query+= "From Jobs Where ID = ?"
+        rows = self.v.queryDB(query, [jobID])
+        if not isinstance(rows, list) or len(rows) == 0:
+            return None
+        keys = ['ID', 'method', 'args', 'requester', 'channel', 'thread',
+                'status', 'result', 'created', 'started', 'finished']
+        job = dict(zip(keys, rows[0]))
+        job['args'] = json.loads(job['args'])
+        job['stage'] = self._stages.get(job['ID'])
+        return job
+
+    def wait(self, jobID, timeout=None):
+        """
+        Blocks until the job is done or failed.
+        Returns the job dict
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._finished:
+            while True:
+                job = self.status(jobID)
+                if job is None or job['status'] in ('done', 'failed'):
+                    return job
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return job
+                self._finished.wait(remaining)
+
+    def _work(self):
+        """
+        Worker loop
+        """
+        while True:
+            jobID = self._queue.get()
+            if jobID is None:
+                return
+            job = self.status(jobID)
+            if job is None or job['status'] != 'queued':
+                continue
+            self.v.queryDB("Update Jobs set status = 'running', started = ? "
+                           "Where ID = ?", [round(time.time(),2), jobID])
+            kwargs = {}
+            if job['method'] in PROGRESS_METHODS:
+                kwargs['progress'] = self._progressFor(job)
+            status = 'done'
+            try:
+                #strict so the method's errors reach here instead of being swallowed
+                with self.v.strict(), self.v.vagrantRuns() as runs:
+                    result = getattr(self.v, job['method'])(*job['args'], **kwargs)
+                #a vagrant command which exits non zero fails the job
+                if any(run.returncode != 0 for run in runs):
+                    status = 'failed'
+            except Exception as e:
+                status = 'failed'
+                result = e
+            self._stages.pop(jobID, None)
+            #summaries, ex: cleanVMs, are kept as JSON so they can be read back
+            if status == 'done' and isinstance(result, (dict, list)):
+                result = json.dumps(result)
+            self.v.queryDB("Update Jobs set status = ?, result = ?, finished = ? "
+                           "Where ID = ?",
+                           [status, str(result), round(time.time(),2), jobID])
+            with self._finished:
+                self._finished.notify_all()
+            job = self.status(jobID)
+            for listener in self._listeners:
+                try:
+                    listener(job)
+                except Exception as e:
+                    sys.stderr.write("job listener failed: "+str(e)+'\n')
+
+    def _progressFor(self, job):
+        """
+        Progress callback for a running job
+        """
+        def progress(stage):
+            self._stages[job['ID']] = stage
+            for listener in self._progressListeners:
+                try:
+                    listener(job, stage)
+                except Exception as e:
+                    sys.stderr.write("job listener failed: "+str(e)+'\n')
+        return progress
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Load test of builds, rebuilds and cleans against fake_vagrant
+
+    python3 load_test.py --builds 40 --workers 8 --latency 2 --failure-rate 0.05
+"""
+__author__ = "Simon Rosner"
+__credits__ = ["Simon Rosner"]
+__version__ = "2026.10.18"
+__maintainer__ = "Simon Rosner"
+__email__ = ""
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+import constants
+from metrics import registry
+from vagrant_API import V_API
+from jobs import JobQueue
+
+SERVICE = "testChat"
+BOX = "ubuntu/trusty32"
+OWNER = 78  #Test McTester in testDBBackup.db
+FAKE_VAGRANT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'fake_vagrant', 'vagrant')
+
+def failureCounts(method):
+    """
+    (calls of method which raised, vagrant commands which exited non zero)
+    so far in this process
+    """
+    errors = registry.counter('vmbot_method_errors_total').get((('method', method),), 0)
+    vagrant = sum(registry.counter('vmbot_vagrant_failures_total').values())
+    return errors, vagrant
+
+def runJobs(queue, method, argsList):
+    """
+    Submits one job per args and waits for all of them.
+    Returns wall seconds, the finished jobs, their run times
+    and the (errors, vagrant failures) while they ran
+    """
+    before = failureCounts(method)
+    start = time.time()
+    jobIDs = [queue.submit(method, args) for args in argsList]
+    jobs = [queue.wait(jobID) for jobID in jobIDs]
+    wall = time.time() - start
+    durations = sorted(job['finished'] - job['started'] for job in jobs)
+    after = failureCounts(method)
+    return wall, jobs, durations, (after[0] - before[0], after[1] - before[1])
+
+def summary(wall, jobs, durations, failures):
+    """
+    failed counts every failed job,
+    errors the ones which raised and
+    vagrant_failures the vagrant commands which exited non zero
+    """
+    failed = [job for job in jobs if job['status'] == 'failed']
+    errors, vagrantFailures = failures
+    def percentile(p):
+        if len(durations) == 0:
+            return None
+        return round(durations[min(len(durations) - 1, int(len(durations) * p))], 2)
+    return {'jobs': len(jobs),
+            'failed': len(failed),
+            'errors': errors,
+            'vagrant_failures': vagrantFailures,
+            'wall_seconds': round(wall, 2),
+            'jobs_per_minute': round(len(jobs) / wall * 60, 1) if wall > 0 else None,
+            'p50_seconds': percentile(0.50),
+            'p95_seconds': percentile(0.95)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test against fake_vagrant")
+    parser.add_argument('--builds', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=constants.JOB_WORKERS,
+                        help="jobs run at once")
+    parser.add_argument('--latency', type=float, default=1,
+                        help="seconds each vagrant command takes")
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--failure-rate', type=float, default=0)
+    parser.add_argument('--lines', type=int, default=20,
+                        help="lines of output per vagrant command")
+    parser.add_argument('--output', help="write results to this JSON file")
+    args = parser.parse_args()
+    workDir = tempfile.mkdtemp()
+    os.environ['FAKE_VAGRANT_HOME'] = os.path.join(workDir, 'fake_vagrant')
+    os.environ['FAKE_VAGRANT_LATENCY'] = str(args.latency)
+    os.environ['FAKE_VAGRANT_JITTER'] = str(args.jitter)
+    os.environ['FAKE_VAGRANT_FAILURE_RATE'] = str(args.failure_rate)
+    os.environ['FAKE_VAGRANT_OUTPUT_LINES'] = str(args.lines)
+    constants.VAGRANT = FAKE_VAGRANT
+    constants.VMS_PATH = os.path.join(workDir, 'vms')
+    os.makedirs(constants.VMS_PATH)
+    db = os.path.join(workDir, 'loadDB.db')
+    shutil.copy2("testDBBackup.db", db)
+    v = V_API(SERVICE, db, BOX)
+    v.logsPath = os.path.join(workDir, 'logs')
+    queue = JobQueue(v, args.workers)
+    queue.start()
+    results = {}
+    try:
+        first = v.queryDB("Select max(ID) from VM", [])[0][0]
+        results['build'] = summary(*runJobs(queue, 'buildVM',
+                                            [[OWNER] for i in range(args.builds)]))
+        built = [row[0] for row in v.queryDB("Select ID from VM Where ID > ?", [first])]
+        results['rebuild'] = summary(*runJobs(queue, 'rebuildVM',
+                                              [[VMid] for VMid in built[::2]]))
+        v.queryDB("Update VM set active = 0 Where ID > ?", [first])
+        start = time.time()
+        cleaned = v.cleanVMs()
+        results['clean'] = {'vms': len(cleaned['results']),
+                            'failed': cleaned['failed'],
+                            'wall_seconds': round(time.time() - start, 2)}
+    finally:
+        queue.stop()
+        v.close()
+        shutil.rmtree(workDir)
+    for phase, stats in results.items():
+        print(phase, json.dumps(stats, sort_keys=True))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'time': round(time.time(),2),
+                       'settings': vars(args),
+                       'results': results}, f, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Helpers for querying the event log
+"""
+__author__ = "Simon Rosner"
+__credits__ = ["Simon Rosner"]
+__version__ = "2026.10.18"
+__maintainer__ = "Simon Rosner"
+__email__ = ""
+
+import datetime
+import time
+
+def parseTime(pointInTime):
+    """
+    Returns a UNIX timestamp for
+    a number or numeric string (already a timestamp),
+    an ISO-8601 date or datetime (local time unless it has an offset)
+    or anything dateparser understands, ex: "yesterday".
+    Raises ValueError if the time cannot be understood
+    """
+    if isinstance(pointInTime, (int, float)):
+        return float(pointInTime)
+    text = str(pointInTime).strip()
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    try:
+        parsed = datetime.datetime.fromisoformat(text.replace('Z', '+00:00'))
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        #dateparser is slow to import, only load it when it is needed
+        try:
+            import dateparser
+        except ImportError:
+            raise ValueError("Cannot understand time "+text)
+        parsed = dateparser.parse(text)
+        if parsed is None:
+            raise ValueError("Cannot understand time "+text)
+    if parsed.tzinfo is not None:
+        return parsed.timestamp()
+    return time.mktime(parsed.timetuple()) + parsed.microsecond / 1000000.0
+
+def likePrefix(prefix):
+    """
+    LIKE pattern matching text that starts with prefix,
+    use with ESCAPE '\\'
+    """
+    escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return escaped + '%'
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Counters and latency histograms, exported in Prometheus text format
+"""
+__author__ = "Simon Rosner"
+__credits__ = ["Simon Rosner"]
+__version__ = "2026.10.18"
+__maintainer__ = "Simon Rosner"
+__email__ = ""
+
+import bisect
+import re
+import threading
+from functools import lru_cache
+
+#seconds, from a quick query up to a slow vSphere build
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, 1800)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labelText(labels, extra=None):
+    pairs = list(labels)
+    if extra is not None:
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ''
+    return '{'+','.join(k+'="'+_escape(v)+'"' for k, v in pairs)+'}'
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+#where the table name is found for each kind of statement
+_TABLE = {'select': re.compile(r'\bfrom\s+(\w+)', re.IGNORECASE),
+          'delete': re.compile(r'\bfrom\s+(\w+)', re.IGNORECASE),
+          'insert': re.compile(r'\binto\s+(\w+)', re.IGNORECASE),
+          'update': re.compile(r'^\s*update\s+(?:or\s+\w+\s+)?(\w+)', re.IGNORECASE),
+          'create': re.compile(r'\b(?:table|index)\s+(?:if not exists\s+)?(\w+)', re.IGNORECASE),
+          'alter': re.compile(r'\btable\s+(\w+)', re.IGNORECASE)}
+
+@lru_cache(maxsize=1024)
+def statementKind(query):
+    """
+    Short label for a statement, ex: "select Users".
+    Statements in this code base are fixed strings
+    so there are only so many labels
+    """
+    words = query.split(None, 1)
+    if len(words) == 0:
+        return 'other'
+    kind = words[0].lower()
+    pattern = _TABLE.get(kind)
+    if pattern is None:
+        return kind
+    m = pattern.search(query)
+    if m is None:
+        return kind
+    return kind+' '+m.group(1)
+
+class Registry:
+    def __init__(self):
+        """
+        Holds every metric of the process.
+        Metrics are made on first use,
+        describe gives them help text and buckets
+        """
+        self._lock = threading.Lock()
+        self._kinds = {}    #name -> (kind, help, buckets)
+        self._counters = {}     #name -> {labels: value}
+        self._histograms = {}   #name -> {labels: [bucket counts, sum, count]}
+
+    def describe(self, name, kind, help, buckets=DEFAULT_BUCKETS):
+        """
+        kind is 'counter' or 'histogram'
+        """
+        with self._lock:
+            self._kinds[name] = (kind, help, tuple(buckets))
+
+    def inc(self, name, labels=None, n=1):
+        """
+        Adds n to a counter
+        """
+        key = tuple(sorted((labels or {}).items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + n
+
+    def observe(self, name, labels, value):
+        """
+        Records one value, usually seconds, in a histogram
+        """
+        key = tuple(sorted((labels or {}).items()))
+        buckets = self._kinds.get(name, (None, None, DEFAULT_BUCKETS))[2]
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            entry = series.get(key)
+            if entry is None:
+                entry = [[0] * len(buckets), 0.0, 0]
+                series[key] = entry
+            #counted in the first bucket it fits, made cumulative on export
+            i = bisect.bisect_left(buckets, value)
+            if i < len(buckets):
+                entry[0][i]+= 1
+            entry[1]+= value
+            entry[2]+= 1
+
+    def counter(self, name):
+        """
+        {labels dict as a tuple of pairs: value} for a counter
+        """
+        with self._lock:
+            return dict(self._counters.get(name, {}))
+
+    def histogram(self, name):
+        """
+        {labels: (count, sum)} for a histogram
+        """
+        with self._lock:
+            return dict((k, (v[2], v[1])) for k, v in self._histograms.get(name, {}).items())
+
+    def render(self):
+        """
+        Every metric in Prometheus text format
+        """
+        lines = []
+        with self._lock:
+            names = sorted(set(self._counters) | set(self._histograms))
+            for name in names:
+                kind, help, buckets = self._kinds.get(
+                    name, ('histogram' if name in self._histograms else 'counter',
+                           None, DEFAULT_BUCKETS))
+                if help is not None:
+                    lines.append('# HELP '+name+' '+help)
+                lines.append('# TYPE '+name+' '+kind)
+                for key, value in sorted(self._counters.get(name, {}).items()):
+                    lines.append(name+_labelText(key)+' '+_number(value))
+                for key, (counts, total, count) in sorted(self._histograms.get(name, {}).items()):
+                    cumulative = 0
+                    for le, n in zip(buckets, counts):
+                        cumulative+= n
+                        lines.append(name+'_bucket'+_labelText(key, ('le', _number(le)))
+                                     +' '+str(cumulative))
+                    lines.append(name+'_bucket'+_labelText(key, ('le', '+Inf'))+' '+str(count))
+                    lines.append(name+'_sum'+_labelText(key)+' '+repr(round(total, 6)))
+                    lines.append(name+'_count'+_labelText(key)+' '+str(count))
+        return '\n'.join(lines)+'\n'
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+
+#the process-wide registry
+registry = Registry()
+registry.describe('vmbot_method_calls_total', 'counter', "V_API method calls")
+registry.describe('vmbot_method_errors_total', 'counter', "V_API method calls that raised")
+registry.describe('vmbot_method_seconds', 'histogram', "Time spent in V_API methods")
+registry.describe('vmbot_vagrant_seconds', 'histogram', "Time vagrant commands took, by verb")
+registry.describe('vmbot_vagrant_failures_total', 'counter',
+                  "vagrant commands that exited with an error, by verb")
+registry.describe('vmbot_db_seconds', 'histogram',
+                  "Time spent running statements, by kind and table")
+registry.describe('vmbot_db_errors_total', 'counter', "Statements that failed")
+registry.describe('vmbot_outbox_total', 'counter',
+                  "Chat messages sent, split, joined, uploaded, rate limited or failed, see outbox.py")
+registry.describe('vmbot_dispatch_total', 'counter',
+                  "Chat events and commands seen by the dispatcher, see dispatch.py")
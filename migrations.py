@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Versioned schema upgrades for VMDB.db
+"""
+__author__ = "Simon Rosner"
+__credits__ = ["Simon Rosner"]
+__version__ = "2026.10.18"
+__maintainer__ = "Simon Rosner"
+__email__ = ""
+
+import time
+
+def addColumn(table, column, definition):
+    """
+    Statement adding a column unless the table has it already,
+    sqlite has no Add Column If Not Exists
+    """
+    def statement(c):
+        c.execute("PRAGMA table_info("+table+")")
+        if column not in [row[1] for row in c.fetchall()]:
+            c.execute("Alter Table "+table+" Add Column "+column+" "+definition)
+    return statement
+
+#(version, description, statements)
+#   a statement is SQL or a function run with the cursor
+#   statements must be safe to run against a database
+#   that already has some of their changes
+#   never edit a migration once released, add a new one
+MIGRATIONS = [
+    (1, "Index hot lookups", [
+        #service and serviceID are matched case-insensitively
+        "Create Index If Not Exists ThirdPartyAccount_service "
+        "On ThirdPartyAccount(serviceID COLLATE NOCASE, service COLLATE NOCASE)",
+        "Create Index If Not Exists ThirdPartyAccount_userID "
+        "On ThirdPartyAccount(userID)",
+        "Create Index If Not Exists VM_ownerID On VM(ownerID)",
+        "Create Index If Not Exists Events_timestamp On Events(timestamp)",
+        "Create Index If Not Exists Actors_eventID On Actors(eventID)",
+    ]),
+    (2, "Jobs table", [
+        "Create Table If Not Exists Jobs ("
+        "ID INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "method TEXT NOT NULL, "
+        "args TEXT NOT NULL, "
+        "requester TEXT, "
+        "channel TEXT, "
+        "thread TEXT, "
+        "status TEXT NOT NULL, "
+        "result TEXT, "
+        "created REAL, "
+        "started REAL, "
+        "finished REAL)",
+        "Create Index If Not Exists Jobs_status On Jobs(status)",
+    ]),
+    (3, "Warm pool", [
+        #1 for built VMs waiting to be claimed, see warm_pool.py
+        addColumn("VM", "pooled", "INTEGER"),
+        "Create Index If Not Exists VM_pooled On VM(pooled, box)",
+    ]),
+    (4, "VM state from vagrant", [
+        #one row per machine in vagrant global-status, see reconciler.py
+        "Create Table If Not Exists VMState ("
+        "directory TEXT PRIMARY KEY, "
+        "VMid INTEGER, "
+        "machineID TEXT, "
+        "provider TEXT, "
+        "state TEXT, "
+        "seen REAL)",
+        "Create Index If Not Exists VMState_VMid On VMState(VMid)",
+    ]),
+    (5, "Index events by actor", [
+        "Create Index If Not Exists Actors_actorID On Actors(actorID, eventID)",
+    ]),
+]
+
+def currentVersion(pool):
+    """
+    Highest migration applied to the database
+    """
+    pool.execute("Create Table If Not Exists schema_version ("
+                 "version INTEGER PRIMARY KEY, "
+                 "description TEXT, "
+                 "applied REAL)", [])
+    rows = pool.execute("Select max(version) from schema_version", [])
+    return rows[0][0] or 0
+
+def upgrade(pool, migrations=MIGRATIONS):
+    """
+    Applies every migration newer than the database,
+    each in its own transaction.
+    Returns the list of versions applied
+    """
+    applied = []
+    if currentVersion(pool) >= migrations[-1][0]:
+        return applied
+    for version, description, statements in migrations:
+        with pool.transaction() as c:
+            #another process may have got here first
+            c.execute("Select count(*) from schema_version Where version = ?",
+                      [version])
+            if c.fetchone()[0] > 0:
+                continue
+            for statement in statements:
+                if callable(statement):
+                    statement(c)
+                else:
+                    c.execute(statement)
+            c.execute("Insert into schema_version(version, description, applied) "
+                      "Values(?,?,?)", [version, description, round(time.time(),2)])
+        applied.append(version)
+    return applied
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""
+Outgoing chat messages, sent from one thread within the service's rate limits
+"""
+__author__ = "Simon Rosner"
+__credits__ = ["Simon Rosner"]
+__version__ = "2026.10.18"
+__maintainer__ = "Simon Rosner"
+__email__ = ""
+
+import sys
+import threading
+import time
+from collections import deque
+import metrics
+
+FENCE = '```'
+
+def splitText(text, maxChars):
+    """
+    Splits text into chunks of at most maxChars,
+    between lines where it can.
+    A code block cut in two is closed and opened again
+    """
+    if len(text) <= maxChars:
+        return [text]
+    #room to close and reopen a code block
+    limit = maxChars - 2 * (len(FENCE) + 1)
+    pieces = []
+    for line in text.split('\n'):
+        while len(line) > limit:
+            pieces.append(line[:limit])
+            line = line[limit:]
+        pieces.append(line)
+    chunks = []
+    current = []
+    size = 0
+    for piece in pieces:
+        if len(current) > 0 and size + 1 + len(piece) > limit:
+            chunks.append('\n'.join(current))
+            current = []
+            size = 0
+        size+= len(piece) + (1 if len(current) > 0 else 0)
+        current.append(piece)
+    if len(current) > 0:
+        chunks.append('\n'.join(current))
+    inFence = False
+    for i, chunk in enumerate(chunks):
+        opened = inFence
+        inFence = inFence != (chunk.count(FENCE) % 2 == 1)
+        if opened:
+            chunk = FENCE+'\n'+chunk
+        if inFence:
+            chunk+= '\n'+FENCE
+        chunks[i] = chunk
+    return chunks
+
+class _Channel:
+    def __init__(self, burst):
+        """
+        Token bucket and waiting messages of one channel
+        """
+        self.tokens = burst
+        self.refilled = time.monotonic()
+        self.pausedUntil = 0    #set from Retry-After
+        self.messages = deque()
+
+class Outbox:
+    def __init__(self, apiCall, rate=1.0, burst=3, maxChars=3500,
+                 snippetChars=12000, coalesce=0.25, maxAttempts=3):
+        """
+        Sends messages through apiCall(method, **kwargs),
+        ex: SlackClient.api_call, from a background thread.
+        Requires the api call,
+        the messages per second each channel may get,
+        the messages a quiet channel may get at once,
+        the longest message, longer ones are split,
+        the longest text split into messages, longer text is uploaded as a file,
+        the seconds a message waits for more text to the same thread
+        and the tries a message gets if the call raises
+        """
+        self.apiCall = apiCall
+        self.rate = rate
+        self.burst = burst
+        self.maxChars = maxChars
+        self.snippetChars = snippetChars
+        self.coalesce = coalesce
+        self.maxAttempts = maxAttempts
+        self._cond = threading.Condition()
+        self._channels = {}     #channel -> _Channel
+        self._shown = {}    #key -> ts of the message show keeps updated, None until posted
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        """
+        Starts sending in the background
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name="outbox",
+                                            daemon=True)
+            self._thread.start()
+
+    def _channel(self, channel):
+        ch = self._channels.get(channel)
+        if ch is None:
+            ch = _Channel(self.burst)
+            self._channels[channel] = ch
+        return ch
+
+    def _message(self, kind, channel, text, thread, key=None):
+        return {'kind': kind, 'channel': channel, 'text': text, 'thread': thread,
+                'key': key, 'queued': time.monotonic(), 'attempts': 0}
+
+    def post(self, channel, text, thread=None):
+        """
+        Queues text for a channel or thread.
+        Joined to the message before it if that one is
+        for the same thread and has not been sent yet
+        """
+        text = str(text)
+        with self._cond:
+            ch = self._channel(channel)
+            if len(text) > self.snippetChars:
+                ch.messages.append(self._message('upload', channel, text, thread))
+                metrics.registry.inc('vmbot_outbox_total', {'event': 'snippet'})
+            else:
+                chunks = splitText(text, self.maxChars)
+                last = ch.messages[-1] if len(ch.messages) > 0 else None
+                if (len(chunks) == 1 and last is not None
+                        and last['kind'] == 'post' and last['thread'] == thread
+                        and len(last['text']) + 1 + len(text) <= self.maxChars):
+                    last['text']+= '\n'+text
+                    metrics.registry.inc('vmbot_outbox_total', {'event': 'coalesced'})
+                else:
+                    for chunk in chunks:
+                        ch.messages.append(self._message('post', channel, chunk, thread))
+                    if len(chunks) > 1:
+                        metrics.registry.inc('vmbot_outbox_total', {'event': 'split'})
+            self._cond.notify()
+
+    def show(self, key, channel, text, thread=None):
+        """
+        Keeps one message per key showing the latest text,
+        ex: a job's progress. The first call posts it,
+        later ones edit it. Texts not yet sent are replaced
+        """
+        text = str(text)[:self.maxChars]
+        with self._cond:
+            ch = self._channel(channel)
+            for message in ch.messages:
+                if message['kind'] == 'show' and message['key'] == key:
+                    message['text'] = text
+                    metrics.registry.inc('vmbot_outbox_total', {'event': 'coalesced'})
+                    return
+            if key not in self._shown:
+                self._shown[key] = None
+            ch.messages.append(self._message('show', channel, text, thread, key))
+            self._cond.notify()
+
+    def forget(self, key):
+        """
+        Stops updating the message for key
+        and drops its unsent text
+        """
+        with self._cond:
+            self._shown.pop(key, None)
+            for ch in self._channels.values():
+                for message in list(ch.messages):
+                    if message['kind'] == 'show' and message['key'] == key:
+                        ch.messages.remove(message)
+
+    def pending(self):
+        """
+        Number of messages not sent yet
+        """
+        with self._cond:
+            return sum(len(ch.messages) for ch in self._channels.values())
+
+    def _next(self, now):
+        """
+        (channel, message, None) to send now
+        or (None, None, seconds until one can be sent),
+        seconds being None if nothing is waiting.
+        Of the channels with a token, the oldest message goes first
+        """
+        best = None
+        wait = None
+        for channel, ch in self._channels.items():
+            if len(ch.messages) == 0:
+                continue
+            ch.tokens = min(self.burst, ch.tokens + (now - ch.refilled) * self.rate)
+            ch.refilled = now
+            head = ch.messages[0]
+            readyAt = max(ch.pausedUntil, now + (1 - ch.tokens) / self.rate)
+            if not self._stopping:
+                readyAt = max(readyAt, head['queued'] + self.coalesce)
+            if readyAt <= now:
+                if best is None or head['queued'] < best[1]['queued']:
+                    best = (channel, head)
+            elif wait is None or readyAt - now < wait:
+                wait = readyAt - now
+        if best is not None:
+            return best[0], best[1], None
+        return None, None, wait
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    channel, message, wait = self._next(time.monotonic())
+                    if channel is not None:
+                        break
+                    if self._stopping and wait is None:
+                        return
+                    self._cond.wait(wait)
+                ch = self._channels[channel]
+                ch.messages.popleft()
+                ch.tokens-= 1
+            self._send(ch, message)
+
+    def _call(self, message):
+        """
+        Makes the api call for a message and returns its result
+        """
+        thread = {} if message['thread'] is None else {'thread_ts': message['thread']}
+        if message['kind'] == 'upload':
+            lines = message['text'].count('\n') + 1
+            return self.apiCall("files.upload",
+                                channels=message['channel'],
+                                content=message['text'],
+                                filetype='text',
+                                title="VMbot output",
+                                initial_comment="Too long for a message, "+str(lines)+" lines",
+                                **thread)
+        if message['kind'] == 'show':
+            with self._cond:
+                if message['key'] not in self._shown:
+                    return None     #forgotten while waiting
+                ts = self._shown[message['key']]
+            if ts is not None:
+                return self.apiCall("chat.update",
+                                    channel=message['channel'],
+                                    ts=ts,
+                                    text=message['text'])
+        return self.apiCall("chat.postMessage",
+                            channel=message['channel'],
+                            text=message['text'],
+                            **thread)
+
+    def _send(self, ch, message):
+        try:
+            result = self._call(message)
+        except Exception as e:
+            message['attempts']+= 1
+            if message['attempts'] < self.maxAttempts:
+                self._retry(ch, message, 1)
+            else:
+                metrics.registry.inc('vmbot_outbox_total', {'event': 'failed'})
+                sys.stderr.write("outbox gave up on a message: "+str(e)+'\n')
+            return
+        if result is None:
+            return
+        if result.get("ok"):
+            metrics.registry.inc('vmbot_outbox_total', {'event': 'sent'})
+            if message['kind'] == 'show':
+                with self._cond:
+                    if self._shown.get(message['key'], 0) is None:
+                        self._shown[message['key']] = result.get("ts")
+            return
+        if result.get("error") == "ratelimited":
+            headers = result.get("headers") or {}
+            retryAfter = headers.get("Retry-After") or headers.get("retry-after") or 1
+            metrics.registry.inc('vmbot_outbox_total', {'event': 'ratelimited'})
+            self._retry(ch, message, float(retryAfter))
+            return
+        metrics.registry.inc('vmbot_outbox_total', {'event': 'failed'})
+        sys.stderr.write("outbox: "+message['kind']+" to "+str(message['channel'])
+                         +" failed: "+str(result.get("error"))+'\n')
+
+    def _retry(self, ch, message, seconds):
+        """
+        Puts a message back at the front of its channel,
+        which waits the given seconds
+        """
+        with self._cond:
+            ch.pausedUntil = time.monotonic() + seconds
+            newer = [m for m in ch.messages
+                     if message['kind'] == 'show' and m['kind'] == 'show'
+                     and m['key'] == message['key']]
+            if len(newer) == 0:
+                ch.messages.appendleft(message)
+            self._cond.notify()
+
+    def close(self, timeout=10):
+        """
+        Sends what is queued, for up to timeout seconds, and stops
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Cached responses for read only web_API endpoints
+"""
+__author__ = "Simon Rosner"
+__credits__ = ["Simon Rosner"]
+__version__ = "2026.10.18"
+__maintainer__ = "Simon Rosner"
+__email__ = ""
+
+import hashlib
+import threading
+import time
+
+class ReadCache:
+    def __init__(self, ttl=10, maxEntries=64):
+        """
+        Keeps one response body per key along with
+        the V_API generation it was made at.
+        Requires the seconds an entry may be used for,
+        which covers writes made by other processes,
+        and the most entries kept
+        """
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self._lock = threading.Lock()
+        self._entries = {}  #key -> (generation, made, etag, body)
+
+    def get(self, key, generation):
+        """
+        (etag, body) if the entry for key was made
+        at generation and has not expired, otherwise None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry[0] != generation:
+            return None
+        if time.time() - entry[1] > self.ttl:
+            return None
+        return entry[2], entry[3]
+
+    def put(self, key, generation, body):
+        """
+        Stores body, in bytes, and returns (etag, body).
+        The etag is a hash of the body so
+        callers keep getting 304s across generations
+        as long as the data is the same
+        """
+        etag = hashlib.sha1(body).hexdigest()
+        with self._lock:
+            if key not in self._entries and len(self._entries) >= self.maxEntries:
+                oldest = min(self._entries, key=lambda k: self._entries[k][1])
+                del self._entries[oldest]
+            self._entries[key] = (generation, time.time(), etag, body)
+        return etag, body
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Keeps the VMState table in line with what vagrant reports
+"""
+__author__ = "Simon Rosner"
+__credits__ = ["Simon Rosner"]
+__version__ = "2026.10.18"
+__maintainer__ = "Simon Rosner"
+__email__ = ""
+
+import os
+import subprocess
+import sys
+import threading
+import time
+
+def parseGlobalStatus(output):
+    """
+    Returns a dict for each machine in the output of
+    vagrant global-status --machine-readable
+    with the keys id, provider, directory and state
+    """
+    machines = []
+    machine = None
+    keys = {'machine-id': 'id',
+            'provider-name': 'provider',
+            'machine-home': 'directory',
+            'state': 'state'}
+    for line in output.splitlines():
+        #timestamp,target,type,data
+        fields = line.split(',', 3)
+        if len(fields) < 4 or fields[2] not in keys:
+            continue
+        value = fields[3].replace('%!(VAGRANT_COMMA)', ',').strip()
+        if fields[2] == 'machine-id':
+            machine = {'id': value, 'provider': None,
+                       'directory': None, 'state': None}
+            machines.append(machine)
+        elif machine is not None:
+            machine[keys[fields[2]]] = value
+    return machines
+
+class Reconciler:
+    def __init__(self, v, interval=300, vagrant=None, timeout=120, archiveInterval=None):
+        """
+        Runs vagrant global-status in the background
+        and records every machine's state in VMState.
+        Old events are archived from the same loop.
+        Requires a V_API,
+        the seconds between runs,
+        the vagrant executable (the V_API's by default),
+        the max seconds a run may take
+        and the seconds between archives of old events, None for never
+        """
+        self.v = v
+        self.interval = interval
+        self.vagrant = vagrant or v.vagrant
+        self.timeout = timeout
+        self.archiveInterval = archiveInterval
+        self.lastRun = None     #time of the last successful run
+        self.lastArchive = None     #time archiveEvents last ran
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        """
+        Starts reconciling in the background
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name="reconciler",
+                                            daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopping:
+            try:
+                self.reconcile()
+            except Exception as e:
+                sys.stderr.write("reconcile failed: "+str(e)+'\n')
+            try:
+                self.archiveIfDue()
+            except Exception as e:
+                sys.stderr.write("archive failed: "+str(e)+'\n')
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def archiveIfDue(self):
+        """
+        Moves events past their retention to the archive
+        if archiveInterval has passed since the last time.
+        Returns the number moved, or None if it was not due
+        """
+        if self.archiveInterval is None:
+            return None
+        if self.lastArchive is not None and time.time() - self.lastArchive < self.archiveInterval:
+            return None
+        self.lastArchive = time.time()
+        return self.v.archiveEvents()
+
+    def wake(self):
+        """
+        Reconciles now instead of at the next interval
+        """
+        self._wake.set()
+
+    def globalStatus(self):
+        """
+        Output of one vagrant global-status run
+        """
+        command = [self.vagrant, 'global-status', '--machine-readable']
+        return subprocess.run(command,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL,
+                              universal_newlines=True,
+                              timeout=self.timeout,
+                              check=True).stdout
+
+    def reconcile(self, output=None):
+        """
+        Replaces VMState with the machines vagrant knows of.
+        Machines in a VM's folder are matched to the VM.
+        Returns the number of machines recorded
+        """
+        if output is None:
+            output = self.globalStatus()
+        machines = parseGlobalStatus(output)
+        seen = round(time.time(),2)
+        rows = []
+        for machine in machines:
+            if machine['directory'] is None:
+                continue
+            rows.append([machine['directory'], self.vmFor(machine['directory']),
+                         machine['id'], machine['provider'], machine['state'], seen])
+        insert = "Insert or Replace into VMState"
+        insert+= "(directory, VMid, machineID, provider, state, seen) "
+        insert+= "Values(?,?,?,?,?,?)"
+        #swapped at once so readers never see half a snapshot
+        with self.v.pool.transaction() as c:
+            c.execute("Delete from VMState")
+            c.executemany(insert, rows)
+        self.v.changed()
+        self.lastRun = seen
+        return len(rows)
+
+    def vmFor(self, directory):
+        """
+        VM ID for a machine's folder or None
+        if the folder is not one of ours
+        """
+        directory = os.path.normpath(directory)
+        name = os.path.basename(directory)
+        if os.path.dirname(directory) != os.path.normpath(self.v.vmsPath):
+            return None
+        if not name.isdigit():
+            return None
+        return int(name)
+
+    def close(self):
+        """
+        Stops reconciling
+        """
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
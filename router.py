@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Table driven command router for chat bots
+"""
+__author__ = "Simon Rosner"
+__credits__ = ["Simon Rosner"]
+__version__ = "2026.10.18"
+__maintainer__ = "Simon Rosner"
+__email__ = ""
+
+import re
+
+#a pattern's leading literal word, or a group of alternative words,
+#   followed by a space or word boundary
+_LEADING = re.compile(r'^(?:\(((?:[a-z]+\|)*[a-z]+)\)|([a-z]+))(?: |\\s|\\b)')
+#first word of a command
+_FIRST = re.compile(r'[a-z]+')
+
+class Route:
+    def __init__(self, index, pattern, handler, name, usage, description, adminOnly):
+        """
+        One command: a compiled pattern, the function that handles it
+        and the help text shown for it
+        """
+        self.index = index  #registration order, earlier routes win
+        self.pattern = re.compile(pattern, re.I)
+        self.handler = handler
+        self.name = name
+        self.usage = usage
+        self.description = description
+        self.adminOnly = adminOnly
+
+def leadingWords(pattern):
+    """
+    Returns the words a pattern must start with
+    or None if it can start with anything
+    """
+    m = _LEADING.match(pattern.lower())
+    if m is None:
+        return None
+    return (m.group(1) or m.group(2)).split('|')
+
+class Router:
+    def __init__(self):
+        """
+        Routes are tried in the order they are added.
+        Only routes whose first word matches the command's
+        first word, and routes that may start with anything,
+        are tried at all
+        """
+        self.routes = []
+        self._byWord = {}   #first word -> routes
+        self._anyWord = []  #routes with no literal first word
+        self._candidates = {}   #first word -> merged, ordered routes
+
+    def add(self, pattern, handler, name=None, usage=None, description=None,
+            adminOnly=False, keywords=None):
+        """
+        Registers handler(ctx, match) for pattern.
+        keywords overrides the first words read from the pattern
+        """
+        route = Route(len(self.routes), pattern, handler,
+                      name, usage, description, adminOnly)
+        self.routes.append(route)
+        words = keywords or leadingWords(pattern)
+        if words is None:
+            self._anyWord.append(route)
+        else:
+            for word in words:
+                self._byWord.setdefault(word.lower(), []).append(route)
+        self._candidates = {}
+        return route
+
+    def route(self, pattern, **kwargs):
+        """
+        Decorator form of add
+        """
+        def register(handler):
+            self.add(pattern, handler, **kwargs)
+            return handler
+        return register
+
+    def candidates(self, text):
+        """
+        Routes which could match text, in registration order
+        """
+        m = _FIRST.match(text.lower())
+        word = m.group(0) if m is not None else ''
+        routes = self._candidates.get(word)
+        if routes is None:
+            routes = sorted(self._byWord.get(word, []) + self._anyWord,
+                            key=lambda r: r.index)
+            self._candidates[word] = routes
+        return routes
+
+    def dispatch(self, text):
+        """
+        Returns (route, match) for the first route
+        matching text, or (None, None)
+        """
+        for route in self.candidates(text):
+            match = route.pattern.match(text)
+            if match is not None:
+                return route, match
+        return None, None
+
+    def helpWith(self, com = None):
+        """
+        Return helptext for the routes:
+        standard commands when com is None,
+        admin commands when com is 'admin',
+        otherwise commands whose name contains com
+        """
+        helpText = ''
+        for r in self.routes:
+            if r.usage is None:
+                continue
+            if com == None:
+                show = r.adminOnly == False
+            elif com.lower() == 'admin':
+                show = r.adminOnly == True
+            else:
+                show = com.lower() in r.name
+            if show:
+                helpText+= "*"+r.usage+"*\n\t"+r.description+"\n"
+        return helpText
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import unittest
 from vagrant_api_tests import *
+from bot_tests import *
 
 def test_suite():
     suite = unittest.TestSuite()
@@ -8,13 +9,31 @@ def test_suite():
     #Do this for each test class
     #suite.addTest(unittest.makeSuite(TEST))
     suite.addTest(unittest.makeSuite(TestAdminChecks))
-    #suite.addTest(unittest.makeSuite(TestBuild))
+    suite.addTest(unittest.makeSuite(TestArchive))
+    suite.addTest(unittest.makeSuite(TestAuthCache))
+    suite.addTest(unittest.makeSuite(TestBatch))
+    suite.addTest(unittest.makeSuite(TestBuild))
     suite.addTest(unittest.makeSuite(TestClaims))
-    #suite.addTest(unittest.makeSuite(TestClean))
+    suite.addTest(unittest.makeSuite(TestClean))
+    suite.addTest(unittest.makeSuite(TestDispatch))
+    suite.addTest(unittest.makeSuite(TestEngine))
     suite.addTest(unittest.makeSuite(TestIdentity))
+    suite.addTest(unittest.makeSuite(TestIPPool))
+    suite.addTest(unittest.makeSuite(TestJobs))
     suite.addTest(unittest.makeSuite(TestLogging))
+    suite.addTest(unittest.makeSuite(TestMetrics))
+    suite.addTest(unittest.makeSuite(TestMigrations))
+    suite.addTest(unittest.makeSuite(TestOutbox))
+    suite.addTest(unittest.makeSuite(TestRTM))
+    suite.addTest(unittest.makeSuite(TestReadCache))
+    suite.addTest(unittest.makeSuite(TestReconciler))
+    suite.addTest(unittest.makeSuite(TestRouter))
+    suite.addTest(unittest.makeSuite(TestRunner))
     suite.addTest(unittest.makeSuite(TestSecurity))
+    suite.addTest(unittest.makeSuite(TestTemplates))
+    suite.addTest(unittest.makeSuite(TestUserDirectory))
     suite.addTest(unittest.makeSuite(TestUtilities))
+    suite.addTest(unittest.makeSuite(TestWarmPool))
     runner = unittest.TextTestRunner()
     print(runner.run(suite))
 
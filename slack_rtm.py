@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Event driven connection to the Slack RTM API, on asyncio.
+Events are handed over as they arrive instead of being polled for.
+The websocket itself is websocket-client's, run on executor threads
+"""
+__author__ = "Simon Rosner"
+__credits__ = ["Simon Rosner"]
+__version__ = "2026.10.18"
+__maintainer__ = "Simon Rosner"
+__email__ = ""
+
+import asyncio
+import json
+import random
+import sys
+import time
+import websocket
+
+class ConnectionClosed(Exception):
+    pass
+
+def connect(url, timeout=10):
+    """
+    Opens a websocket to a ws:// or wss:// url. Blocks.
+    Reads wait as long as it takes once connected,
+    RTMTransport pings a quiet connection itself
+    """
+    socket = websocket.create_connection(url, timeout=timeout)
+    socket.settimeout(None)
+    return socket
+
+def receiveText(socket):
+    """
+    Next text message. Blocks.
+    websocket-client answers pings on the way,
+    raises ConnectionClosed when the server closes
+    """
+    try:
+        message = socket.recv()
+    except websocket.WebSocketException as e:
+        raise ConnectionClosed(str(e) or "connection closed")
+    #a close frame reads as an empty message
+    if message == '':
+        raise ConnectionClosed("closed by server")
+    return message
+
+def closeSocket(socket):
+    """
+    Says goodbye and closes, waking a thread blocked in receiveText
+    """
+    try:
+        socket.send_close()
+    except (websocket.WebSocketException, OSError):
+        pass
+    socket.abort()
+    socket.shutdown()
+
+class RTMTransport:
+    def __init__(self, connectURL, onEvent, pingInterval=30,
+                 minBackoff=1, maxBackoff=60):
+        """
+        Keeps a connection to Slack's RTM API and calls
+        onEvent(event) for every event as soon as it arrives.
+        Requires connectURL(), returning a fresh websocket url
+        (the url from rtm.connect, each is only good once),
+        the handler, which should not block,
+        the seconds of silence before the connection is pinged
+        and the least and most seconds waited between reconnects
+        """
+        self.connectURL = connectURL
+        self.onEvent = onEvent
+        self.pingInterval = pingInterval
+        self.minBackoff = minBackoff
+        self.maxBackoff = maxBackoff
+        self.connections = 0    #successful connections so far
+        self._stopping = None
+        self._socket = None
+
+    async def run(self):
+        """
+        Connects, reads events and reconnects with
+        exponential backoff until stop is called
+        """
+        self._stopping = asyncio.Event()
+        backoff = self.minBackoff
+        loop = asyncio.get_running_loop()
+        while not self._stopping.is_set():
+            try:
+                #rtm.connect is a blocking web API call
+                url = await loop.run_in_executor(None, self.connectURL)
+                self._socket = await loop.run_in_executor(None, connect, url)
+                self.connections+= 1
+                if await self._read(self._socket):
+                    backoff = self.minBackoff
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                sys.stderr.write("RTM connection lost: "+str(e)+'\n')
+            finally:
+                if self._socket is not None:
+                    await loop.run_in_executor(None, closeSocket, self._socket)
+                    self._socket = None
+            if self._stopping.is_set():
+                break
+            #jittered so many bots do not reconnect in step
+            delay = backoff * (0.5 + random.random() / 2)
+            backoff = min(self.maxBackoff, backoff * 2)
+            try:
+                await asyncio.wait_for(self._stopping.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _read(self, socket):
+        """
+        Reads events until the connection ends.
+        Returns True if Slack said hello, meaning the
+        connection worked and backoff starts over
+        """
+        loop = asyncio.get_running_loop()
+        helloed = False
+        pingID = 0
+        lastHeard = time.monotonic()
+        stopping = asyncio.ensure_future(self._stopping.wait())
+        receive = None
+        try:
+            while True:
+                #kept across pings, the executor thread
+                #   stays blocked in the read until a message comes
+                if receive is None:
+                    receive = loop.run_in_executor(None, receiveText, socket)
+                done, waiting = await asyncio.wait([receive, stopping],
+                                                   timeout=self.pingInterval,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if stopping in done:
+                    return helloed
+                if receive not in done:
+                    if time.monotonic() - lastHeard > 2 * self.pingInterval:
+                        raise ConnectionClosed("no answer to ping")
+                    pingID+= 1
+                    await loop.run_in_executor(None, socket.send,
+                                               json.dumps({'id': pingID, 'type': 'ping'}))
+                    continue
+                message = receive.result()
+                receive = None
+                lastHeard = time.monotonic()
+                try:
+                    event = json.loads(message)
+                except ValueError:
+                    continue
+                kind = event.get('type')
+                if kind == 'hello':
+                    helloed = True
+                elif kind == 'goodbye':
+                    #Slack is about to close this connection
+                    return helloed
+                elif kind != 'pong':
+                    self.onEvent(event)
+        finally:
+            stopping.cancel()
+            if receive is not None:
+                receive.cancel()
+
+    def stop(self):
+        """
+        Ends run. Call from the event loop's thread,
+        or through loop.call_soon_threadsafe
+        """
+        if self._stopping is not None:
+            self._stopping.set()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Cached directory of chat service users
+"""
+__author__ = "Simon Rosner"
+__credits__ = ["Simon Rosner"]
+__version__ = "2026.10.18"
+__maintainer__ = "Simon Rosner"
+__email__ = ""
+
+import sys
+import threading
+import time
+
+class UserDirectory:
+    def __init__(self, fetchPage, ttl=3600, fetchOne=None):
+        """
+        Keeps every chat user in memory, indexed by id.
+        Requires fetchPage(cursor), returning (members, nextCursor)
+        with an empty nextCursor on the last page,
+        the seconds before the directory is considered stale
+        and optionally fetchOne(uid), used for users
+        who joined since the last refresh
+        """
+        self.fetchPage = fetchPage
+        self.fetchOne = fetchOne
+        self.ttl = ttl
+        self._users = {}    #id -> member dict
+        self._loaded = 0    #time of last full refresh
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def refresh(self):
+        """
+        Reloads every page of users and swaps them in at once
+        """
+        users = {}
+        cursor = ''
+        while True:
+            members, cursor = self.fetchPage(cursor)
+            for member in members:
+                users[member["id"]] = member
+            if not cursor:
+                break
+        with self._lock:
+            self._users = users
+            self._loaded = time.time()
+        return len(users)
+
+    def refreshAsync(self):
+        """
+        Refreshes in a background thread
+        unless a refresh is already running
+        """
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._backgroundRefresh,
+                         name="user-directory",
+                         daemon=True).start()
+
+    def _backgroundRefresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            sys.stderr.write("user directory refresh failed: "+str(e)+'\n')
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def isStale(self):
+        return time.time() - self._loaded > self.ttl
+
+    def get(self, uid):
+        """
+        Returns the member dict for a user id or None.
+        A stale directory is refreshed in the background
+        and keeps answering from what it has meanwhile
+        """
+        if self.isStale():
+            self.refreshAsync()
+        member = self._users.get(uid)
+        if member is None and self.fetchOne is not None:
+            member = self.fetchOne(uid)
+            if member is not None:
+                with self._lock:
+                    self._users[uid] = member
+        return member
+
+    def realName(self, uid):
+        """
+        Returns a user's real name or None
+        """
+        member = self.get(uid)
+        if member is None:
+            return None
+        return member.get("real_name") or member.get("profile", {}).get("real_name")
@@ -9,6 +9,8 @@ __maintainer__ = "Simon Rosner"
 __email__ = ""
 
 error_log_file = "custom_command_error.log"
+#files in the templates folder which are Vagrantfile templates
+TEMPLATE_EXTENSIONS = ('.j2', '.tmp')
 
 import subprocess
 import datetime
@@ -16,10 +18,47 @@ import sqlite3
 import time
 import os
 import shutil
+import threading
+import uuid
+import constants
+from db_pool import getPool, closePool
+from audit_log import getAuditBuffer, closeAuditBuffer
+import migrations
+import vagrant_runner
+import metrics
+from ip_pool import IPPool, PoolExhausted
+from auth_cache import AuthCache, MISSING, userKey, serviceKey
+from blocklist import BlockMatcher
+from log_query import parseTime, likePrefix
+from event_archive import archiveEvents, readEvents
 #TODO revisit multiproccessing implementation
 #import multiproccesing
-from jinja2 import Environment, FileSystemLoader, Template
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 from functools import wraps
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+#compiled templates are shared by every V_API using the same folder
+_templateEnvironments = {}
+_templateLock = threading.Lock()
+
+def templateEnvironment(templatesPath, cachePath):
+    """
+    Returns the jinja2 Environment for a templates folder.
+    Templates are compiled once, bytecode is kept in cachePath
+    and a template is recompiled when its file changes
+    """
+    with _templateLock:
+        env = _templateEnvironments.get(templatesPath)
+        if env is None:
+            if not os.path.exists(cachePath):
+                os.makedirs(cachePath, exist_ok=True)
+            env = Environment(loader=FileSystemLoader(templatesPath),
+                              bytecode_cache=FileSystemBytecodeCache(cachePath),
+                              auto_reload=True,
+                              keep_trailing_newline=True)
+            _templateEnvironments[templatesPath] = env
+        return env
 
 class V_API:
     def __init__(self, service, db, defaultBox):
@@ -35,10 +74,31 @@ class V_API:
         self.myPath = os.path.abspath(os.path.realpath(__file__))
         self.parentPath = os.path.dirname(self.myPath)
         self.templatesPath = os.path.join(self.parentPath,'templates')
-        blockedCommands = self.queryDB("Select * From BlockedCommands", [])
-        self.blocked_commands = []  #list of blocked commands
-        for b in blockedCommands:
-            self.blocked_commands.append(b[0].lower())
+        self.logsPath = os.path.join(self.parentPath,'logs')   #full command output
+        self.archivePath = os.path.join(self.parentPath,'archive')   #old events
+        self.vmsPath = constants.VMS_PATH or self.parentPath    #one folder per VM
+        self.vagrant = constants.VAGRANT    #vagrant executable
+        self.templates = templateEnvironment(
+            self.templatesPath,
+            os.path.join(self.parentPath,'.template_cache'))
+        self.pool = getPool(db)    #shared connections to the database
+        migrations.upgrade(self.pool)
+        #events are written in batches, see logEvent
+        self.audit = getAuditBuffer(self.pool,
+                                    constants.AUDIT_BATCH_SIZE,
+                                    constants.AUDIT_FLUSH_INTERVAL,
+                                    constants.AUDIT_MAX_ATTEMPTS)
+        self._blocked = None    #BlockMatcher of blocked commands, see getBlockMatcher
+        self._blockedLock = threading.Lock()
+        self._strict = threading.local()    #see strict
+        self._runs = threading.local()  #see vagrantRuns
+        self.generation = 0     #bumped whenever data changes, see changed
+        #who is an admin, invalidated by the methods that change it
+        self.auth = AuthCache(constants.AUTH_CACHE_SIZE, constants.AUTH_CACHE_SECONDS)
+        self._generationLock = threading.Lock()
+        #addresses for new VMs, see reserveIP
+        self.ips = IPPool(constants.IP_POOLS, constants.IP_RESERVED_HOSTS)
+        self.ips.load(row[0] for row in self.queryDB("Select ip from VM", []))
 
     def _returnToDir(the_func):
         """
@@ -54,8 +114,10 @@ class V_API:
             try:
                 output = the_func(*args, **kwargs)
             except:
-                pass
-            os.chdir(lastPath)
+                if args[0].isStrict():
+                    raise
+            finally:
+                os.chdir(lastPath)
             if output != None:
                 return output
         return wrapTheFunction
@@ -64,6 +126,7 @@ class V_API:
         """
         Records activity as generic records
         with the user noted as "System"
+        and counts and times the call, see metrics.py
         """
         @wraps(the_func)
         def wrapper(*args, **kwargs):
@@ -73,37 +136,81 @@ class V_API:
             #   Kind of a hack but it works
             args[0].logEvent(eventDescription,[0])
             output = None
+            labels = {'method': the_func.__name__}
+            metrics.registry.inc('vmbot_method_calls_total', labels)
+            start = time.perf_counter()
             try:
                 output = the_func(*args, **kwargs)
             except:
-                pass
+                metrics.registry.inc('vmbot_method_errors_total', labels)
+                if args[0].isStrict():
+                    raise
+            finally:
+                metrics.registry.observe('vmbot_method_seconds', labels,
+                                         time.perf_counter() - start)
             if output != None:
                 return output
         return wrapper
+
+    def _mutates(the_func):
+        """
+        Marks a method which changes data.
+        The generation is bumped when it returns
+        so cached reads are made again, see changed
+        """
+        @wraps(the_func)
+        def wrapper(self, *args, **kwargs):
+            try:
+                return the_func(self, *args, **kwargs)
+            finally:
+                self.changed()
+        return wrapper
         
     @_log    
+    @_mutates
     def addBlockedCommand(self, com):
         """
         Adds to the list of commands that
         will not be processed under any circumstances
         """
         self.queryDB("Insert into BlockedCommands(commands) values(?)",[com])
-        self.blocked_commands.append(com.lower())
+        #added to the loaded matcher rather than reloading every entry
+        with self._blockedLock:
+            if self._blocked is not None:
+                self._blocked.add(com)
         
     @_log
     def adminCheck(self, uid):
         """
         Checks if ID is tied to admin user
         """
+        return self._isAdmin(uid)
+
+    def _isAdmin(self, uid):
+        """
+        adminCheck without the event, answered from self.auth when it can
+        """
+        key = userKey(uid)
+        found = self.auth.get(key)
+        if found is not MISSING:
+            return found
+        version = self.auth.version
         adminQuery = "Select Count(*) from Admins "
         adminQuery += "where worksHere = 1 "
-        adminQuery += "and ID like ?"
+        adminQuery += "and ID = ?"
         queryArgs = [uid]
         numValidAdmins = self.queryDB(adminQuery,queryArgs)
         if numValidAdmins[0][0] >= 1:
-            return True
+            isAdmin = True
         else:
-            return False
+            isAdmin = False
+        self._remember(key, isAdmin, version)
+        return isAdmin
+
+    def _remember(self, key, value, version):
+        #nothing read inside a transaction is kept, it may yet be rolled back
+        if not self.pool.connection().in_transaction:
+            self.auth.put(key, value, version)
         
     @_log
     def adminCheckThroughService(self, serviceID):
@@ -111,65 +218,141 @@ class V_API:
         Checks if the serviceID provided
         is tied to an admin user
         """
-        adminQuery = "Select Count(*) from ThirdPartyAccount "
-        adminQuery += "Inner Join Admins on Admins.ID = ThirdPartyAccount.userID "
-        adminQuery += "where worksHere = 1 "
-        adminQuery += "and service like ? "
-        adminQuery += "and serviceId like ?"
-        queryArgs = [self.service, serviceID]
-        numValidAdmins = self.queryDB(adminQuery,queryArgs)
-        if numValidAdmins[0][0] >= 1:
-            return True
-        else:
+        key = serviceKey(serviceID)
+        userID = self.auth.get(key)
+        if userID is MISSING:
+            version = self.auth.version
+            query = "Select userID from ThirdPartyAccount "
+            query+= "where serviceID = ? COLLATE NOCASE "
+            query+= "and service = ? COLLATE NOCASE"
+            queryArgs = [serviceID, self.service]
+            rows = self.queryDB(query,queryArgs)
+            if not isinstance(rows, list):
+                return False
+            userID = rows[0][0] if len(rows) > 0 else None
+            self._remember(key, userID, version)
+        if userID is None:
             return False
+        return self._isAdmin(userID)
+
+    @_log
+    def archiveEvents(self, days=None):
+        """
+        Moves events older than days (constants.EVENT_RETENTION_DAYS
+        by default) to the archive folder, see event_archive.py.
+        getLogsSince still finds them.
+        Returns the number of events moved
+        """
+        if days == None:
+            days = constants.EVENT_RETENTION_DAYS
+        before = round(time.time(),2) - float(days) * 86400
+        #queued events must not jump ahead of the archive
+        self.audit.flush()
+        return archiveEvents(self.pool, self.archivePath, before,
+                             constants.ARCHIVE_BATCH_SIZE)
 
     @_log #may be redundant here
-    def buildThroughService(self, serviceID, box = None):
+    def buildThroughService(self, serviceID, box = None, progress=None):
         """
         Create a new VM through a service
         """
-        return self.buildVM(self.getUserID(serviceID),box);
+        return self.buildVM(self.getUserID(serviceID),box,progress=progress);
 
     #@_log 
-    @_returnToDir
-    def buildVagrantFile(self, VMid):
+    def buildVagrantFile(self, VMid, template=None, ip=None):
         """
-        Uses Jinja2 to build VagrantFile      
+        Uses Jinja2 to build VagrantFile
+        template is the name of a file in the templates folder,
+        constants.VAGRANT_TEMPLATE by default
+        ip is the VM's address, see reserveIP
         """
+        if template == None:
+            template = constants.VAGRANT_TEMPLATE
         hostname = "nyc-vm-d" + str(VMid)
-        #TODO ip generation
-        ip = "xx.xx.x."
+        if ip == None:
+            ip = self.reserveIP(VMid)
         data = {'ip': ip,
                 'id': VMid,
                 'hostname' : hostname}
-        #copy over template files
-        templateFiles = os.listdir(self.templatesPath)
-        targetFolder = os.path.join(self.parentPath,str(VMid))
-        for file in templateFiles:
+        #copy over supporting files, the templates themselves stay behind
+        targetFolder = os.path.join(self.vmsPath,str(VMid))
+        for file in os.listdir(self.templatesPath):
             tempFile = os.path.join(self.templatesPath,file)
+            if file.endswith(TEMPLATE_EXTENSIONS) or not os.path.isfile(tempFile):
+                continue
             shutil.copy2(tempFile,targetFolder)
-        #get text of template file
-        j2Location = os.path.join(self.templatesPath,'Vagrantfile.j2')
-        with open(j2Location, 'r') as tFile:
-            tText=tFile.read()
-        #templatize it
-        template = Template(tText)
-        #fill out template with data
-        rText = template.render(data)
-        #write data into Vagrantfile
-        with open('Vagrantfile', 'w') as vFile:
-            vFile.write(rText)
-        #put new Vagrantfile with other templateFiles
+        #render the compiled template straight into the Vagrantfile
         dest = os.path.join(targetFolder,'Vagrantfile')
-        shutil.move('Vagrantfile',dest)
+        self.templates.get_template(template).stream(data).dump(dest)
         return data
 
+    @_mutates
+    def reserveIP(self, VMid):
+        """
+        Gives a VM an address from the pool
+        unless it already has one, and returns it.
+        Returns None if there is no such VM.
+        VM.ip is UNIQUE, so two processes can never
+        reserve the same address
+        """
+        rows = self.queryDB("Select ip from VM Where VM.ID = ?", [VMid])
+        if len(rows) == 0:
+            return None
+        if rows[0][0] is not None:
+            return rows[0][0]
+        while True:
+            ip = self.ips.allocate()
+            try:
+                self.pool.execute("Update VM set ip = ? "
+                                  "Where VM.ID = ? and ip is null", [ip, VMid])
+            except sqlite3.IntegrityError:
+                #reserved elsewhere since the pool was loaded, leave it marked
+                continue
+            reserved = self.queryDB("Select ip from VM Where VM.ID = ?", [VMid])[0][0]
+            if reserved != ip:
+                #the VM got an address from another caller first
+                self.ips.release(ip)
+            return reserved
+
+    def listTemplates(self):
+        """
+        Names of the Vagrantfile templates that can be built from
+        """
+        return self.templates.list_templates(
+            filter_func=lambda name: name.endswith(TEMPLATE_EXTENSIONS))
+
     @_log 
     @_returnToDir
-    def buildVM(self, userID, box=None):
+    @_mutates
+    def buildVM(self, userID, box=None, template=None, progress=None):
         """
         Makes a VM and
         pairs it to a user
+        template picks the Vagrantfile template, see buildVagrantFile
+        progress(stage) is called as vagrant works, see runVagrant
+        """
+        return self._build(userID, box, template, progress)[1]
+
+    @_log
+    @_mutates
+    def buildPooledVM(self, box=None, progress=None):
+        """
+        Makes an unassigned VM for the warm pool, see warm_pool.py
+        Returns its ID, or None if the build failed
+        """
+        VMid, results, ok = self._build(constants.POOL_OWNER, box, None, progress)
+        if VMid is None:
+            return None
+        if not ok:
+            self.deleteVM(VMid)
+            return None
+        self.queryDB("Update VM set pooled = 1 Where VM.ID = ?", [VMid])
+        return VMid
+
+    def _build(self, userID, box=None, template=None, progress=None):
+        """
+        Does the work of buildVM.
+        Returns (VM ID, output, whether vagrant up worked)
         """
         #build initial insert query
         query = "Insert into VM(hostname,ownerID,initDate,lastBuildDate,box) "
@@ -179,46 +362,40 @@ class V_API:
             box = self.defaultBox
         #know that any record in the db with this hostname is
         #   an instance of this method failing halfway through
-        tempName = 'underConstruction' + str(curTime)
+        #   unique, builds run at the same time on job and pool threads
+        tempName = 'underConstruction' + str(curTime) + '-' + uuid.uuid4().hex
         queryArgs = [tempName, userID, curTime, curTime, box]
-        self.queryDB(query, queryArgs)
-        #get id of new VM record
-        idQuery = "Select VM.ID from VM Where "
-        idQuery+= "hostname like ? and "
-        idQuery+= "ownerID = ? and "
-        idQuery+= "initDate = ? and "
-        idQuery+= "lastBuildDate = ? and "
-        idQuery+= "box = ?"
-        VMid = self.queryDB(idQuery, queryArgs)[0][0] #reuse args
+        with self.pool.transaction() as c:
+            c.execute(query, queryArgs)
+            VMid = c.lastrowid
+        try:
+            ip = self.reserveIP(VMid)
+        except PoolExhausted as e:
+            self.queryDB("Delete from VM Where VM.ID = ?", [VMid])
+            return None, "Could not build a VM: "+str(e), False
         #made directory
-        dirPath = os.path.join(self.parentPath,str(VMid))
+        dirPath = os.path.join(self.vmsPath,str(VMid))
         if not os.path.exists(dirPath):
             os.mkdir(dirPath, mode=0o777)
         #build the vagrant file
-        data = self.buildVagrantFile(VMid)
+        data = self.buildVagrantFile(VMid, template, ip)
         #take data and fill out the rest of the record
         finishQuery = "Update VM set hostname = ?, "
-        finishQuery+= "ip = ?, "
         finishQuery+= "active = ? "
         finishQuery+= "Where VM.ID = ?"
-        lastQuargs = [data["hostname"],data["ip"],1,data["id"]]
+        lastQuargs = [data["hostname"],1,data["id"]]
         errCheck = self.queryDB(finishQuery, lastQuargs)
         results = ""
         if 'failed' in errCheck:
             results = errCheck+' '
         #vagrant commands   
-        #vagrant commands must be called from the dir where it lives
-        os.chdir(dirPath)
-        command1 = ['vagrant','up']
-        #command2 = ['vagrant','provision']
-        try:
-            results+= str(subprocess.check_output(command1))
-            #results+= str(subprocess.check_output(command2))
-        except subprocess.CalledProcessError as e:
-            results+= str(e)
-        return results
+        up = self.runVagrant(VMid, 'up', progress=progress)
+        results+= str(up)
+        #results+= str(self.runVagrant(VMid, 'provision', progress=progress))
+        return VMid, results, up.returncode == 0
 
     @_log 
+    @_mutates
     def claimUser(self, targetID, username, serviceID):
         """
         directly pair a user to a service account
@@ -230,9 +407,12 @@ class V_API:
             self.queryDB(query,queryArgs)
         except Exception as e:
             return e
+        finally:
+            self.auth.invalidate(serviceKey(serviceID))
         return None
 
     @_log 
+    @_mutates
     def claimByVM(self, targetVMid, serviceUsername, serviceID):
         """
         Pair VM to service account
@@ -248,9 +428,12 @@ class V_API:
             self.queryDB(query,queryArgs)
         except Exception as e:
             return e
+        finally:
+            self.auth.invalidate(serviceKey(serviceID))
         return None
     
     @_log
+    @_mutates
     def claimVM(self, targetVMid, userid):
         """
         Take over ownership of a VM
@@ -264,28 +447,87 @@ class V_API:
             return e
         return None
 
+    @_log
+    @_mutates
+    def claimPooledVM(self, userID, box=None):
+        """
+        Hands a ready VM from the warm pool to a user.
+        Returns its ID, or None if the pool for the box is empty
+        """
+        if box == None:
+            box = self.defaultBox
+        query = "Select VM.ID from VM "
+        query+= "Where pooled = 1 and active = 1 and box = ? "
+        query+= "Order by VM.ID Limit 1"
+        #in one transaction so two users never get the same VM
+        with self.pool.transaction() as c:
+            c.execute(query, [box])
+            row = c.fetchone()
+            if row is None:
+                return None
+            c.execute("Update VM set ownerID = ?, pooled = null "
+                      "Where VM.ID = ?", [userID, row[0]])
+        return row[0]
+
     @_log 
     @_returnToDir
+    @_mutates
     def cleanVMs(self):
         """
         Destroy VMs which belong to users
-        who are not employed here
+        who are not employed here or are not active.
+        Destroys run in parallel, at most
+        constants.CLEAN_PARALLELISM per box at once.
+        Returns a summary with one result per VM
         """
+        start = time.time()
         #get all VMs that are innactive or owned by defunct users
-        cleanList = ""
-        junkQuery = "Select VM.hostname, VM.ID from VM "
-        junkQuery+= "join Users on User.ID = VM.ownerID "
+        junkQuery = "Select VM.ID, VM.hostname, VM.box from VM "
+        junkQuery+= "join Users on Users.ID = VM.ownerID "
         junkQuery+= "Where Users.worksHere = 0 "
         junkQuery+= "Or VM.active = 0"
         badVMs = self.queryDB(junkQuery, [])
-        for vm in badVMs:
-            cleanList = vm+' '
-            self.destroyVM(vm)
-        pruneCommand = ['vagrant','global-status','--prune']
-        subprocess.check_output(pruneCommand)
-        return cleanList.rstrip()    
+        #each box (cluster) has its own limit
+        limits = {}
+        for VMid, hostname, box in badVMs:
+            if box not in limits:
+                limit = constants.CLEAN_PARALLELISM.get(box,
+                                                        constants.CLEAN_DEFAULT_PARALLELISM)
+                limits[box] = threading.Semaphore(limit)
+        def clean(vm):
+            VMid, hostname, box = vm
+            with limits[box]:
+                result = self._destroy(VMid)
+            return {'ID': VMid,
+                    'hostname': hostname,
+                    'box': box,
+                    'ok': result.returncode == 0,
+                    'seconds': round(result.seconds,2),
+                    'output': str(result)}
+        results = []
+        if len(badVMs) > 0:
+            workers = min(len(badVMs), constants.CLEAN_MAX_WORKERS)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(clean, badVMs))
+        #prune once, after every destroy
+        prune = vagrant_runner.run([self.vagrant,'global-status','--prune'],
+                                   tailLines=constants.OUTPUT_TAIL_LINES)
+        return {'results': results,
+                'destroyed': len([r for r in results if r['ok']]),
+                'failed': len([r for r in results if not r['ok']]),
+                'pruned': prune.returncode == 0,
+                'seconds': round(time.time() - start,2)}
+
+    def countPooledVMs(self):
+        """
+        Ready VMs in the warm pool, by box
+        """
+        query = "Select box, count(*) from VM "
+        query+= "Where pooled = 1 and active = 1 Group by box"
+        return dict(self.queryDB(query, []))
 
     @_log 
+    @_mutates
     def createServiceUser(self, username, realID, serviceID):
         """
         Creates a service user and pairs it to a regular user
@@ -294,9 +536,13 @@ class V_API:
         query = "Insert into ThirdPartyAccount(userID,username,serviceID,service)"
         query += "Values(?,?,?,?)"
         queryArgs = [realID, username, serviceID, self.service]
-        self.queryDB(query,queryArgs)
+        try:
+            self.queryDB(query,queryArgs)
+        finally:
+            self.auth.invalidate(serviceKey(serviceID))
 
     @_log 
+    @_mutates
     def createUser(self, name):
         """
         Creates a user and returns their ID.
@@ -309,41 +555,46 @@ class V_API:
             self.queryDB(query,queryArgs)
         except Exception as e:
             return e
-        q2 = "Select ID FROM Users WHERE name like ? Order by desc Limit 1"
+        q2 = "Select ID FROM Users WHERE name like ? Order by ID desc Limit 1"
         newID = self.queryDB(q2,queryArgs)
         return newID
 
     @_log
-    def deleteVM(self, VMid):
+    @_mutates
+    def deleteVM(self, VMid, progress=None):
         """
         Destroy a VM and remove it's record from the database
         """
-        output = self.destroyVM(VMid)
+        output = self.destroyVM(VMid, progress)
+        rows = self.queryDB("Select ip from VM Where VM.ID = ?", [VMid])
         query = "DELETE from VM where VM.ID = ?"
         self.queryDB(query,[VMid])
+        #the address can go to the next VM
+        for row in rows:
+            self.ips.release(row[0])
         return output
 
     @_returnToDir
-    def destroyVM(self, VMid):
+    @_mutates
+    def destroyVM(self, VMid, progress=None):
         """
         Destroys a VM and marks it as
         not active in database
         """
+        return str(self._destroy(VMid, progress))
+
+    def _destroy(self, VMid, progress=None):
+        """
+        Marks a VM as not active and destroys it.
+        Returns the vagrant_runner.RunResult
+        """
         removalQuery = "Update VM set active = 0 "
         removalQuery+= "Where VM.ID = ?"
         queryArgs = [VMid]
         self.queryDB(removalQuery,queryArgs)
         
-        results = ''
-        lastPath = os.getcwd()
-        targetDir = os.path.join(self.parentPath,str(VMid))
-        os.chdir(targetDir)
-        destroyCommand = ['vagrant','destroy','-f'] #do not require prompt
-        try:
-            results+= subprocess.check_output(destroyCommand)
-        except subprocess.CalledProcessError as e:
-            results = e.output
-        return results
+        #-f so there is no prompt
+        return self.runVagrant(VMid, 'destroy', ['-f'], progress)
 
     @_log 
     def getIDbyName(self, name):
@@ -368,33 +619,68 @@ class V_API:
         return vmid
 
     @_log 
-    def getLogsSince(self, pointInTime):
+    def getLogsSince(self, pointInTime, after=None, actor=None, method=None, limit=None):
         """
-        Returns all logged Events since a given
-        date: UNIX timestamp
+        Returns logged Events since a given time, oldest first,
+        as (description, timestamp, user name, event ID).
+        pointInTime: see log_query.parseTime
+        after: event ID of the last row of the previous page
+        actor: only events with this user ID as an actor
+        method: only events recorded for this V_API method
+        limit: max events, constants.LOG_PAGE_SIZE by default
         """
-        #I know this is ugly and violates PEP,
-        #it is also more efficient than importing dateparser
-        #everytime the API is instantiated
-        import dateparser
-        cleanTime = 0
         try:
-            #This has the annoying side effect of rounding the decimal
-            #revisit later?
-            cleanTime = time.mktime(
-                dateparser.parse(str(pointInTime))
-                .timetuple())
-        except Exception as e:
-            return e.output
-        query = "Select Events.description, Events.timestamp, "
-        query+= "Users.name from Events "
-        query+= "Join Actors on Events.ID = Actors.eventID "
+            cleanTime = parseTime(pointInTime)
+        except ValueError as e:
+            return str(e)
+        if limit == None:
+            limit = constants.LOG_PAGE_SIZE
+        limit = max(1, min(int(limit), constants.LOG_MAX_PAGE_SIZE))
+        after = int(after or 0)
+        if actor != None:
+            actor = int(actor)
+        #archived events are older than any in the database
+        #   and IDs are never reused, so they simply come first
+        rows = []
+        archived = 0
+        for event in readEvents(self.archivePath, cleanTime, after, actor, method, limit):
+            for actorID, name in event['actors']:
+                if actor == None or actorID == actor:
+                    rows.append((event['description'], event['timestamp'],
+                                 name, event['ID']))
+            archived+= 1
+            after = event['ID']
+        if archived >= limit:
+            return rows
+        limit-= archived
+        #events are written in time order, so the first one since
+        #   cleanTime starts a scan by ID
+        first = self.queryDB("Select min(ID) from Events Where timestamp >= ?",
+                             [cleanTime])[0][0]
+        if first is None:
+            return rows
+        #a page holds whole events, whatever their number of actors
+        page = "Select Events.ID, Events.description, Events.timestamp "
+        page+= "From Events "
+        page+= "Where Events.ID >= ? and Events.ID > ? and Events.timestamp >= ? "
+        quargs = [first, after, cleanTime]
+        if method != None:
+            page+= "and Events.description like ? escape '\\' "
+            quargs.append(likePrefix(str(method)+'('))
+        if actor != None:
+            page+= "and Events.ID in (Select eventID from Actors Where actorID = ?) "
+            quargs.append(actor)
+        page+= "Order by Events.ID Limit ?"
+        quargs.append(limit)
+        query = "Select E.description, E.timestamp, Users.name, E.ID "
+        query+= "From ("+page+") E "
+        query+= "Join Actors on E.ID = Actors.eventID "
         query+= "Join Users on Actors.actorID = Users.ID "
-        query+= "Where Events.timestamp >= ? "
-        query+= "ORDER BY timestamp ASC"
-        quargs = [cleanTime]
-        results = self.queryDB(query,quargs)
-        return results
+        if actor != None:
+            query+= "Where Actors.actorID = ? "
+            quargs.append(actor)
+        query+= "Order by E.ID, Actors.actorID"
+        return rows + self.queryDB(query,quargs)
 
     @_log 
     def getUserID(self, serviceID):
@@ -404,9 +690,9 @@ class V_API:
         """
         query = "Select ID from ThirdPartyAccount "
         query+= "Inner Join Users on Users.ID = ThirdPartyAccount.userID "
-        query+= "and service like ? "
-        query+= "and serviceId like ?"
-        queryArgs = [self.service, serviceID]
+        query+= "and serviceID = ? COLLATE NOCASE "
+        query+= "and service = ? COLLATE NOCASE"
+        queryArgs = [serviceID, self.service]
         userID = self.queryDB(query,queryArgs)
         return userID[0][0]
 
@@ -446,18 +732,56 @@ class V_API:
         return users
 
     @_log 
-    def listVMs(self):
+    def listVMs(self, withState=False):
         """
         Returns a list of active VMs
+        withState adds the state vagrant last reported,
+        see reconciler.py
         """
-        query = "Select VM.hostname, VM.ip, Users.name From VM "
+        query = "Select VM.hostname, VM.ip, Users.name"
+        if withState:
+            query+= ", VMState.state"
+        query+= " From VM "
         query+= "Left Join Users on VM.ownerID = Users.ID "
+        if withState:
+            query+= "Left Join VMState on VMState.VMid = VM.ID "
         query+= "Where VM.active IS NULL "
         query+= "OR VM.active = 1 "
         query+= "Order by VM.hostname"
         vms = self.queryDB(query, [])
         return vms
 
+    def findDrift(self):
+        """
+        VMs whose record disagrees with vagrant, as
+        (ID, hostname, problem).
+        Uses the state from the last reconcile, see reconciler.py
+        """
+        drift = []
+        query = "Select VM.ID, VM.hostname, VMState.state From VM "
+        query+= "Left Join VMState on VMState.VMid = VM.ID "
+        query+= "Where (VM.active IS NULL OR VM.active = 1) "
+        query+= "and (VMState.state IS NULL OR VMState.state = 'not_created') "
+        query+= "and VM.hostname not like 'underConstruction%' "
+        query+= "Order by VM.ID"
+        for VMid, hostname, state in self.queryDB(query, []):
+            drift.append((VMid, hostname, "active but "+(state or "unknown to vagrant")))
+        query = "Select VM.ID, VM.hostname From VM "
+        query+= "Join VMState on VMState.VMid = VM.ID "
+        query+= "Where VM.active = 0 and VMState.state = 'running' "
+        query+= "Order by VM.ID"
+        for VMid, hostname in self.queryDB(query, []):
+            drift.append((VMid, hostname, "inactive but running"))
+        #buildVM renames the VM once its Vagrantfile is written
+        query = "Select VM.ID, VM.hostname From VM "
+        query+= "Where VM.hostname like 'underConstruction%' "
+        query+= "and VM.initDate < ? "
+        query+= "Order by VM.ID"
+        cutoff = round(time.time(),2) - constants.STALE_BUILD_SECONDS
+        for VMid, hostname in self.queryDB(query, [cutoff]):
+            drift.append((VMid, hostname, "unfinished build"))
+        return drift
+
     #Never _log this - infinite loop 
     def logEvent(self, description, actors):
         """
@@ -472,25 +796,15 @@ class V_API:
 
         For more detailed or specific logging
         the logEvent method must be used explicitly
+
+        Events are queued and written in batches.
+        Anything that reads Events or Actors through
+        queryDB sees them immediately
         """
-        eventInsert = "Insert into Events(description, timestamp) "
-        eventInsert+= "Values(?,?)"
-        theNow = str(round(time.time(),2))
-        eventArgs = [str(description), theNow]
-        self.queryDB(eventInsert, eventArgs)
-        #get ID from new event
-        getID = "Select Events.ID from Events "
-        getID+= "Where Events.description like ? "
-        getID+= "And Events.timestamp = ?"
-        eventID = self.queryDB(getID, eventArgs)[0][0]
-        #add actors
-        for actor in actors:
-            addActor = "Insert into Actors(eventID, actorID) "
-            addActor+= "Values(?,?)"
-            actArgs = [eventID, actor]
-            self.queryDB(addActor, actArgs)
+        self.audit.add(description, actors)
 
     @_log 
+    @_mutates
     def makeAdmin(self, myID, targetID):
         """
         Grant a user admin status
@@ -500,7 +814,10 @@ class V_API:
             query = "Update Users Set isAdmin = 1 "
             query+= "Where Users.ID = ?"
             quargs = [targetID]
-            self.queryDB(query, quargs)
+            try:
+                self.queryDB(query, quargs)
+            finally:
+                self.auth.invalidate(userKey(targetID))
             return True
         else:
             return False
@@ -511,37 +828,76 @@ class V_API:
         """
         executes any string as a VBoxManage command
         """
-        results = None
         command = args.split(" ")
-        try:
-            results = subprocess.check_output(command).decode('ascii')
-        except subprocess.CalledProcessError as e:
-            results = e.output
+        #the configured vagrant, which may be fake_vagrant
+        if command[0] == 'vagrant':
+            command[0] = self.vagrant
+        logPath = os.path.join(self.logsPath,
+                               'other-'+str(round(time.time(),2))+'.log')
+        result = vagrant_runner.run(command, logPath=logPath,
+                                    tailLines=constants.OUTPUT_TAIL_LINES)
+        if result.returncode != 0:
             with open(error_log_file, 'a+') as error_log:
-                time = str(datetime.datetime.now())
-                error_log.write(time+": "+str(e)+'\n')
-        return results
+                now = str(datetime.datetime.now())
+                error_log.write(now+": "+str(command)+" returned "
+                                +str(result.returncode)+'\n')
+        return str(result)
 
     @_log
     @_returnToDir
-    def provisionVM(self, VMid):
+    def provisionVM(self, VMid, progress=None):
         """
         Activated the provisioner for the VM
         """
-        dirPath = os.path.join(self.parentPath,str(VMid))
+        dirPath = os.path.join(self.vmsPath,str(VMid))
         if not os.path.exists(dirPath):
             return "VM does not exist"
-        results = ""
-        #vagrant commands   
-        #vagrant commands must be called from the dir where it lives
-        os.chdir(dirPath)
-        command = ['vagrant','provision']
-        try:
-            results+= str(subprocess.check_output(command))
-        except subprocess.CalledProcessError as e:
-            results+= str(e)
-        return results      
+        return str(self.runVagrant(VMid, 'provision', progress=progress))
     
+    def runVagrant(self, VMid, verb, args=[], progress=None):
+        """
+        Runs a vagrant command from the VM's folder
+        and returns a vagrant_runner.RunResult.
+        Output is streamed: only the last lines are kept,
+        the full log goes to the logs folder
+        and progress(stage) is called as the stage changes
+        """
+        #vagrant commands must be called from the dir where it lives
+        dirPath = os.path.join(self.vmsPath,str(VMid))
+        command = [self.vagrant, verb] + list(args) + ['--machine-readable']
+        logName = str(VMid)+'-'+verb+'-'+str(round(time.time(),2))+'.log'
+        result = vagrant_runner.run(command,
+                                    cwd=dirPath,
+                                    logPath=os.path.join(self.logsPath,logName),
+                                    progress=progress,
+                                    interval=constants.PROGRESS_INTERVAL,
+                                    tailLines=constants.OUTPUT_TAIL_LINES)
+        metrics.registry.observe('vmbot_vagrant_seconds', {'verb': verb}, result.seconds)
+        if result.returncode != 0:
+            metrics.registry.inc('vmbot_vagrant_failures_total', {'verb': verb})
+        runs = getattr(self._runs, 'results', None)
+        if runs is not None:
+            runs.append(result)
+        return result
+
+    def getBlockedCommands(self):
+        """
+        Returns the cached list of blocked commands,
+        loading it from the database if needed
+        """
+        return self.getBlockMatcher().entries
+
+    def getBlockMatcher(self):
+        """
+        Returns the BlockMatcher built from BlockedCommands,
+        loading it from the database if needed
+        """
+        with self._blockedLock:
+            if self._blocked is None:
+                rows = self.queryDB("Select * From BlockedCommands", [])
+                self._blocked = BlockMatcher(b[0] for b in rows)
+            return self._blocked
+
     #Never _log this - infinite loop 
     def queryDB(self, query, quargs):
         """
@@ -549,18 +905,73 @@ class V_API:
         query string
         list of arguments
         """
-        connection = sqlite3.connect(self.db,isolation_level=None)
-        c = connection.cursor()
         out = None
         try:
-            c.execute(query,quargs)
-            out = c.fetchall()
+            #write out queued events before anything that may read them,
+            #   unless this thread is in a transaction, see AuditBuffer.flush
+            if self.audit.pending() > 0:
+                lowered = query.lower()
+                if 'events' in lowered or 'actors' in lowered:
+                    self.audit.flush()
+            out = self.pool.execute(query,quargs)
         except Exception as e:
+            if self.isStrict():
+                raise
             out = str(e)
-        c.close
         return out
 
+    @contextmanager
+    def strict(self):
+        """
+        While open, errors in queries and logged methods
+        are raised on this thread instead of being
+        returned or hidden, so a caller can roll back. See batch.py
+        """
+        depth = getattr(self._strict, 'depth', 0)
+        self._strict.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._strict.depth = depth
+
+    @contextmanager
+    def vagrantRuns(self):
+        """
+        While open, every RunResult of runVagrant on this thread
+        is added to the list it yields, so a caller
+        can tell a failed vagrant command from the method's output
+        """
+        outer = getattr(self._runs, 'results', None)
+        self._runs.results = []
+        try:
+            yield self._runs.results
+        finally:
+            if outer is not None:
+                outer.extend(self._runs.results)
+            self._runs.results = outer
+
+    def isStrict(self):
+        return getattr(self._strict, 'depth', 0) > 0
+
+    def changed(self):
+        """
+        Bumps the generation. Called by every method that
+        writes, readers compare generations to know their copy is stale
+        """
+        with self._generationLock:
+            self.generation+= 1
+
+    def close(self):
+        """
+        Closes all pooled database connections.
+        Call this when shutting down, queries made
+        through this V_API afterwards fail
+        """
+        closeAuditBuffer(self.db)
+        closePool(self.db)
+
     @_log
+    @_mutates
     def reactivateUser(self, myID, targetID):
         """
         Reactivate a user
@@ -569,14 +980,18 @@ class V_API:
             rquery = "Update Users set worksHere = 1 "
             rquery+= "Where Users.ID = ?"
             rargs = [targetID]
-            self.queryDB(rquery, rargs)
+            try:
+                self.queryDB(rquery, rargs)
+            finally:
+                self.auth.invalidate(userKey(targetID))
             return True
         else:
             return False
     
     @_log 
     @_returnToDir
-    def rebuildVM(self, VMid):
+    @_mutates
+    def rebuildVM(self, VMid, progress=None):
         """
         destory and then build an existing VM
         """
@@ -585,27 +1000,14 @@ class V_API:
         queryArgs = [VMid]
         self.queryDB(query,queryArgs)
         
-        targetDir = os.path.join(self.parentPath,str(VMid))
-        os.chdir(targetDir)
-        destroyCommand = ['vagrant','destroy']
-        destroyResults=''
-        try:
-            destroyResutls = str(subprocess.check_output(destroyCommand))
-        except subprocess.CalledProcessError as de:
-            destroyResutls+= str(de)
-        command1 = ['vagrant','up']
-        #command2 = ['vagrant','provision']
-        reupResults = ''
-        try:
-            reupResults+= str(subprocess.check_output(command1))
-            #reupResults+= str(subprocess.check_output(command2))
-        except subprocess.CalledProcessError as e:
-            reupResults+= str(e)
-        reupResults = subprocess.check_output(reupCommand)
+        destroyResults = str(self.runVagrant(VMid, 'destroy', ['-f'], progress))
+        reupResults = str(self.runVagrant(VMid, 'up', progress=progress))
+        #reupResults+= str(self.runVagrant(VMid, 'provision', progress=progress))
         results = destroyResults + "\n" + reupResults
         return results
 
     @_log
+    @_mutates
     def removeUser(self, myID, targetID):
         """
         Sets a user as not working here
@@ -616,7 +1018,10 @@ class V_API:
             rquery = "Update Users set worksHere = 0 "
             rquery+= "Where Users.ID = ?"
             rargs = [targetID]
-            self.queryDB(rquery, rargs)
+            try:
+                self.queryDB(rquery, rargs)
+            finally:
+                self.auth.invalidate(userKey(targetID))
             return True
         else:
             return False
@@ -626,15 +1031,13 @@ class V_API:
     @_log
     def securityCheck(self, args):
         """
-        Fill in the blocked_commands list with
+        Fill in the BlockedCommands table with
         keywords  and commands which should not
         be run under any circumstances
         """
-        command = args.split(" ")
-        for c in command:
-            if c.lower() in self.blocked_commands or command in self.blocked_commands:
-                return False
-        return True
+        #blocks any command with a blocked word,
+        #   or blocked words in a row, ex: "rm -rf"
+        return self.getBlockMatcher().match(args) is None
 
     @_log 
     def userOwnsVM(self, uid, vid):
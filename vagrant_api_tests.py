@@ -15,11 +15,34 @@ import sqlite3
 import shutil
 import os
 import time
+import threading
+import ipaddress
+import constants
 from vagrant_API import *
+import engine
+from jobs import JobQueue
+import migrations
+import tempfile
+import vagrant_runner
+from warm_pool import WarmPool
+from reconciler import Reconciler, parseGlobalStatus
+from log_query import parseTime
+from ip_pool import IPPool, PoolExhausted
+import metrics
+from batch import runBatch
+from read_cache import ReadCache
+from auth_cache import AuthCache, MISSING
+from blocklist import BlockMatcher, tokenize
+from db_pool import DBPool
+from event_archive import archiveEvents, readEvents
+from audit_log import AuditBuffer
 
 SERVICE = "testChat"
 DB = "testDB.db"
 BOX = "ubuntu/trusty32"
+#stands in for vagrant, see fake_vagrant/vagrant
+FAKE_VAGRANT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'fake_vagrant', 'vagrant')
 
 class settings(unittest.TestCase):
     """
@@ -28,11 +51,21 @@ class settings(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
         shutil.copy2("testDBBackup.db","testDB.db")
+        cls.fakeHome = tempfile.mkdtemp()
+        os.environ['FAKE_VAGRANT_HOME'] = cls.fakeHome
+        os.environ['FAKE_VAGRANT_LATENCY'] = '0'
+        os.environ['FAKE_VAGRANT_FAILURE_RATE'] = '0'
         cls.v = V_API(SERVICE, DB, BOX)
+        cls.v.vagrant = FAKE_VAGRANT
+        #vagrant run logs stay out of the working tree
+        cls.v.logsPath = tempfile.mkdtemp()
 
     @classmethod
     def tearDownClass(cls):
+        cls.v.close()
         os.remove("testDB.db")
+        shutil.rmtree(cls.fakeHome)
+        shutil.rmtree(cls.v.logsPath)
         cls.v = None
     
 class TestAdminChecks(settings):
@@ -64,58 +97,406 @@ class TestAdminChecks(settings):
         self.assertTrue(self.v.makeAdmin(75,74))
         self.assertTrue(self.v.adminCheck(74))
 
+class TestArchive(settings):
+    """
+    Test moving old events out of the database
+    """
+    def setUp(self):
+        self.saved = self.v.archivePath
+        self.v.archivePath = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.v.archivePath)
+        self.v.archivePath = self.saved
+
+    def test_archiveEvents(self):
+        """
+        Old events move to monthly files and
+        getLogsSince reads across the archive and the database
+        """
+        for i in range(4):
+            self.v.logEvent("archiveTest("+str(i)+")", [0, 78])
+        self.v.audit.flush()
+        old = time.mktime((2018, 9, 30, 12, 0, 0, 0, 0, -1))
+        ids = [row[0] for row in self.v.queryDB(
+            "Select ID from Events Where description like 'archiveTest%' "
+            "Order by ID", [])]
+        #two events in September, two in October
+        for n, eventID in enumerate(ids[:2]):
+            self.v.queryDB("Update Events set timestamp = ? Where ID = ?",
+                           [old + n, eventID])
+        for n, eventID in enumerate(ids[2:]):
+            self.v.queryDB("Update Events set timestamp = ? Where ID = ?",
+                           [old + 86400*5 + n, eventID])
+        self.v.queryDB("Update Events set timestamp = ? Where ID = ?",
+                       [round(time.time(),2), ids[3]])
+        moved = self.v.archiveEvents(30)
+        self.assertTrue(moved >= 3)
+        self.assertEqual(sorted(os.listdir(self.v.archivePath)),
+                         ['events-2018-09.jsonl.gz', 'events-2018-10.jsonl.gz',
+                          'index.json'])
+        self.assertEqual(self.v.queryDB("Select count(*) from Events Where ID <= ?",
+                                        [ids[2]]), [(0,)])
+        self.assertEqual(self.v.queryDB("Select count(*) from Actors Where eventID = ?",
+                                        [ids[0]]), [(0,)])
+        #one page from the archive, the next reaches the database
+        page = self.v.getLogsSince(old, method="archiveTest", limit=3)
+        self.assertEqual([row[3] for row in page][::2], ids[:3])
+        self.assertEqual(page[1][2], "Test McTester")
+        page = self.v.getLogsSince(old, after=page[-1][3], method="archiveTest")
+        self.assertEqual([row[3] for row in page], [ids[3], ids[3]])
+        mine = self.v.getLogsSince(old + 86400, actor=78, method="archiveTest")
+        self.assertEqual([row[3] for row in mine], ids[2:])
+
+    def test_skipMonths(self):
+        """
+        Months already paged past are not opened again
+        """
+        self.v.logEvent("skipTest(0)", [0])
+        self.v.logEvent("skipTest(1)", [0])
+        self.v.audit.flush()
+        ids = [row[0] for row in self.v.queryDB(
+            "Select ID from Events Where description like 'skipTest%' "
+            "Order by ID", [])]
+        self.v.queryDB("Update Events set timestamp = ? Where ID = ?",
+                       [time.mktime((2018, 9, 30, 12, 0, 0, 0, 0, -1)), ids[0]])
+        self.v.queryDB("Update Events set timestamp = ? Where ID = ?",
+                       [time.mktime((2018, 10, 5, 12, 0, 0, 0, 0, -1)), ids[1]])
+        self.v.archiveEvents(30)
+        since = time.mktime((2018, 9, 1, 0, 0, 0, 0, 0, -1))
+        first = list(readEvents(self.v.archivePath, since, method="skipTest", limit=1))
+        self.assertEqual([e['ID'] for e in first], [ids[0]])
+        #September is finished with, a corrupt file shows if it is opened
+        with open(os.path.join(self.v.archivePath, 'events-2018-09.jsonl.gz'), 'wb') as f:
+            f.write(b'not gzip')
+        rest = list(readEvents(self.v.archivePath, since, after=ids[0], method="skipTest"))
+        self.assertEqual([e['ID'] for e in rest], [ids[1]])
+
+    def test_appendedMonth(self):
+        """
+        Paging stays in ID order when a later run
+        appends lower IDs to a month already archived
+        """
+        self.v.logEvent("appendTest(0)", [0])
+        self.v.logEvent("appendTest(1)", [0])
+        self.v.audit.flush()
+        ids = [row[0] for row in self.v.queryDB(
+            "Select ID from Events Where description like 'appendTest%' "
+            "Order by ID", [])]
+        september = time.mktime((2018, 9, 10, 12, 0, 0, 0, 0, -1))
+        self.v.queryDB("Update Events set timestamp = ? Where ID = ?",
+                       [september, ids[1]])
+        archiveEvents(self.v.pool, self.v.archivePath, time.time() - 30*86400)
+        self.v.queryDB("Update Events set timestamp = ? Where ID = ?",
+                       [september + 60, ids[0]])
+        archiveEvents(self.v.pool, self.v.archivePath, time.time() - 30*86400)
+        since = time.mktime((2018, 9, 1, 0, 0, 0, 0, 0, -1))
+        paged = []
+        after = 0
+        while True:
+            page = list(readEvents(self.v.archivePath, since, after=after,
+                                   method="appendTest", limit=1))
+            if len(page) == 0:
+                break
+            paged+= [e['ID'] for e in page]
+            after = page[-1]['ID']
+        self.assertEqual(paged, ids)
+
+    def test_scheduledArchive(self):
+        """
+        The reconciler archives old events once per archiveInterval
+        """
+        r = Reconciler(self.v, archiveInterval=3600)
+        self.assertIsNotNone(r.archiveIfDue())
+        self.assertIsNone(r.archiveIfDue())
+        self.assertIsNone(Reconciler(self.v).archiveIfDue())
+
+class TestAuthCache(settings):
+    """
+    Test cached admin checks and their invalidation
+    """
+    def count(self, statement):
+        series = metrics.registry.histogram('vmbot_db_seconds')
+        return series.get((('statement', statement),), (0, 0))[0]
+
+    def test_cachedChecks(self):
+        """
+        Repeat checks do not query the database
+        """
+        self.v.adminCheckThroughService('ABC123')
+        before = self.count('select ThirdPartyAccount') + self.count('select Admins')
+        for i in range(5):
+            self.assertTrue(self.v.adminCheckThroughService('abc123'))
+            self.assertTrue(self.v.adminCheck(75))
+        after = self.count('select ThirdPartyAccount') + self.count('select Admins')
+        self.assertEqual(after, before)
+
+    def test_invalidation(self):
+        """
+        Changes made through V_API show up at once
+        """
+        self.assertFalse(self.v.adminCheckThroughService('xyz789'))
+        self.assertTrue(self.v.makeAdmin(75, 76))
+        self.assertTrue(self.v.adminCheckThroughService('xyz789'))
+        self.assertTrue(self.v.removeUser(75, 76))
+        self.assertFalse(self.v.adminCheck(76))
+        self.assertTrue(self.v.reactivateUser(75, 76))
+        self.assertTrue(self.v.adminCheck(76))
+        self.assertFalse(self.v.adminCheckThroughService('new456'))
+        self.v.createServiceUser('new', 75, 'new456')
+        self.assertTrue(self.v.adminCheckThroughService('NEW456'))
+        self.v.claimUser(78, 'new', 'new456')
+        self.assertFalse(self.v.adminCheckThroughService('new456'))
+
+    def test_stalePut(self):
+        """
+        A value read before an invalidation is not kept
+        """
+        cache = AuthCache(maxEntries=2, ttl=60)
+        version = cache.version
+        cache.invalidate(('user', '1'))
+        cache.put(('user', '1'), True, version)
+        self.assertTrue(cache.get(('user', '1')) is MISSING)
+        cache.put(('user', '1'), True, cache.version)
+        cache.put(('user', '2'), False, cache.version)
+        cache.get(('user', '1'))
+        cache.put(('user', '3'), None, cache.version)
+        #least recently used goes first
+        self.assertTrue(cache.get(('user', '2')) is MISSING)
+        self.assertEqual(cache.get(('user', '1')), True)
+        self.assertEqual(cache.get(('user', '3')), None)
+
+class TestBatch(settings):
+    """
+    Test running many operations in one transaction
+    """
+    def test_batch(self):
+        """
+        Operations run in order, a failed one
+        is rolled back without the others
+        """
+        results = runBatch(self.v, [
+            {'method': 'createUser', 'args': ['Batch Person']},
+            {'method': 'claimByVM', 'args': [-1, 'bp', 'BP1']},
+            {'method': 'getIDbyName', 'args': ['Batch Person']},
+            {'method': 'buildVM', 'args': [78]},
+            {'method': 'securityCheck', 'args': ['ls']},
+            {'args': []}])
+        self.assertTrue(results[0]['ok'])
+        uid = results[0]['result'][0][0]
+        #there is no VM -1
+        self.assertFalse(results[1]['ok'])
+        self.assertEqual(results[2], {'ok': True, 'result': [('Batch Person', uid)]})
+        self.assertFalse(results[3]['ok'])
+        self.assertTrue('vagrant' in results[3]['error'])
+        self.assertFalse(results[4]['ok'])
+        self.assertFalse(results[5]['ok'])
+        self.assertEqual(self.v.getIDbyName("Batch Person"), [('Batch Person', uid)])
+
+    def test_batchRolledBack(self):
+        """
+        A duplicate user name rolls back the whole transaction
+        so every operation is reported as failed
+        """
+        self.v.createUser("Batch Twin")
+        results = runBatch(self.v, [
+            {'method': 'createUser', 'args': ['Batch Single']},
+            {'method': 'createUser', 'args': ['Batch Twin']},
+            {'method': 'listUsers'}])
+        self.assertEqual([r['ok'] for r in results], [False, False, False])
+        self.assertTrue('Rolled back' in results[0]['error'])
+        self.assertEqual(self.v.getIDbyName("Batch Single"), [])
+        self.assertTrue(isinstance(self.v.listUsers(), list))
+
+    def test_batchKeepsEvents(self):
+        """
+        A failed operation does not take queued events,
+        including other threads', down with it
+        """
+        saved = self.v.audit
+        self.v.audit = AuditBuffer(self.v.pool, batchSize=3, flushInterval=3600)
+        try:
+            def other(n):
+                self.v.audit.add("keepTest("+str(n)+")", [0])
+            threads = [threading.Thread(target=other, args=[n]) for n in range(2)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            #the third event fills the buffer, then getUserID fails
+            results = runBatch(self.v, [{'method': 'getUserID', 'args': ['keepTestNobody']}])
+            self.assertFalse(results[0]['ok'])
+        finally:
+            self.v.audit.close()
+            self.v.audit = saved
+        rows = self.v.queryDB("Select description from Events "
+                              "Where description like 'keepTest(%' "
+                              "or description like 'getUserID(''keepTestNobody''%' "
+                              "Order by description", [])
+        self.assertEqual([row[0] for row in rows],
+                         ["getUserID('keepTestNobody',)", "keepTest(0)", "keepTest(1)"])
+
+    def test_batchJobs(self):
+        """
+        Vagrant operations are queued once the batch commits
+        """
+        jq = JobQueue(self.v, 1, methods=('getUserVMCount', 'rebuildVM'))
+        results = runBatch(self.v, [{'method': 'rebuildVM', 'args': [-1]}],
+                           jobs=lambda: jq)
+        self.assertTrue(results[0]['ok'])
+        self.assertEqual(jq.status(results[0]['job'])['status'], 'queued')
+
+    def test_batchLimit(self):
+        self.assertRaises(ValueError, runBatch, self.v, {'method': 'listUsers'})
+        self.assertRaises(ValueError, runBatch, self.v,
+                          [{'method': 'listUsers'}] * 3, None, 2)
+
 class TestBuild(settings):
     """
     Test methods relating to building VMs
+    These run against fake_vagrant, see settings
     """
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.v.vmsPath = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.v.vmsPath)
+        super().tearDownClass()
+
+    def tearDown(self):
+        os.environ['FAKE_VAGRANT_FAILURE_RATE'] = '0'
+
+    def build(self, userID=78):
+        results = self.v.buildVM(userID)
+        VMid = self.v.queryDB("Select max(ID) from VM", [])[0][0]
+        hostname, ip = self.v.queryDB("Select hostname, ip from VM Where ID = ?",
+                                      [VMid])[0]
+        return VMid, hostname, ip, results
+
     def test_buildThroughService(self):
         #essentially an alias for buildVM
-        #if buildVM and getUserID work this will work
-        pass
-    def test_buildVagrantFile(self):
-        #must run properly for builds to run
-        pass
+        self.v.buildThroughService("TEST000")
+        VMid = self.v.queryDB("Select max(ID) from VM", [])[0][0]
+        self.assertEqual(self.v.queryDB("Select ownerID from VM Where ID = ?",
+                                        [VMid]), [(78,)])
+
     def test_buildVM(self):
-        #this cannot accurately be tested without a Vsphere cluster
-        results = self.v.buildVM(78)
-        #print(results)
-        vmList = self.v.listVMs()
-        #print(vmList)
-        self.assertTrue(('nyc-vm-d80', '10.20.6.', 'Test McTester') in vmList)
-   
+        VMid, hostname, ip, results = self.build()
+        self.assertEqual(hostname, "nyc-vm-d"+str(VMid))
+        self.assertTrue(ipaddress.ip_address(ip)
+                        in ipaddress.ip_network(constants.IP_POOLS[0]))
+        self.assertTrue("==> default: Cloning VM..." in results)
+        self.assertFalse("Command failed" in results)
+        self.assertTrue((hostname, ip, 'Test McTester') in self.v.listVMs())
+        self.assertTrue(os.path.exists(os.path.join(self.v.vmsPath, str(VMid),
+                                                    'Vagrantfile')))
+
+    def test_concurrentBuilds(self):
+        """
+        Builds started at the same moment each get their own VM
+        """
+        before = self.v.queryDB("Select max(ID) from VM", [])[0][0]
+        start = threading.Barrier(6)
+        results = []
+        def build():
+            start.wait()
+            results.append(self.v.buildVM(78))
+        threads = [threading.Thread(target=build) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        rows = self.v.queryDB("Select ID, hostname from VM Where ID > ?", [before])
+        self.assertEqual(len(rows), 6)
+        for VMid, hostname in rows:
+            self.assertEqual(hostname, "nyc-vm-d"+str(VMid))
+        self.assertFalse(any("Command failed" in str(r) for r in results))
+
+    def test_failedBuild(self):
+        os.environ['FAKE_VAGRANT_FAILURE_RATE'] = '1'
+        VMid, hostname, ip, results = self.build()
+        self.assertTrue("Command failed with exit status 1" in results)
+        latest = self.v.queryDB("Select max(ID) from VM", [])[0][0]
+        self.assertIsNone(self.v.buildPooledVM(BOX))
+        #the failed pool VM was removed again
+        self.assertEqual(self.v.queryDB("Select max(ID) from VM", [])[0][0], latest)
+
     def test_destroyVM(self):
         """
         Test ability to destroy a VM
-        MUST BE RUN SEQUENTIALLY
         """
-        results = self.v.destroyVM(80)
-        #print(results)
+        VMid, hostname, ip, results = self.build()
+        results = self.v.destroyVM(VMid)
+        self.assertTrue("Destroying VM" in results)
         vmList = self.v.listVMs()
-        self.assertFalse(('nyc-vm-d80', '10.20.6.', 'Test McTester') in vmList)
+        self.assertFalse((hostname, ip, 'Test McTester') in vmList)
 
     def test_rebuildVM(self):
-        """
-        MUST BE RUN SEQUENTIALLY
-        """
-        results = self.v.rebuildVM(80)
-        #print(results)
+        VMid, hostname, ip, results = self.build()
+        results = self.v.rebuildVM(VMid)
+        self.assertTrue("Destroying VM" in results and "Cloning VM" in results)
         vmList = self.v.listVMs()
-        #print(vmList)
-        self.assertTrue(('nyc-vm-d80', '10.20.6.', 'Test McTester') in vmList)
-        shutil.rmtree(os.path.join(self.v.parentPath, str(80)))
+        self.assertTrue((hostname, ip, 'Test McTester') in vmList)
 
     def test_deleteVM(self):
         """
         Test ability to remove VM
         from the database entirely
         """
+        VMid, hostname, ip, results = self.build()
+        free = self.v.ips.free()
+        self.v.deleteVM(VMid)
         vmList = self.v.listVMs()
-        self.assertTrue(('nyc-vm-d80', '10.20.6.', 'Test McTester') in vmList)
-        vmid = self.v.getIDbyHostname("nyc-vm-d80")
-        self.v.deleteVM(vmid)
-        vmList = self.v.listVMs()
-        self.assertFalse(('nyc-vm-d80', '10.20.6.', 'Test McTester') in vmList)
-        
+        self.assertFalse((hostname, ip, 'Test McTester') in vmList)
+        self.assertEqual(self.v.ips.free(), free + 1)
+
+    def test_reconcile(self):
+        """
+        The state vagrant reports reaches listVMs
+        """
+        VMid, hostname, ip, results = self.build()
+        Reconciler(self.v).reconcile()
+        states = dict((vm[0], vm[3]) for vm in self.v.listVMs(withState=True))
+        self.assertEqual(states[hostname], 'running')
+        self.v.destroyVM(VMid)
+        Reconciler(self.v).reconcile()
+        self.assertEqual(self.v.queryDB("Select state from VMState Where VMid = ?",
+                                        [VMid]), [('not_created',)])
+
+class TestTemplates(settings):
+    """
+    Test Vagrantfile templating
+    """
+    def test_buildVagrantFile(self):
+        """
+        Every named template renders straight into the VM folder
+        """
+        self.assertEqual(sorted(self.v.listTemplates()),
+                         ['Vagrantfile.j2', 'Vagrantfilej2-a.tmp', 'Vagrantfilej2.tmp'])
+        dirPath = os.path.join(self.v.vmsPath, "999999")
+        os.mkdir(dirPath)
+        try:
+            for name in self.v.listTemplates():
+                data = self.v.buildVagrantFile(999999, name)
+                self.assertEqual(data['hostname'], "nyc-vm-d999999")
+                with open(os.path.join(dirPath, 'Vagrantfile')) as vFile:
+                    self.assertTrue('"nyc-vm-d999999"' in vFile.read())
+            self.assertTrue(os.path.exists(os.path.join(dirPath, 'vagrant_global.rb')))
+            self.assertFalse(os.path.exists(os.path.join(dirPath, 'Vagrantfile.j2')))
+        finally:
+            shutil.rmtree(dirPath)
+
+    def test_compiledOnce(self):
+        """
+        Templates are compiled once and shared
+        """
+        first = self.v.templates.get_template('Vagrantfile.j2')
+        self.assertIs(first, self.v.templates.get_template('Vagrantfile.j2'))
+        other = V_API(SERVICE, DB, BOX)
+        self.assertIs(self.v.templates, other.templates)
 
 class TestClaims(settings):
     """
@@ -155,9 +536,84 @@ class TestClean(settings):
     """
     Test ability to remove abandonded VMs
     """
-    def cleanVMs(self):
-        cleaned = self.v.cleanVMs()
-        self.assertTrue((77,) in cleaned)
+    def setUp(self):
+        self.running = {}
+        self.most = {}
+        self.lock = threading.Lock()
+        def runVagrant(VMid, verb, args=[], progress=None):
+            box = self.v.queryDB("Select box from VM Where ID = ?", [VMid])[0][0]
+            with self.lock:
+                self.running[box] = self.running.get(box, 0) + 1
+                self.most[box] = max(self.most.get(box, 0), self.running[box])
+            time.sleep(0.05)
+            with self.lock:
+                self.running[box]-= 1
+            return vagrant_runner.RunResult(0 if VMid != 76 else 1,
+                                            verb, None, None, 0.05)
+        #stand in for vagrant on this instance only
+        self.v.runVagrant = runVagrant
+
+    def tearDown(self):
+        del self.v.runVagrant
+
+    def test_cleanVMs(self):
+        """
+        Inactive VMs and VMs of former employees are destroyed
+        and reported one by one
+        """
+        summary = self.v.cleanVMs()
+        byID = dict((r['ID'], r) for r in summary['results'])
+        self.assertTrue(77 in byID)
+        self.assertTrue(76 in byID)
+        self.assertTrue(byID[77]['ok'])
+        self.assertFalse(byID[76]['ok'])
+        self.assertEqual(summary['failed'], 1)
+        self.assertEqual(self.v.queryDB("Select active from VM Where ID = 76", []),
+                         [(0,)])
+
+    def test_parallelism(self):
+        """
+        Destroys run at once, within each box's limit
+        """
+        self.v.queryDB("Update VM set active = 0, box = 'vsphere' "
+                       "Where ID between 60 and 69", [])
+        saved = constants.CLEAN_PARALLELISM
+        constants.CLEAN_PARALLELISM = {'vsphere': 3}
+        try:
+            start = time.time()
+            summary = self.v.cleanVMs()
+        finally:
+            constants.CLEAN_PARALLELISM = saved
+        self.assertEqual(len(summary['results']), 12)
+        self.assertEqual(self.most['vsphere'], 3)
+        #ten 0.05s destroys three at a time
+        self.assertTrue(time.time() - start < 0.45)
+
+class TestEngine(settings):
+    """
+    Test the shared V_API used by the bot and web API
+    """
+    def test_sharedEngine(self):
+        """
+        Every caller should get the same V_API
+        until it is shut down
+        """
+        first = engine.startup(SERVICE, DB, BOX)
+        self.assertIs(first, engine.get())
+        self.assertIs(first, engine.startup(SERVICE, DB, BOX))
+        engine.shutdown()
+        second = engine.startup(SERVICE, DB, BOX)
+        self.assertIsNot(first, second)
+        engine.shutdown()
+
+    def test_blockedCommandCache(self):
+        """
+        Blocked commands are cached until one is added
+        """
+        cached = self.v.getBlockedCommands()
+        self.assertIs(cached, self.v.getBlockedCommands())
+        self.v.addBlockedCommand("shutdown")
+        self.assertTrue("shutdown" in self.v.getBlockedCommands())
 
 class TestIdentity(settings):
     """
@@ -251,6 +707,123 @@ class TestIdentity(settings):
         self.assertTrue(("Mid Temp",uid) in uList)
         
 
+class TestIPPool(settings):
+    """
+    Test VM address allocation
+    """
+    def newVM(self, hostname, ip=None):
+        self.v.queryDB("Insert into VM(hostname, ownerID, active, ip) "
+                       "Values(?, 78, 1, ?)", [hostname, ip])
+        return self.v.queryDB("Select ID from VM Where hostname = ?", [hostname])[0][0]
+
+    def test_allocate(self):
+        """
+        Addresses are handed out in order, skipping reserved hosts,
+        and released addresses are reused
+        """
+        pool = IPPool(['10.0.0.0/29'])
+        self.assertEqual(pool.free(), 5)
+        pool.load(['10.0.0.3', '1', None, '192.168.0.1'])
+        self.assertEqual(pool.allocate(), '10.0.0.2')
+        self.assertEqual(pool.allocate(), '10.0.0.4')
+        self.assertEqual(pool.allocate(), '10.0.0.5')
+        self.assertEqual(pool.allocate(), '10.0.0.6')
+        self.assertRaises(PoolExhausted, pool.allocate)
+        pool.release('10.0.0.4')
+        self.assertEqual(pool.allocate(), '10.0.0.4')
+        self.assertEqual(pool.free(), 0)
+
+    def test_reserveIP(self):
+        """
+        A VM keeps its address and addresses reserved
+        by another process are skipped
+        """
+        first = self.newVM('ip-test-01')
+        ip = ipaddress.ip_address(self.v.reserveIP(first))
+        self.assertTrue(ip in ipaddress.ip_network(constants.IP_POOLS[0]))
+        self.assertEqual(self.v.reserveIP(first), str(ip))
+        #written by someone else after this V_API loaded its pool
+        self.newVM('ip-test-02', str(ip + 1))
+        self.assertEqual(self.v.reserveIP(self.newVM('ip-test-03')), str(ip + 2))
+        self.assertIsNone(self.v.reserveIP(999999))
+
+    def test_concurrentReserve(self):
+        """
+        Concurrent builds never get the same address
+        """
+        ids = [self.newVM('ip-thread-'+str(i)) for i in range(20)]
+        threads = [threading.Thread(target=self.v.reserveIP, args=[VMid])
+                   for VMid in ids]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        ips = [self.v.queryDB("Select ip from VM Where ID = ?", [VMid])[0][0]
+               for VMid in ids]
+        self.assertFalse(None in ips)
+        self.assertEqual(len(set(ips)), 20)
+
+class TestJobs(settings):
+    """
+    Test the background job queue
+    """
+    def test_runJob(self):
+        """
+        Jobs run in the background, are recorded
+        in the Jobs table and notify listeners
+        """
+        jq = JobQueue(self.v, 2, methods=('getUserVMCount',))
+        finished = []
+        jq.addListener(finished.append)
+        jq.start()
+        jobID = jq.submit('getUserVMCount', [78], 'test000', 'C1', '1.5')
+        job = jq.wait(jobID, 10)
+        jq.stop()
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(job['args'], [78])
+        self.assertEqual(job['thread'], '1.5')
+        self.assertEqual(finished[0]['ID'], jobID)
+
+    def test_failedJob(self):
+        """
+        A job whose method raises is recorded as failed,
+        even through the decorators which hide errors
+        """
+        jq = JobQueue(self.v, 1, methods=('other',))
+        jq.start()
+        #other splits its argument, an int raises AttributeError
+        jobID = jq.submit('other', [5])
+        job = jq.wait(jobID, 10)
+        jq.stop()
+        self.assertEqual(job['status'], 'failed')
+        self.assertTrue('split' in job['result'])
+
+    def test_failedVagrant(self):
+        """
+        A job whose vagrant command exits non zero is failed
+        """
+        saved = self.v.vmsPath
+        self.v.vmsPath = tempfile.mkdtemp()
+        os.environ['FAKE_VAGRANT_FAILURE_RATE'] = '1'
+        try:
+            jq = JobQueue(self.v, 1, methods=('buildVM',))
+            jq.start()
+            job = jq.wait(jq.submit('buildVM', [78]), 10)
+            jq.stop()
+        finally:
+            os.environ['FAKE_VAGRANT_FAILURE_RATE'] = '0'
+            shutil.rmtree(self.v.vmsPath)
+            self.v.vmsPath = saved
+        self.assertEqual(job['status'], 'failed')
+        self.assertTrue("Command failed" in job['result'])
+
+    def test_rejectJob(self):
+        """
+        Only whitelisted methods may be queued
+        """
+        jq = JobQueue(self.v, 1)
+        self.assertRaises(ValueError, jq.submit, 'makeAdmin', [0, 78])
+
 class TestLogging(settings):
     """
     Test ability to log various events
@@ -308,6 +881,333 @@ class TestLogging(settings):
         #a record will be made of the call to .getLogsSince()
         self.assertTrue(res[1][2]=="System")
 
+    def test_logPages(self):
+        """
+        Logs come a page of whole events at a time
+        and can be filtered by method and actor
+        """
+        start_time = round(time.time(),2)
+        for i in range(5):
+            self.v.logEvent("pageTest("+str(i)+")", [0, 78])
+        self.v.logEvent("pageTest_other()", [0])
+        page = self.v.getLogsSince(start_time, method="pageTest", limit=2)
+        self.assertEqual([row[0] for row in page],
+                         ["pageTest(0)", "pageTest(0)", "pageTest(1)", "pageTest(1)"])
+        page = self.v.getLogsSince(start_time, after=page[-1][3],
+                                   method="pageTest", limit=2)
+        self.assertEqual([row[0] for row in page][::2], ["pageTest(2)", "pageTest(3)"])
+        mine = self.v.getLogsSince(start_time, actor=78)
+        self.assertEqual(len(mine), 5)
+        self.assertEqual(set(row[2] for row in mine), set(["Test McTester"]))
+        self.assertEqual(self.v.getLogsSince(time.time() + 3600), [])
+        self.assertTrue("Cannot understand" in self.v.getLogsSince("not a time at all"))
+
+    def test_parseTime(self):
+        """
+        Timestamps and ISO-8601 times do not need dateparser
+        """
+        self.assertEqual(parseTime(1539094525), 1539094525.0)
+        self.assertEqual(parseTime("1539094525.25"), 1539094525.25)
+        self.assertEqual(parseTime("2018-10-09T14:15:25Z"), 1539094525.0)
+        self.assertEqual(parseTime("2018-10-09T14:15:25+00:00"), 1539094525.0)
+        self.assertEqual(parseTime("2018-10-09"),
+                         time.mktime((2018, 10, 9, 0, 0, 0, 0, 0, -1)))
+
+    def test_batchedLogging(self):
+        """
+        Test that queued events are written with
+        all of their actors before they are read
+        """
+        self.v.logEvent("This is a batched event", [0, 0])
+        self.assertTrue(self.v.audit.pending() >= 1)
+        query = "Select Actors.actorID from Events "
+        query+= "Join Actors on Events.ID = Actors.eventID "
+        query+= "Where Events.description = ? "
+        query+= "Order by Actors.actorID"
+        res = self.v.queryDB(query,["This is a batched event"])
+        self.assertEqual(res, [(0,),(0,)])
+        self.assertEqual(self.v.audit.pending(), 0)
+
+    def test_badEvent(self):
+        """
+        Test that an event which cannot be written
+        is retried a few times and then dropped,
+        without holding back the events queued with it
+        """
+        buf = AuditBuffer(self.v.pool, batchSize=100, flushInterval=60, maxAttempts=2)
+        buf.add("Written despite its neighbour", [0])
+        buf.add("Never written", [object()])
+        self.assertEqual(buf.flush(), 1)
+        self.assertEqual(buf.pending(), 1)
+        self.assertEqual(buf.flush(), 0)
+        self.assertEqual(buf.pending(), 0)
+        buf.close()
+        query = "Select description from Events Where description = ?"
+        self.assertEqual(self.v.queryDB(query, ["Written despite its neighbour"]),
+                         [("Written despite its neighbour",)])
+        self.assertEqual(self.v.queryDB(query, ["Never written"]), [])
+
+class TestMetrics(settings):
+    """
+    Test method, vagrant and statement metrics
+    """
+    def test_statementKind(self):
+        self.assertEqual(metrics.statementKind("Select ID from VM Where ID = ?"), "select VM")
+        self.assertEqual(metrics.statementKind("Insert or Replace into VMState(a) Values(?)"),
+                         "insert VMState")
+        self.assertEqual(metrics.statementKind("Update VM set active = 0"), "update VM")
+        self.assertEqual(metrics.statementKind("PRAGMA foreign_keys = ON"), "pragma")
+
+    def test_methodMetrics(self):
+        """
+        Logged methods count calls and time,
+        statements are timed by kind
+        """
+        registry = metrics.registry
+        calls = dict(registry.counter('vmbot_method_calls_total'))
+        before = calls.get((('method', 'listUsers'),), 0)
+        self.v.listUsers()
+        calls = dict(registry.counter('vmbot_method_calls_total'))
+        self.assertEqual(calls[(('method', 'listUsers'),)], before + 1)
+        self.assertTrue((('statement', 'select Users'),) in registry.histogram('vmbot_db_seconds'))
+        text = registry.render()
+        self.assertTrue('# TYPE vmbot_method_seconds histogram' in text)
+        self.assertTrue('vmbot_method_seconds_bucket{method="listUsers",le="+Inf"}' in text)
+
+    def test_render(self):
+        registry = metrics.Registry()
+        registry.describe('calls', 'counter', "Calls")
+        registry.inc('calls', {'name': 'a"b'})
+        registry.observe('seconds', None, 0.002)
+        registry.observe('seconds', None, 20)
+        text = registry.render()
+        self.assertTrue('calls{name="a\\"b"} 1' in text)
+        self.assertTrue('seconds_bucket{le="0.001"} 0' in text)
+        self.assertTrue('seconds_bucket{le="0.005"} 1' in text)
+        self.assertTrue('seconds_bucket{le="+Inf"} 2' in text)
+        self.assertTrue('seconds_count 2' in text)
+
+class TestMigrations(settings):
+    """
+    Test schema migrations and the indexes they add
+    """
+    def plan(self, query, quargs):
+        rows = self.v.queryDB("EXPLAIN QUERY PLAN "+query, quargs)
+        return " ".join(row[3] for row in rows)
+
+    def test_upgrade(self):
+        """
+        Migrations are applied once and recorded
+        """
+        latest = migrations.MIGRATIONS[-1][0]
+        self.assertEqual(migrations.currentVersion(self.v.pool), latest)
+        self.assertEqual(migrations.upgrade(self.v.pool), [])
+        rows = self.v.queryDB("Select version from schema_version Order by version",[])
+        self.assertEqual(rows, [(m[0],) for m in migrations.MIGRATIONS])
+
+    def test_rerun(self):
+        """
+        Migrations run again cleanly against
+        a database which already has their changes
+        """
+        self.v.queryDB("Delete from schema_version Where version >= 3", [])
+        self.assertEqual(migrations.upgrade(self.v.pool),
+                         [m[0] for m in migrations.MIGRATIONS if m[0] >= 3])
+        self.assertEqual(migrations.currentVersion(self.v.pool),
+                         migrations.MIGRATIONS[-1][0])
+
+    def test_serviceLookupPlan(self):
+        """
+        Service account lookups use the index
+        and still ignore case
+        """
+        query = "Select ID from ThirdPartyAccount "
+        query+= "Inner Join Users on Users.ID = ThirdPartyAccount.userID "
+        query+= "and serviceID = ? COLLATE NOCASE "
+        query+= "and service = ? COLLATE NOCASE"
+        plan = self.plan(query, ["test000", SERVICE])
+        self.assertTrue("USING INDEX ThirdPartyAccount_service" in plan)
+        self.assertEqual(self.v.getUserID("TEST000"), 78)
+        self.assertTrue(self.v.adminCheckThroughService('ABC123'))
+
+    def test_hotPathPlans(self):
+        """
+        VM counts, event times and actor joins use indexes
+        """
+        plan = self.plan("Select COUNT(VM.ID) from VM Where VM.ownerID = ?", [78])
+        self.assertTrue("INDEX VM_ownerID" in plan)
+        query = "Select Events.description, Events.timestamp, "
+        query+= "Users.name from Events "
+        query+= "Join Actors on Events.ID = Actors.eventID "
+        query+= "Join Users on Actors.actorID = Users.ID "
+        query+= "Where Events.timestamp >= ? "
+        query+= "ORDER BY timestamp ASC"
+        plan = self.plan(query, [time.time()])
+        self.assertTrue("INDEX Events_timestamp" in plan)
+        self.assertTrue("INDEX Actors_eventID" in plan)
+
+class TestReadCache(settings):
+    """
+    Test the generation counter and cached reads
+    """
+    def test_generation(self):
+        """
+        Writes bump the generation, reads do not
+        """
+        before = self.v.generation
+        self.v.listUsers()
+        self.v.getIDbyName("Test McTester")
+        self.assertEqual(self.v.generation, before)
+        self.v.createUser("Cache Person")
+        self.assertEqual(self.v.generation, before + 1)
+        self.v.claimVM(-1, 78)
+        self.assertEqual(self.v.generation, before + 2)
+
+    def test_cache(self):
+        cache = ReadCache(ttl=60, maxEntries=2)
+        self.assertEqual(cache.get('users', 1), None)
+        etag, body = cache.put('users', 1, b'[1]')
+        self.assertEqual(cache.get('users', 1), (etag, b'[1]'))
+        #stale once the generation moves on
+        self.assertEqual(cache.get('users', 2), None)
+        #same data, same etag
+        self.assertEqual(cache.put('users', 2, b'[1]')[0], etag)
+        cache.put('vms', 2, b'[]')
+        cache.put('other', 2, b'{}')
+        self.assertEqual(cache.get('users', 2), None)
+        cache.ttl = 0
+        time.sleep(0.01)
+        self.assertEqual(cache.get('vms', 2), None)
+
+class TestReconciler(settings):
+    """
+    Test recording VM state from vagrant global-status
+    """
+    def globalStatus(self, machines):
+        lines = ["1539094525,,metadata,machine-count,"+str(len(machines))]
+        for machineID, directory, state in machines:
+            lines.append("1539094525,,machine-id,"+machineID)
+            lines.append("1539094525,,provider-name,vsphere")
+            lines.append("1539094525,,machine-home,"+directory)
+            lines.append("1539094525,,state,"+state)
+        lines.append("1539094525,,ui,info,id       name    provider state")
+        return "\n".join(lines)+"\n"
+
+    def test_parseGlobalStatus(self):
+        """
+        Each machine's fields are grouped together
+        """
+        output = self.globalStatus([('abc1234', '/vms/1', 'running'),
+                                    ('def5678', '/vms/2', 'not_created')])
+        machines = parseGlobalStatus(output)
+        self.assertEqual(machines, [{'id': 'abc1234', 'provider': 'vsphere',
+                                     'directory': '/vms/1', 'state': 'running'},
+                                    {'id': 'def5678', 'provider': 'vsphere',
+                                     'directory': '/vms/2', 'state': 'not_created'}])
+
+    def test_reconcile(self):
+        """
+        Machines are matched to VMs by folder
+        and listVMs shows their state without running vagrant
+        """
+        r = Reconciler(self.v)
+        output = self.globalStatus([
+            ('abc1234', os.path.join(self.v.vmsPath, '78'), 'running'),
+            ('def5678', os.path.join(self.v.vmsPath, '77'), 'running'),
+            ('0123456', '/somewhere/else/3', 'running')])
+        self.assertEqual(r.reconcile(output), 3)
+        #a second run replaces the first
+        self.assertEqual(r.reconcile(output), 3)
+        states = dict((vm[0], vm[3]) for vm in self.v.listVMs(withState=True))
+        self.assertEqual(states['test-vm-01'], 'running')
+        self.assertIsNone(states['a'])
+        self.assertEqual(self.v.queryDB("Select VMid from VMState "
+                                        "Where machineID = '0123456'", []), [(None,)])
+
+    def test_findDrift(self):
+        """
+        Records that disagree with vagrant are reported
+        """
+        r = Reconciler(self.v)
+        r.reconcile(self.globalStatus([
+            ('abc1234', os.path.join(self.v.vmsPath, '78'), 'running'),
+            ('def5678', os.path.join(self.v.vmsPath, '77'), 'running'),
+            ('9876543', os.path.join(self.v.vmsPath, '79'), 'not_created')]))
+        self.v.queryDB("Insert into VM(hostname, ownerID, initDate) "
+                       "Values('underConstruction1.0', 78, 1.0)", [])
+        drift = self.v.findDrift()
+        problems = dict((hostname, problem) for VMid, hostname, problem in drift)
+        self.assertFalse('test-vm-01' in problems)
+        self.assertEqual(problems['junk-VM-01'], "inactive but running")
+        self.assertEqual(problems['test-vm-02'], "active but not_created")
+        self.assertEqual(problems['a'], "active but unknown to vagrant")
+        self.assertEqual(problems['underConstruction1.0'], "unfinished build")
+
+class TestRunner(unittest.TestCase):
+    """
+    Test streaming command output
+    """
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+
+    def test_machineReadable(self):
+        """
+        Machine readable lines are turned back into text and stages
+        """
+        line = "1540000000,default,ui,info,==> default: Cloning VM%!(VAGRANT_COMMA) please wait\n"
+        self.assertEqual(vagrant_runner.parseLine(line),
+                         ("==> default: Cloning VM, please wait",
+                          "Cloning VM, please wait"))
+        self.assertEqual(vagrant_runner.parseLine("1540000000,default,state,running\n"),
+                         (None, None))
+        self.assertEqual(vagrant_runner.parseLine("TASK [common : install packages] ***\n")[1],
+                         "TASK: common : install packages")
+
+    def test_streaming(self):
+        """
+        Only the tail is kept in memory, the log has everything
+        and progress is reported as stages change
+        """
+        script = "for i in range(1000):\n"
+        script+= "    print('==> default: step %d' % (i // 100))\n"
+        logPath = os.path.join(self.workDir, 'logs', 'run.log')
+        stages = []
+        result = vagrant_runner.run([sys.executable, '-c', script],
+                                    logPath=logPath,
+                                    progress=stages.append,
+                                    interval=0,
+                                    tailLines=5)
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.tail.split('\n'), ['==> default: step 9'] * 5)
+        self.assertEqual(result.stage, 'step 9')
+        self.assertEqual(stages, ['step %d' % i for i in range(10)])
+        with open(logPath) as log:
+            self.assertEqual(len(log.readlines()), 1000)
+
+    def test_lastStage(self):
+        """
+        A stage held back by the interval is still reported at the end
+        """
+        script = "print('TASK [first]')\n"
+        script+= "print('TASK [last]')\n"
+        stages = []
+        result = vagrant_runner.run([sys.executable, '-c', script],
+                                    progress=stages.append,
+                                    interval=3600)
+        self.assertEqual(result.stage, 'TASK: last')
+        self.assertEqual(stages, ['TASK: first', 'TASK: last'])
+
+    def test_missingCommand(self):
+        """
+        A missing executable is a failed result, not an exception
+        """
+        result = vagrant_runner.run(['no-such-command-here'])
+        self.assertEqual(result.returncode, 127)
+        self.assertTrue("Command failed" in str(result))
+
 class TestSecurity(settings):
     """
     Test ability of API to absolutely
@@ -329,6 +1229,126 @@ class TestSecurity(settings):
         """
         self.assertFalse(self.v.securityCheck("DROP TABLES *"))
 
+    def test_blockedPhrases(self):
+        """
+        Words in a row are blocked wherever they appear,
+        whatever the case and spacing
+        """
+        self.assertTrue(self.v.securityCheck("vagrant ssh -c 'rm -r /tmp/x'"))
+        self.v.addBlockedCommand("rm -rf")
+        self.assertFalse(self.v.securityCheck("vagrant ssh -c 'sudo RM   -RF /'"))
+        self.assertFalse(self.v.securityCheck("server ls;rm -rf /"))
+        self.assertTrue(self.v.securityCheck("server rm -r -f /tmp/x"))
+        self.assertTrue(self.v.securityCheck("server form -rfx"))
+
+    def test_matcher(self):
+        """
+        Phrases sharing words are all found
+        """
+        m = BlockMatcher(["a b c d", "b c e", "c e f g", "halt"])
+        self.assertEqual(m.match("x a b c e"), "b c e")
+        self.assertEqual(m.match("a b c d"), "a b c d")
+        self.assertEqual(m.match("a b c f"), None)
+        self.assertEqual(m.match("HALT now"), "halt")
+        self.assertEqual(tokenize("ls&&Halt"), ['ls', '&&', 'halt'])
+        m.add(b"c f")
+        self.assertEqual(m.match("a b c f"), "c f")
+        self.assertEqual(len(m.entries), 5)
+
+    def test_matcherAdd(self):
+        """
+        A phrase added later is found inside
+        the words of a phrase already there
+        """
+        m = BlockMatcher(["a b c d", "x y"])
+        self.assertIsNone(m.match("a b c z"))
+        m.add("b c")
+        self.assertEqual(m.match("a b c z"), "b c")
+        m.add("c z q")
+        self.assertEqual(m.match("a b c z q"), "b c")
+        self.assertEqual(m.match("b a b x c z q"), "c z q")
+        self.assertEqual(m.match("a b c d"), "b c")
+
+class TestWarmPool(settings):
+    """
+    Test handing out pre-built VMs
+    """
+    def setUp(self):
+        self.built = []
+        self.fail = False
+        def buildPooledVM(box=None, progress=None):
+            time.sleep(0.05)
+            if self.fail:
+                return None
+            hostname = 'pool-vm-'+str(len(self.built))+'-'+str(time.time())
+            self.v.queryDB("Insert into VM(hostname, ownerID, active, box, pooled) "
+                           "Values(?, 0, 1, ?, 1)", [hostname, box])
+            self.built.append(box)
+            return self.v.queryDB("Select ID from VM Where hostname = ?",
+                                  [hostname])[0][0]
+        #stand in for vagrant on this instance only
+        self.v.buildPooledVM = buildPooledVM
+
+    def tearDown(self):
+        del self.v.buildPooledVM
+        self.v.queryDB("Delete from VM Where pooled = 1", [])
+
+    def test_claimPooledVM(self):
+        """
+        A ready VM is re-pointed to its new owner exactly once
+        """
+        self.v.buildPooledVM(BOX)
+        self.assertEqual(self.v.countPooledVMs(), {BOX: 1})
+        VMid = self.v.claimPooledVM(75, BOX)
+        self.assertIsNotNone(VMid)
+        self.assertEqual(self.v.queryDB("Select ownerID, pooled from VM Where ID = ?",
+                                        [VMid]), [(75, None)])
+        self.assertIsNone(self.v.claimPooledVM(75, BOX))
+        self.assertEqual(self.v.countPooledVMs(), {})
+
+    def test_refill(self):
+        """
+        The pool is filled to its target
+        without running more than maxBuilds at once
+        """
+        pool = WarmPool(self.v, {BOX: 3}, maxBuilds=2, interval=60)
+        self.assertEqual(pool.refill(), 2)
+        self.assertEqual(pool.refill(), 0)
+        self.assertEqual(pool.building(), {BOX: 2})
+        pool.start()
+        deadline = time.time() + 5
+        while len(self.built) < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        pool.close()
+        self.assertEqual(self.v.countPooledVMs(), {BOX: 3})
+        self.assertIsNotNone(pool.claim(75, BOX))
+
+    def test_maxPooled(self):
+        """
+        The pool never holds more than maxPooled VMs
+        across every box, whatever the targets
+        """
+        pool = WarmPool(self.v, {BOX: 2, 'vsphere': 2}, maxBuilds=4,
+                        interval=60, maxPooled=3)
+        self.assertEqual(pool.refill(), 3)
+        pool.close()
+        self.assertEqual(len(self.built), 3)
+        #ready VMs count as well as running builds
+        pool = WarmPool(self.v, {BOX: 2, 'vsphere': 2}, maxBuilds=4,
+                        interval=60, maxPooled=3)
+        self.assertEqual(pool.refill(), 0)
+        pool.close()
+
+    def test_failedBuild(self):
+        """
+        A box whose build failed is not retried straight away
+        """
+        self.fail = True
+        pool = WarmPool(self.v, {BOX: 1}, maxBuilds=1, interval=60)
+        self.assertEqual(pool.refill(), 1)
+        pool.close()
+        self.assertEqual(pool.refill(), 0)
+
 class TestUtilities(settings):
     """
     Test internal use methods
@@ -353,3 +1373,22 @@ class TestUtilities(settings):
         query+= "OR VM.active = 1 "
         query+= "Order by VM.hostname"
         self.assertEqual(self.v.listVMs(), self.v.queryDB(query, []))
+
+    def test_threadConnections(self):
+        """
+        A thread's connection is closed when the thread exits
+        """
+        pool = DBPool(DB)
+        threads = [threading.Thread(target=lambda: pool.execute("Select 1", []))
+                   for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(pool.openConnections(), 0)
+        pool.execute("Select 1", [])
+        self.assertEqual(pool.openConnections(), 1)
+        pool.close()
+        self.assertEqual(pool.openConnections(), 0)
+        self.assertRaises(sqlite3.ProgrammingError, pool.execute, "Select 1", [])
+        self.assertEqual(pool.openConnections(), 0)
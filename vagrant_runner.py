@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Runs vagrant and other commands, streaming their output
+"""
+__author__ = "Simon Rosner"
+__credits__ = ["Simon Rosner"]
+__version__ = "2026.10.18"
+__maintainer__ = "Simon Rosner"
+__email__ = ""
+
+import os
+import re
+import subprocess
+import time
+from collections import deque
+
+#ansible task and play headers make good stage names
+_ANSIBLE_HEADER = re.compile(r'^(TASK|PLAY|RUNNING HANDLER) \[(.*)\]')
+#vagrant's human readable lines look like "==> default: Cloning VM..."
+_VAGRANT_UI = re.compile(r'^==> [^:]+: (.*)')
+
+class RunResult:
+    def __init__(self, returncode, tail, logPath, stage, seconds):
+        """
+        Outcome of a command:
+        its exit status,
+        the last lines of output,
+        where the full output was written,
+        the last stage seen
+        and how long it took
+        """
+        self.returncode = returncode
+        self.tail = tail
+        self.logPath = logPath
+        self.stage = stage
+        self.seconds = seconds
+
+    def __str__(self):
+        text = self.tail
+        if self.returncode != 0:
+            text+= "\nCommand failed with exit status "+str(self.returncode)
+        if self.logPath is not None:
+            text+= "\nFull log: "+self.logPath
+        return text
+
+def parseLine(line):
+    """
+    Returns (text, stage) for one line of output.
+    --machine-readable lines are turned back into
+    the text vagrant would have shown, other lines are kept.
+    text is None for machine-readable lines with nothing to show
+    """
+    line = line.rstrip('\n')
+    fields = line.split(',', 3)
+    if len(fields) == 4 and fields[0].isdigit():
+        if fields[2] != 'ui':
+            return None, None
+        #data is "level,message"
+        message = fields[3].split(',', 1)[-1]
+        message = message.replace('%!(VAGRANT_COMMA)', ',').replace('\\n', '\n')
+        line = message
+    stage = None
+    m = _VAGRANT_UI.match(line)
+    if m is not None:
+        stage = m.group(1).strip()
+    else:
+        m = _ANSIBLE_HEADER.match(line)
+        if m is not None:
+            stage = m.group(1) + ": " + m.group(2).strip()
+    return line, stage
+
+def run(command, cwd=None, logPath=None, progress=None, interval=5, tailLines=200):
+    """
+    Runs command, reading its output line by line.
+    Only the last tailLines lines are kept in memory,
+    everything is written to logPath if given.
+    progress(stage) is called when the stage changes,
+    at most once every interval seconds,
+    and once more at the end if the last stage was held back
+    """
+    start = time.time()
+    tail = deque(maxlen=tailLines)
+    stage = None
+    reported = None
+    lastReport = 0
+    log = None
+    if logPath is not None:
+        os.makedirs(os.path.dirname(logPath), exist_ok=True)
+        log = open(logPath, 'w')
+    try:
+        try:
+            proc = subprocess.Popen(command, cwd=cwd,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT,
+                                    universal_newlines=True,
+                                    errors='replace')
+        except OSError as e:
+            if log is not None:
+                log.write(str(e)+'\n')
+            return RunResult(127, str(e), logPath, None, time.time() - start)
+        for line in proc.stdout:
+            if log is not None:
+                log.write(line)
+            text, newStage = parseLine(line)
+            if text is not None:
+                tail.append(text)
+            if newStage is not None:
+                stage = newStage
+            if (progress is not None and stage != reported
+                    and time.time() - lastReport >= interval):
+                reported = stage
+                lastReport = time.time()
+                progress(stage)
+        returncode = proc.wait()
+        if progress is not None and stage != reported:
+            progress(stage)
+    finally:
+        if log is not None:
+            log.close()
+    return RunResult(returncode, '\n'.join(tail), logPath, stage, time.time() - start)
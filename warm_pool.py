@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Keeps built VMs ready so "build new" does not wait for vagrant
+"""
+__author__ = "Simon Rosner"
+__credits__ = ["Simon Rosner"]
+__version__ = "2026.10.18"
+__maintainer__ = "Simon Rosner"
+__email__ = ""
+
+import sys
+import threading
+import time
+
+class WarmPool:
+    def __init__(self, v, targets, maxBuilds=1, interval=300, maxPooled=None):
+        """
+        Builds unassigned VMs in the background
+        and hands them out on request.
+        Requires a V_API,
+        the number of ready VMs wanted per box,
+        the number of pool builds which may run at once,
+        the max seconds between checks of the pool level
+        and the most VMs the pool may hold across every box,
+        counting those being built, or None for no limit
+        """
+        self.v = v
+        self.targets = targets
+        self.maxBuilds = maxBuilds
+        self.interval = interval
+        self.maxPooled = maxPooled
+        self._building = {}     #box -> builds running
+        self._retryAt = {}      #box -> time its next build may start after a failure
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._builders = []
+
+    def start(self):
+        """
+        Starts refilling in the background
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name="warm-pool",
+                                            daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopping:
+            try:
+                self.refill()
+            except Exception as e:
+                sys.stderr.write("warm pool refill failed: "+str(e)+'\n')
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def wake(self):
+        """
+        Checks the pool level now instead of at the next interval
+        """
+        self._wake.set()
+
+    def building(self):
+        """
+        Pool builds running, by box
+        """
+        with self._lock:
+            return dict(self._building)
+
+    def refill(self):
+        """
+        Starts builds for every box below its target,
+        never more than maxBuilds at once
+        and never past maxPooled VMs in the pool.
+        A box whose last build failed waits an interval.
+        Returns the number of builds started
+        """
+        ready = self.v.countPooledVMs()
+        started = 0
+        with self._lock:
+            running = sum(self._building.values())
+            #every pooled VM is paid for, ready or not
+            room = None
+            if self.maxPooled is not None:
+                room = self.maxPooled - sum(ready.values()) - running
+            for box, target in self.targets.items():
+                if time.time() < self._retryAt.get(box, 0):
+                    continue
+                missing = target - ready.get(box, 0) - self._building.get(box, 0)
+                if room is not None:
+                    missing = min(missing, room - started)
+                while missing > 0 and running < self.maxBuilds and not self._stopping:
+                    self._building[box] = self._building.get(box, 0) + 1
+                    t = threading.Thread(target=self._build, args=[box],
+                                         name="warm-pool-build", daemon=True)
+                    t.start()
+                    self._builders.append(t)
+                    missing-= 1
+                    running+= 1
+                    started+= 1
+            self._builders = [t for t in self._builders if t.is_alive()]
+        return started
+
+    def _build(self, box):
+        try:
+            if self.v.buildPooledVM(box) is None:
+                sys.stderr.write("warm pool build for "+str(box)+" failed\n")
+                #do not keep spending on a box that cannot be built
+                with self._lock:
+                    self._retryAt[box] = time.time() + self.interval
+        finally:
+            with self._lock:
+                self._building[box]-= 1
+            #a slot is free, there may be more to build
+            self.wake()
+
+    def claim(self, userID, box=None):
+        """
+        Gives a ready VM to a user and starts a refill.
+        Returns the VM ID, or None if none is ready
+        """
+        VMid = self.v.claimPooledVM(userID, box)
+        if VMid is not None:
+            self.wake()
+        return VMid
+
+    def close(self, wait=True):
+        """
+        Stops refilling.
+        Builds already running are waited for if wait is True
+        """
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if wait:
+            with self._lock:
+                builders = list(self._builders)
+            for t in builders:
+                t.join()
@@ -9,7 +9,11 @@ __maintainer__ = "Simon Rosner"
 __email__ = ""
 
 from vagrant_API import *
-from flask import Flask, jsonify, request
+import engine
+import metrics
+from batch import runBatch
+from read_cache import ReadCache
+from flask import Flask, Response, jsonify, request
 app = Flask(__name__)
 
 #Constants
@@ -18,8 +22,28 @@ SERVICE = constants.SERVICE
 DATABASE = constants.DATABASE
 BOX = constants.BOX
 
+readCache = ReadCache(constants.READ_CACHE_SECONDS)
+
 def v():
-    return V_API(SERVICE, DATABASE, BOX)
+    #one V_API for the whole process, see engine.py
+    return engine.get()
+
+def cachedJSON(key, produce):
+    """
+    JSON response made by produce(V_API), reused until
+    a write bumps the V_API's generation.
+    Answers 304 when If-None-Match has the current ETag
+    """
+    v2 = v()
+    #read before producing so a write made meanwhile is not missed
+    generation = v2.generation
+    entry = readCache.get(key, generation)
+    if entry is None:
+        entry = readCache.put(key, generation, jsonify(produce(v2)).get_data())
+    etag, body = entry
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    return response.make_conditional(request)
 
 @app.route('/addBlockedCommand/',methods=['POST'])
 def addBlockedCommand():
@@ -50,6 +74,20 @@ def adminCheckThroughService():
     res = v().adminCheckThroughService(request.args.get('serviceID'))
     return jsonify(res)
 
+@app.route('/batch/', methods=['POST'])
+def batch():
+    """
+    JSON body, a list of operations:
+        [{"method": "createUser", "args": ["Anne Anyone"]}, ...]
+    Database operations share one transaction,
+    builds and rebuilds are queued as jobs.
+    Returns a result per operation, see batch.py
+    """
+    try:
+        return jsonify(runBatch(v(), request.get_json(silent=True), engine.jobs))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
 @app.route('/buildThroughService/', methods=['POST'])
 def buildThroughService():
     """
@@ -110,7 +148,7 @@ def cleanVMs():
     """
     uid = request.args.get('userID')
     v2 = v()
-    if v2.adminCheck(userID) or v2.adminCheckThroughService(userID):
+    if v2.adminCheck(uid) or v2.adminCheckThroughService(uid):
         return jsonify(v2.cleanVMs())
     else:
         return 'Only admins can do that'
@@ -133,7 +171,7 @@ def createUser():
     """
     return jsonify(v().createUser(request.args.get('name')))
 
-@app.route('/deleteVM/',method=['POST'])
+@app.route('/deleteVM/',methods=['POST'])
 def deleteVM():
     """
     int:VMid
@@ -173,9 +211,18 @@ def getIDbyHostname():
 @app.route('/getLogsSince/',methods=['POST'])
 def getLogsSince():
     """
-    int:time
-    """
-    return jsonify(v().getLogsSince(request.args.get('time')))
+    int|string:time
+    optional:
+        int:after, event ID of the last row of the previous page
+        int:actor
+        string:method
+        int:limit
+    """
+    return jsonify(v().getLogsSince(request.args.get('time'),
+                                    request.args.get('after'),
+                                    request.args.get('actor'),
+                                    request.args.get('method'),
+                                    request.args.get('limit')))
 
 @app.route('/getUserID/',methods=['POST'])
 def getUserID():
@@ -193,11 +240,15 @@ def guessIDbyName():
 
 @app.route('/listUsers/')
 def listUsers():
-    return jsonify(v().listUsers())
+    return cachedJSON('listUsers', lambda v2: v2.listUsers())
 
 @app.route('/listVMs/')
 def listVMs():
-    return jsonify(v().listVMs())
+    """
+    optional:state, adds the state vagrant last reported
+    """
+    withState = 'state' in request.args
+    return cachedJSON(('listVMs', withState), lambda v2: v2.listVMs(withState=withState))
 
 @app.route('/makeAdmin/',methods=['POST'])
 def makeAdmin():
@@ -213,6 +264,14 @@ def makeAdmin():
     else:
         return 'Only admins can do that'
 
+@app.route('/metrics')
+def metricsText():
+    """
+    Every counter and histogram in Prometheus text format
+    """
+    return Response(metrics.registry.render(),
+                    mimetype='text/plain; version=0.0.4')
+
 @app.route('/provisionVM/',methods=['POST'])
 def provisionVM():
     """
@@ -270,8 +329,8 @@ def rebuildVM():
     """
     return jsonify(v().rebuildVM(request.args.get('VMid')))
 
-@app.route('/removeUser/',method=['POST'])
-def removeUser()
+@app.route('/removeUser/',methods=['POST'])
+def removeUser():
     """
     int|string:userID
     int:targetID
@@ -295,4 +354,8 @@ def userOwnsVM():
     return jsonify(res)
 
 if __name__ == '__main__':
-   app.run(debug = True)
+   engine.startup(SERVICE, DATABASE, BOX)
+   try:
+       app.run(debug = True)
+   finally:
+       engine.shutdown()